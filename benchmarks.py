@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+
+# Micro-benchmarks for wyag's hot paths.  Each benchmark builds a
+# synthetic repository in a temporary directory, and prints timings.
+#
+#     ./benchmarks.py              # run everything
+#     ./benchmarks.py checkout     # run one benchmark
+
+import argparse
+import collections
+import hashlib
+import itertools
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import libwyag
+
+def timed(label, fn, *args, **kwargs):
+    start = time.perf_counter()
+    ret = fn(*args, **kwargs)
+    print(f"  {label:<40} {time.perf_counter() - start:8.3f}s")
+    return ret
+
+def synthetic_repo(path, files, size, dirs=100):
+    """Create a repository at path, holding a single tree of files
+    blobs of size bytes each, spread over dirs directories.  Return
+    the repository and the tree's SHA."""
+
+    repo = libwyag.repo_create(path)
+    entries = list()
+
+    for i in range(files):
+        data = (f"file {i}\n".encode() * (size // 8 + 1))[:size]
+        sha = libwyag.object_write(libwyag.GitBlob(data), repo)
+        entries.append(libwyag.GitIndexEntry(ctime=(0, 0), mtime=(0, 0), dev=0, ino=0,
+                                             mode_type=0b1000, mode_perms=0o644,
+                                             uid=0, gid=0, fsize=size, sha=sha,
+                                             flag_assume_valid=False, flag_stage=0,
+                                             name=f"d{i % dirs}/f{i}"))
+
+    tree = libwyag.tree_from_index(repo, libwyag.GitIndex(entries=entries))
+    return repo, tree
+
+def synthetic_history(repo, commits, merge_every=100):
+    """Write a history of commits commits on a single tree, mostly
+    linear, with a merge of a one-commit side branch every merge_every
+    commits.  Point master to the last one, and return its SHA."""
+
+    tree = libwyag.object_write(libwyag.GitTree(), repo)
+    parents = []
+
+    for i in range(commits):
+        commit = libwyag.GitCommit()
+        commit.kvlm = collections.OrderedDict()
+        commit.kvlm[b'tree'] = tree.encode("ascii")
+        if parents:
+            commit.kvlm[b'parent'] = parents if len(parents) > 1 else parents[0]
+        date = 1600000000 + 60 * i
+        commit.kvlm[b'author'] = f"Wyag <wyag@example.com> {date} +0000".encode()
+        commit.kvlm[b'committer'] = f"Wyag <wyag@example.com> {date} +0000".encode()
+        commit.kvlm[None] = f"Commit {i}\n".encode()
+        sha = libwyag.object_write(commit, repo).encode("ascii")
+
+        if merge_every and i % merge_every == merge_every - 1 and len(parents) == 1:
+            # The next commit merges this one with its parent's other child
+            parents = [ sha ] + [ p for p in parents ]
+        else:
+            parents = [ sha ]
+
+    libwyag.ref_create(repo, "heads/master", parents[0].decode("ascii"))
+    return parents[0].decode("ascii")
+
+def bench_checkout(args):
+    """Serial against parallel checkout of a wide tree"""
+
+    with tempfile.TemporaryDirectory() as tmp:
+        repo, tree_sha = synthetic_repo(os.path.join(tmp, "repo"), args.files, args.size)
+        dest = os.path.join(tmp, "dest")
+
+        for jobs in [ 1 ] + [ j for j in (2, 4, 8) if j <= (os.cpu_count() or 1) * 2 ]:
+            # A fresh repository object for each run, so that caches
+            # don't favour later runs.
+            repo = libwyag.GitRepository(repo.worktree)
+            tree = libwyag.object_read(repo, tree_sha)
+            os.mkdir(dest)
+            if jobs == 1:
+                timed("checkout (serial)", libwyag.tree_checkout, repo, tree, dest)
+            else:
+                timed(f"checkout -j {jobs}", libwyag.tree_checkout_parallel, repo, tree, dest, jobs)
+            shutil.rmtree(dest)
+
+def bench_index(args):
+    """Reading and writing a large index"""
+
+    with tempfile.TemporaryDirectory() as tmp:
+        repo = libwyag.repo_create(os.path.join(tmp, "repo"))
+        entries = [ libwyag.GitIndexEntry(ctime=(1700000000, i), mtime=(1700000000, i), dev=2049, ino=i,
+                                          mode_type=0b1000, mode_perms=0o644, uid=1000, gid=1000,
+                                          fsize=i, sha=f"{i:040x}", flag_assume_valid=False, flag_stage=0,
+                                          name=f"src/module{i % 500}/component{i % 37}/file{i}.py")
+                    for i in range(args.files) ]
+        index = libwyag.GitIndex(entries=entries)
+
+        for _ in range(3):
+            timed(f"index_write, {args.files} entries", libwyag.index_write, repo, index)
+            timed(f"index_read, {args.files} entries", libwyag.index_read, repo)
+
+        # git must be able to read a split index with an fsmonitor
+        # token, after a change that leaves few entries in the split
+        # index itself.
+        if shutil.which("git"):
+            hook = os.path.join(tmp, "fsmonitor-hook")
+            with open(hook, "w") as f:
+                f.write("#!/bin/sh\nprintf 'token\\0/'\n")
+            os.chmod(hook, 0o755)
+
+            repo = libwyag.GitRepository(repo.worktree)
+            repo.conf.set("core", "splitIndex", "true")
+            index = libwyag.GitIndex(entries=[ e for e in entries[:100] if e.sha != "0" * 40 ])
+            index.fsmonitor_token = "token"
+            index.fsmonitor_dirty = { index.entries[-1].name }
+            libwyag.index_write(repo, index)
+            index.entries[0] = libwyag.GitIndexEntry(**{ slot: getattr(index.entries[0], slot)
+                                                         for slot in libwyag.GitIndexEntry.__slots__ })
+            index.entries[0].fsize += 1
+            libwyag.index_write(repo, index)
+
+            git = subprocess.run([ "git", "-c", f"core.fsmonitor={hook}", "-c", "core.fsmonitorHookVersion=2",
+                                   "status", "--porcelain" ],
+                                 cwd=repo.worktree, capture_output=True, text=True)
+            if git.returncode != 0:
+                raise Exception(f"git can't read a split index with fsmonitor data:\n{git.stderr}")
+
+def bench_ignore(args):
+    """Matching paths against a large .gitignore"""
+
+    rules = [ f"/generated{i}/" for i in range(200) ]
+    rules += [ f"*.ext{i}" for i in range(200) ]
+    rules += [ f"cache{i}" for i in range(200) ]
+    rules += [ f"src/**/tmp{i}" for i in range(200) ]
+    rules += [ f"!keep{i}.ext{i}" for i in range(200) ]
+    ignore = libwyag.GitIgnore(absolute=[], scoped={ "": libwyag.GitIgnoreMatcher(libwyag.gitignore_parse(rules)) })
+    paths = [ f"src/module{i % 500}/component{i % 37}/file{i}.ext{i % 400}" for i in range(args.files) ]
+
+    timed(f"compile, {len(rules)} rules", libwyag.GitIgnoreMatcher, libwyag.gitignore_parse(rules))
+    timed(f"check_ignore, {args.files} paths", lambda: [ libwyag.check_ignore(ignore, p) for p in paths ])
+
+def bench_refs(args):
+    """Listing and resolving many tags, loose then packed"""
+
+    with tempfile.TemporaryDirectory() as tmp:
+        repo, tree = synthetic_repo(os.path.join(tmp, "repo"), 1, 16)
+        names = [ f"v{i // 1000}.{i % 1000}" for i in range(args.files) ]
+        for name in names:
+            libwyag.ref_create(repo, "tags/" + name, tree)
+
+        for packed in (False, True):
+            if packed:
+                libwyag.pack_refs(repo)
+            label = "packed" if packed else "loose"
+
+            # A fresh repository object, with an empty ref cache
+            repo = libwyag.GitRepository(repo.worktree)
+            timed(f"ref_list, {args.files} {label} tags", libwyag.ref_list, repo)
+            repo = libwyag.GitRepository(repo.worktree)
+            timed(f"object_resolve, {len(names[::10])} {label} tags",
+                  lambda: [ libwyag.object_resolve(repo, name) for name in names[::10] ])
+
+def bench_abbrev(args):
+    """Resolving and abbreviating hashes, loose then packed"""
+
+    with tempfile.TemporaryDirectory() as tmp:
+        repo, tree = synthetic_repo(os.path.join(tmp, "repo"), args.files, 16)
+        shas = [ sha.hex() for _, _, subtree in libwyag.tree_entries(libwyag.object_read(repo, tree))
+                 for _, _, sha in libwyag.tree_entries(libwyag.object_read(repo, subtree.hex())) ][::10]
+
+        for packed in (False, True):
+            if packed:
+                libwyag.repack(repo, prune=True)
+            label = "packed" if packed else "loose"
+
+            # A fresh repository object, with nothing listed yet
+            repo = libwyag.GitRepository(repo.worktree)
+            timed(f"object_resolve, {len(shas)} {label} short hashes",
+                  lambda: [ libwyag.object_resolve(repo, sha[:8]) for sha in shas ])
+            timed(f"object_abbrev, {len(shas)} {label} objects",
+                  lambda: [ libwyag.object_abbrev(repo, sha) for sha in shas ])
+
+def bench_history(args):
+    """Walking a long history, with and without a commit graph"""
+
+    with tempfile.TemporaryDirectory() as tmp:
+        repo = libwyag.repo_create(os.path.join(tmp, "repo"))
+        commits = args.commits or 10000
+        head = timed(f"write {commits} commits", synthetic_history, repo, commits)
+
+        repo = libwyag.GitRepository(repo.worktree)
+        timed("rev-list, from commit objects", lambda: sum(1 for _ in libwyag.commits_reachable(repo, [ head ])))
+        timed("commit-graph write", libwyag.commit_graph_write, repo)
+
+        repo = libwyag.GitRepository(repo.worktree)
+        timed("rev-list, from the commit graph", lambda: sum(1 for _ in libwyag.commits_reachable(repo, [ head ])))
+        timed("log -n 10", lambda: list(itertools.islice(libwyag.log_walk(repo, [ head ]), 10)))
+        timed("log, by date", lambda: sum(1 for _ in libwyag.log_walk(repo, [ head ])))
+        timed("log --topo-order", lambda: sum(1 for _ in libwyag.log_walk(repo, [ head ], topo=True)))
+
+def bench_parse(args):
+    """Parsing the commits of a long history, eagerly and lazily"""
+
+    commits = args.commits or 100000
+
+    # A synthetic history, in memory: a chain of commits, one in ten
+    # of them signed, as raw objects.  One in a thousand has its
+    # headers out of the usual order, which the lazy accessors can't
+    # take shortcuts on.
+    raws = list()
+    parent = None
+    for i in range(commits):
+        date = 1600000000 + 60 * i
+        author = f"author Wyag <wyag@example.com> {date} +0000\n".encode()
+        raw = author if i % 1000 == 999 else b""
+        raw += f"tree {i:040x}\n".encode()
+        if parent:
+            raw += b"parent " + parent + b"\n"
+        if i % 1000 != 999:
+            raw += author
+        raw += f"committer Wyag <wyag@example.com> {date} +0000\n".encode()
+        if i % 10 == 0:
+            raw += b"gpgsig -----BEGIN PGP SIGNATURE-----\n \n " + b"A" * 64 + b"\n -----END PGP SIGNATURE-----\n"
+        raw += f"\nCommit {i}\n\nWith a longer description of what it does.\n".encode()
+        raws.append(raw)
+        parent = hashlib.sha1(b"commit " + str(len(raw)).encode() + b"\x00" + raw).hexdigest().encode()
+
+    def eager():
+        for raw in raws:
+            kvlm = libwyag.kvlm_parse(raw)
+            kvlm[b'tree'].decode("ascii"), kvlm.get(b'parent', b'').decode("ascii")
+            int(kvlm[b'committer'].split(b' ')[-2])
+
+    def lazy():
+        for raw in raws:
+            commit = libwyag.GitCommit(raw)
+            libwyag.kvlm_sha_headers(commit, b'tree'), libwyag.kvlm_sha_headers(commit, b'parent')
+            libwyag.commit_date(commit)
+
+    # Lazy or not, we must read the same headers.
+    for raw in raws:
+        for key in [ b'tree', b'parent' ]:
+            if libwyag.kvlm_sha_headers(libwyag.GitCommit(raw), key) != \
+               libwyag.kvlm_sha_headers_parsed(libwyag.GitCommit(raw), key):
+                raise Exception(f"Lazy and parsed {key.decode()} headers differ on:\n{raw.decode()}")
+
+    timed(f"kvlm_parse, {commits} commits", eager)
+    timed(f"tree, parents and date, {commits} commits", lazy)
+    timed(f"kvlm_serialise, {commits} commits",
+          lambda: [ libwyag.kvlm_serialise(libwyag.GitCommit(raw).kvlm) for raw in raws ])
+
+def bench_tree(args):
+    """Reading a wide tree, eagerly and lazily"""
+
+    tree = libwyag.GitTree()
+    tree.items = [ libwyag.GitTreeLeaf(mode=b"100644", path=f"file{i}.py", sha=f"{i:040x}")
+                   for i in range(args.files) ]
+    raw = tree.serialise()
+    names = [ f"file{i}.py" for i in range(0, args.files, max(1, args.files // 100)) ]
+
+    timed(f"tree_parse, {args.files} entries", libwyag.tree_parse, raw)
+    timed(f"tree_entries, {args.files} entries", lambda: sum(1 for _ in libwyag.tree_entries(libwyag.GitTree(raw))))
+
+    # Each lookup gets a fresh tree, as after a cache miss.
+    timed(f"find {len(names)} names, scanning items",
+          lambda: [ next(leaf for leaf in libwyag.GitTree(raw).items if leaf.path == name) for name in names ])
+    timed(f"find {len(names)} names, with tree_lookup",
+          lambda: [ libwyag.tree_lookup(libwyag.GitTree(raw), name.encode()) for name in names ])
+    # Trees usually come from the object cache, which keeps offsets.
+    tree = libwyag.GitTree(raw)
+    timed(f"find {len(names)} names, with tree_lookup, cached",
+          lambda: [ libwyag.tree_lookup(tree, name.encode()) for name in names ])
+
+benchmarks = {
+    "checkout" : bench_checkout,
+    "index"    : bench_index,
+    "ignore"   : bench_ignore,
+    "refs"     : bench_refs,
+    "abbrev"   : bench_abbrev,
+    "history"  : bench_history,
+    "parse"    : bench_parse,
+    "tree"     : bench_tree,
+}
+
+def main(argv=sys.argv[1:]):
+    argparser = argparse.ArgumentParser(description="Benchmark wyag")
+    argparser.add_argument("names", nargs="*", help="Benchmarks to run: {}".format(", ".join(benchmarks)))
+    argparser.add_argument("--files", type=int, default=10000, help="Number of files in synthetic trees")
+    argparser.add_argument("--commits", type=int, default=None, help="Number of commits in synthetic histories (default: 10000, or 100000 for parse)")
+    argparser.add_argument("--size", type=int, default=4096, help="Size of synthetic files, in bytes")
+    args = argparser.parse_args(argv)
+
+    for name in args.names:
+        if name not in benchmarks:
+            argparser.error(f"Unknown benchmark {name}")
+
+    for name in args.names or benchmarks:
+        print(f"{name}: {benchmarks[name].__doc__}")
+        benchmarks[name](args)
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,30 @@
 import argparse
+import array
+import bisect
 import collections
+import concurrent.futures
 import configparser
+import contextlib
+import errno
+import functools
+import ctypes, ctypes.util
 from datetime import datetime
 import grp, pwd
 from fnmatch import fnmatch
 import hashlib
+import heapq
+import itertools
 from math import ceil
+import mmap
 import re
+import select
+import socket
+import stat
+import struct
 import sys
+import tempfile
+import threading
+import time
 import zlib
 import os
 
@@ -34,14 +51,35 @@ def main(argv=sys.argv[1:]):
         case "rm"           : cmd_rm(args)
         case "add"          : cmd_add(args)
         case "commit"       : cmd_commit(args)
+        case "repack"       : cmd_repack(args)
+        case "gc"           : cmd_gc(args)
+        case "pack-refs"    : cmd_pack_refs(args)
+        case "commit-graph" : cmd_commit_graph(args)
+        case "rev-list"     : cmd_rev_list(args)
+        case "fsmonitor"    : cmd_fsmonitor(args)
         case _              : print("Bad command.")
 
+    # Setting WYAG_CACHE_STATS dumps cache counters to stderr, which
+    # helps tuning their sizes.
+    if os.environ.get("WYAG_CACHE_STATS"):
+        for cache in LRUCache.instances:
+            print(f"{cache.name}: {cache.hits} hits, {cache.misses} misses, "
+                  f"{cache.size}/{cache.limit} bytes in {len(cache.entries)} entries", file=sys.stderr)
+
 class GitRepository(object):
     """A git repository"""
 
     worktree = None
     gitdir = None
     conf = None
+    packs = None
+    delta_base_cache = None
+    object_cache = None
+    object_info_cache = None
+    gitignore_cache = None
+    refs = None
+    loose_names = None
+    commit_graph = None
 
     def __init__(self, path, force=False) -> None:
         self.worktree = path
@@ -123,6 +161,44 @@ def repo_create(path):
 
     return repo
         
+def repo_config_int(repo, section, key, default):
+    """Read an integer from the repository's configuration.  As in
+    git, integers may be suffixed with k, m or g."""
+
+    value = repo.conf.get(section, key, fallback=None) if repo.conf else None
+
+    if value is None:
+        return default
+
+    units = { "k": 1024, "m": 1024 ** 2, "g": 1024 ** 3 }
+    value = value.strip().lower()
+
+    if value and value[-1] in units:
+        return int(value[:-1]) * units[value[-1]]
+
+    return int(value)
+
+def repo_config_bool(repo, section, key, default):
+    """Read a boolean from the repository's configuration."""
+
+    if not repo.conf:
+        return default
+
+    return repo.conf.getboolean(section, key, fallback=default)
+
+def repo_jobs(repo, jobs, section, key, default=1):
+    """Return the number of workers to use: jobs if given, else the
+    configured section.key, else default.  As in git, a value below 1
+    means one worker per core."""
+
+    if jobs is None:
+        jobs = repo_config_int(repo, section, key, default)
+
+    if jobs < 1:
+        jobs = os.cpu_count() or 1
+
+    return jobs
+
 def repo_default_config():
     ret = configparser.ConfigParser()
 
@@ -179,55 +255,757 @@ class GitObject(object):
 
 def object_read(repo, sha):
     """Read object sha from Git repository repo.  Return a
-    GitObject whose exact type depends on the object."""
+    GitObject whose exact type depends on the object.
 
-    path = repo_file(repo, "objects", sha[:2], sha[2:])
+    Objects are cached, so callers must not modify them."""
 
-    if not os.path.isfile(path):
+    cache = repo_object_cache(repo)
+    obj = cache.get(sha)
+
+    if obj:
+        return obj
+
+    raw = object_read_raw(repo, sha)
+
+    if not raw:
         return None
-    
+
+    fmt, data = raw
+
+    match fmt:
+        case b'commit'  : c=GitCommit
+        case b'tree'    : c=GitTree
+        case b'tag'     : c=GitTag
+        case b'blob'    : c=GitBlob
+        case _:
+            raise Exception(f"Unknown type {fmt.decode('ascii')} for object {sha}")
+
+    obj = c(data)
+    repo_object_info_cache(repo)[sha] = (fmt, len(data))
+    cache.put(sha, obj, len(data))
+
+    return obj
+
+def repo_object_cache(repo):
+    """Return the repository's cache of parsed objects, keyed by SHA.
+    Its size is bounded by wyag.objectCacheLimit, 64MiB by default."""
+
+    if repo.object_cache is None:
+        limit = repo_config_int(repo, "wyag", "objectCacheLimit", 64 * 1024 ** 2)
+        repo.object_cache = LRUCache("object cache", limit)
+
+    return repo.object_cache
+
+def repo_object_info_cache(repo):
+    """Return the repository's map of SHA to (fmt, size).  Entries are
+    tiny, and much more useful than full objects (we often only need
+    the type of an object), so it isn't bounded."""
+
+    if repo.object_info_cache is None:
+        repo.object_info_cache = dict()
+
+    return repo.object_info_cache
+
+def object_info(repo, sha):
+    """Return the type and size of object sha as a pair (fmt, size),
+    or None if it doesn't exist.  This only inflates the first few
+    bytes of the object, however large it is."""
+
+    cache = repo_object_info_cache(repo)
+    info = cache.get(sha)
+
+    if info:
+        return info
+
+    path = repo_path(repo, "objects", sha[:2], sha[2:])
+
+    if os.path.isfile(path):
+        with open(path, "rb") as f:
+            fmt, size, _ = object_loose_header(f, zlib.decompressobj(), 256)
+        info = (fmt, size)
+    else:
+        found = pack_locate(repo, sha)
+        if not found:
+            return None
+        info = pack_object_info(repo, *found)
+
+    cache[sha] = info
+    return info
+
+def object_read_raw(repo, sha):
+    """Read object sha from Git repository repo, either from its loose
+    file or from one of the packfiles.  Return a pair (fmt, data), or
+    None if the object doesn't exist."""
+
+    path = repo_path(repo, "objects", sha[:2], sha[2:])
+
+    if not os.path.isfile(path):
+        # Not a loose object: most objects in a cloned or gc'd
+        # repository live in packfiles.
+        return pack_read_raw(repo, sha)
+
     with open(path, "rb") as f:
         raw = zlib.decompress(f.read())
 
-        # read object type
-        x = raw.find(b' ')
-        fmt = raw[:x]
+    # read object type
+    x = raw.find(b' ')
+    fmt = raw[:x]
+
+    # read and validate object size
+    y = raw.find(b'\x00', x)
+    size = int(raw[x:y].decode('ascii'))
 
-        # read and validate object size
-        y = raw.find(b'\x00', x)
-        size = int(raw[x:y].decode('ascii'))
+    if size != len(raw) - y - 1:
+        raise Exception(f"Malformed objext {sha}: bad length")
 
-        if size != len(raw) - y - 1:
-            raise Exception(f"Malformed objext {sha}: bad length")
-        
-        match fmt:
-            case b'commit'  : c=GitCommit
-            case b'tree'    : c=GitTree
-            case b'tag'     : c=GitTag
-            case b'blob'    : c=GitBlob
-            case _:
-                raise Exception(f"Unknown type {fmt.decode('ascii')} for object {sha}")
-            
-        return c(raw[y + 1:])
+    return fmt, raw[y + 1:]
+
+def object_loose_header(f, d, chunk_size):
+    """Inflate, with decompressor d, just enough of the loose object
+    file f to read its "fmt size\\0" header.  Return a triple (fmt,
+    size, inflated data past the header)."""
+
+    header = b''
+    while b'\x00' not in header:
+        data = d.unconsumed_tail or f.read(chunk_size)
+        if not data:
+            raise Exception(f"Truncated object {f.name}")
+        # A header is a few dozen bytes at most.
+        header += d.decompress(data, 64)
+
+    x = header.find(b' ')
+    y = header.find(b'\x00', x)
+    fmt = header[:x]
+    size = int(header[x:y].decode("ascii"))
+
+    return fmt, size, header[y + 1:]
+
+def object_loose_stream(repo, sha, chunk_size=65536):
+    """Open loose object sha for streaming.  Return a triple (fmt,
+    size, chunks), chunks being an iterator over the inflated data, or
+    None if there's no such loose object."""
+
+    path = repo_path(repo, "objects", sha[:2], sha[2:])
+
+    if not os.path.isfile(path):
+        return None
+
+    f = open(path, "rb")
+    d = zlib.decompressobj()
+    fmt, size, rest = object_loose_header(f, d, chunk_size)
+
+    def chunks():
+        with f:
+            if rest:
+                yield rest
+            while not d.eof:
+                data = d.unconsumed_tail or f.read(chunk_size)
+                if not data:
+                    raise Exception(f"Truncated object {sha}")
+                data = d.decompress(data, chunk_size)
+                if data:
+                    yield data
+
+    return fmt, size, chunks()
+
+# Objects are compressed and written in pieces of this size, so that
+# we never hold a whole compressed copy of an object in memory.
+OBJECT_CHUNK_SIZE = 1024 * 1024
 
 def object_write(obj, repo=None):
     data = obj.serialise(repo)
 
     # header
-    result = obj.fmt + b' ' + str(len(data)).encode() + b'\x00' + data
+    header = obj.fmt + b' ' + str(len(data)).encode() + b'\x00'
 
-    # compute hash
-    sha = hashlib.sha1(result).hexdigest()
+    # compute hash, without building a copy of header + data
+    sha = hashlib.sha1(header)
+    sha.update(data)
+    sha = sha.hexdigest()
 
     if repo:
+        repo_object_info_cache(repo)[sha] = (obj.fmt, len(data))
+
         path = repo_file(repo, "objects", sha[:2], sha[2:], mkdir=True)
 
         if not os.path.exists(path):
-            with open(path, 'wb') as f:
-                f.write(zlib.compress(result))
+            view = memoryview(data)
+            chunks = (view[i:i + OBJECT_CHUNK_SIZE] for i in range(0, len(data), OBJECT_CHUNK_SIZE))
+            with object_tempfile(repo) as (f, tmp_path):
+                c = zlib.compressobj()
+                f.write(c.compress(header))
+                for chunk in chunks:
+                    f.write(c.compress(chunk))
+                f.write(c.flush())
+            os.replace(tmp_path, path)
+            loose_names_add(repo, sha)
+
+    return sha
+
+def object_write_stream(fmt, size, chunks, repo=None):
+    """Hash an object of type fmt whose size bytes of data come from
+    the chunks iterator, writing it to repo if provided.  The data is
+    hashed and compressed as it comes, into a temporary file renamed
+    in place at the end, so this works in constant memory."""
+
+    header = fmt + b' ' + str(size).encode() + b'\x00'
+    sha = hashlib.sha1(header)
+    total = 0
+
+    if not repo:
+        for chunk in chunks:
+            sha.update(chunk)
+            total += len(chunk)
+    else:
+        with object_tempfile(repo) as (f, tmp_path):
+            c = zlib.compressobj()
+            f.write(c.compress(header))
+            for chunk in chunks:
+                sha.update(chunk)
+                total += len(chunk)
+                f.write(c.compress(chunk))
+            f.write(c.flush())
+
+    if total != size:
+        if repo:
+            os.unlink(tmp_path)
+        raise Exception(f"Expected {size} bytes of object data, got {total}")
+
+    sha = sha.hexdigest()
+
+    if repo:
+        repo_object_info_cache(repo)[sha] = (fmt, size)
+        path = repo_file(repo, "objects", sha[:2], sha[2:], mkdir=True)
+
+        # We only learn the name of the object at the end, so we may
+        # have written an object we already had.
+        if os.path.exists(path):
+            os.unlink(tmp_path)
+        else:
+            os.replace(tmp_path, path)
+            loose_names_add(repo, sha)
 
     return sha
 
+@contextlib.contextmanager
+def object_tempfile(repo):
+    """Open a temporary file in the object store, yielding a pair (file,
+    path).  The file is removed if anything goes wrong while it's
+    open."""
+
+    fd, path = tempfile.mkstemp(prefix="tmp_obj_", dir=repo_dir(repo, "objects", mkdir=True))
+    try:
+        with os.fdopen(fd, "wb") as f:
+            yield f, path
+    except BaseException:
+        os.unlink(path)
+        raise
+
+def object_stream(repo, sha, chunk_size=65536):
+    """Open object sha for streaming, wherever it's stored.  Return a
+    triple (fmt, size, chunks) as object_loose_stream does, or None.
+    Deltas have to be resolved in memory, but other objects are never
+    held whole."""
+
+    stream = object_loose_stream(repo, sha, chunk_size)
+
+    if stream:
+        return stream
+
+    found = pack_locate(repo, sha)
+
+    if not found:
+        return None
+
+    pack, offset = found
+    type, size, pos = pack_entry_header(pack, offset)
+
+    if type in pack_type_fmt:
+        return pack_type_fmt[type], size, pack_inflate_stream(pack, pos, size, chunk_size)
+
+    fmt, data = pack_read_object(repo, pack, offset)
+    return fmt, len(data), iter([ data ])
+
+# Packfiles
+# =========
+#
+# A packfile stores many objects in a single file, each one
+# zlib-compressed independently and optionally stored as a delta
+# against another object.  Each .pack comes with a .idx, which maps
+# object names to offsets in the pack.  We memory-map both, so
+# looking an object up costs a binary search in the index and a
+# single inflate in the pack, without ever loading either file in
+# memory.
+
+# Object types, as stored in pack entry headers.  5 is reserved.
+PACK_OBJ_COMMIT    = 1
+PACK_OBJ_TREE      = 2
+PACK_OBJ_BLOB      = 3
+PACK_OBJ_TAG       = 4
+PACK_OBJ_OFS_DELTA = 6
+PACK_OBJ_REF_DELTA = 7
+
+pack_type_fmt = {
+    PACK_OBJ_COMMIT : b'commit',
+    PACK_OBJ_TREE   : b'tree',
+    PACK_OBJ_BLOB   : b'blob',
+    PACK_OBJ_TAG    : b'tag',
+}
+
+class LRUCache(object):
+    """A least-recently-used cache, bounded by the total size (in
+    bytes, usually) of its values rather than by their number."""
+
+    name = None
+    limit = None
+    size = 0
+    hits = 0
+    misses = 0
+
+    # Every cache ever created, so main() can report on them
+    instances = []
+
+    def __init__(self, name, limit):
+        self.name = name
+        self.limit = limit
+        self.entries = collections.OrderedDict()
+        # Caches are shared with worker threads.
+        self.lock = threading.Lock()
+        LRUCache.instances.append(self)
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, value, size):
+        # Don't flush the whole cache for a value that won't fit anyway
+        if size > self.limit:
+            return
+
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+
+            self.entries[key] = (value, size)
+            self.size += size
+
+            while self.size > self.limit:
+                _, (_, evicted) = self.entries.popitem(last=False)
+                self.size -= evicted
+
+def repo_delta_base_cache(repo):
+    """Return the repository's cache of delta bases, keyed by (pack
+    path, offset).  Its size is bounded by core.deltaBaseCacheLimit,
+    which defaults to 96MiB as in git."""
+
+    if repo.delta_base_cache is None:
+        limit = repo_config_int(repo, "core", "deltaBaseCacheLimit", 96 * 1024 ** 2)
+        repo.delta_base_cache = LRUCache("delta base cache", limit)
+
+    return repo.delta_base_cache
+
+class GitPack(object):
+    """A packfile and its version 2 index, both memory-mapped."""
+
+    path = None
+    idx = None
+    pack = None
+    count = None
+    fanout = None
+
+    def __init__(self, idx_path):
+        self.path = idx_path[:-len(".idx")] + ".pack"
+
+        with open(idx_path, "rb") as f:
+            self.idx = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        with open(self.path, "rb") as f:
+            self.pack = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        # Version 2 indexes begin with a magic number, then the
+        # version.  (Version 1 had no header at all, and begins
+        # directly with the fanout table.)
+        if self.idx[:4] != b'\xfftOc':
+            raise Exception(f"Unsupported pack index version 1 {idx_path}")
+        version = int.from_bytes(self.idx[4:8], "big")
+        if version != 2:
+            raise Exception(f"Unsupported pack index version {version} {idx_path}")
+
+        if self.pack[:4] != b'PACK':
+            raise Exception(f"Not a packfile {self.path}")
+
+        # The fanout table: entry N is the number of objects whose
+        # name begins with a byte lesser than or equal to N.  It
+        # bounds the binary search to objects that share the first
+        # byte of the name we look for.
+        self.fanout = struct.unpack_from(">256L", self.idx, 8)
+        self.count = self.fanout[255]
+
+        # Then come, for every object and in the same (sorted) order,
+        # the 20-byte names, the CRC32 of the packed data, and the
+        # 31-bit offsets in the pack.  Offsets with the MSB set are
+        # indices in a last table of 64-bit offsets, for packs larger
+        # than 2GiB.
+        self.names_start = 8 + 256 * 4
+        self.crc_start = self.names_start + 20 * self.count
+        self.offsets_start = self.crc_start + 4 * self.count
+        self.large_offsets_start = self.offsets_start + 4 * self.count
+
+def pack_name(pack, i):
+    """Return the binary name of the i-th object in the pack index"""
+    start = pack.names_start + 20 * i
+    return pack.idx[start:start + 20]
+
+def pack_offset(pack, i):
+    """Return the offset in the pack of the i-th object in the index"""
+    offset = struct.unpack_from(">L", pack.idx, pack.offsets_start + 4 * i)[0]
+    if offset & 0x80000000:
+        large = pack.large_offsets_start + 8 * (offset & 0x7fffffff)
+        offset = struct.unpack_from(">Q", pack.idx, large)[0]
+    return offset
+
+def pack_find(pack, binsha):
+    """Return the offset of object binsha in the pack, or None"""
+
+    first = binsha[0]
+    lo = pack.fanout[first - 1] if first else 0
+    hi = pack.fanout[first]
+
+    while lo < hi:
+        mid = (lo + hi) // 2
+        name = pack_name(pack, mid)
+        if name < binsha:
+            lo = mid + 1
+        elif name > binsha:
+            hi = mid
+        else:
+            return pack_offset(pack, mid)
+
+    return None
+
+def repo_packs(repo, refresh=False):
+    """Return the list of packs in repo.  Packs are opened once, and
+    cached on the repository object."""
+
+    if repo.packs is None or refresh:
+        packs = list()
+        path = repo_dir(repo, "objects", "pack")
+
+        if path:
+            for f in sorted(os.listdir(path)):
+                if f.endswith(".idx") and os.path.isfile(os.path.join(path, f[:-4] + ".pack")):
+                    packs.append(GitPack(os.path.join(path, f)))
+
+        repo.packs = packs
+
+    return repo.packs
+
+def pack_locate(repo, sha):
+    """Find object sha in the repository's packs.  Return a pair
+    (pack, offset), or None."""
+
+    binsha = bytes.fromhex(sha)
+
+    for pack in repo_packs(repo):
+        offset = pack_find(pack, binsha)
+        if offset is not None:
+            return pack, offset
+
+    # The object may be in a pack that was created after we listed
+    # them, so look again once before giving up.
+    for pack in repo_packs(repo, refresh=True):
+        offset = pack_find(pack, binsha)
+        if offset is not None:
+            return pack, offset
+
+    return None
+
+def pack_read_raw(repo, sha):
+    """Read object sha from the repository's packs.  Return a pair
+    (fmt, data), or None."""
+
+    found = pack_locate(repo, sha)
+
+    if not found:
+        return None
+
+    return pack_read_object(repo, *found)
+
+def pack_entry_header(pack, offset):
+    """Parse the header of the pack entry at offset.  Return a triple
+    (type, size, position of the entry data)."""
+
+    # The first byte holds the continuation bit, three bits of type
+    # and the four least significant bits of the inflated size.  Each
+    # following byte adds seven more bits of size.
+    buf = pack.pack
+    c = buf[offset]
+    type = (c >> 4) & 0x7
+    size = c & 0x0f
+    shift = 4
+
+    while c & 0x80:
+        offset += 1
+        c = buf[offset]
+        size |= (c & 0x7f) << shift
+        shift += 7
+
+    return type, size, offset + 1
+
+def pack_inflate(pack, pos, size):
+    """Inflate size bytes of zlib data from the pack, starting at pos."""
+
+    # We feed the decompressor from the mmap piece by piece: handing
+    # it the whole rest of the pack would make zlib copy all of it
+    # into unused_data.  Compressed data is rarely much larger than
+    # its inflated size, so the first piece is usually the only one.
+    buf = pack.pack
+    d = zlib.decompressobj()
+    ret = list()
+    chunk = size + 64
+
+    while not d.eof:
+        data = buf[pos:pos + chunk]
+        if not data:
+            raise Exception(f"Truncated packfile {pack.path}")
+        ret.append(d.decompress(data))
+        pos += len(data)
+        chunk = 65536
+
+    ret = b''.join(ret)
+
+    if len(ret) != size:
+        raise Exception(f"Malformed pack entry in {pack.path}: bad length")
+
+    return ret
+
+def pack_inflate_stream(pack, pos, size, chunk_size):
+    """Inflate the size bytes of zlib data at pos in the pack, yielding
+    them in chunks of at most chunk_size bytes."""
+
+    buf = pack.pack
+    d = zlib.decompressobj()
+    total = 0
+
+    while not d.eof:
+        data = d.unconsumed_tail
+        if not data:
+            data = buf[pos:pos + chunk_size]
+            if not data:
+                raise Exception(f"Truncated packfile {pack.path}")
+            pos += len(data)
+        data = d.decompress(data, chunk_size)
+        total += len(data)
+        if data:
+            yield data
+
+    if total != size:
+        raise Exception(f"Malformed pack entry in {pack.path}: bad length")
+
+def pack_delta_base(pack, type, offset, pos):
+    """Locate the base of a delta entry.  Return a triple (base pack
+    offset or None, base sha or None, position of the delta data)."""
+
+    buf = pack.pack
+
+    if type == PACK_OBJ_OFS_DELTA:
+        # The base is given as a negative offset from this entry.
+        pos, distance = varint_decode(buf, pos)
+        return offset - distance, None, pos
+    else:
+        # The base is given by name.  It's normally in the same pack,
+        # but nothing prevents it from living elsewhere.
+        binsha = buf[pos:pos + 20]
+        return pack_find(pack, binsha), binsha.hex(), pos + 20
+
+def varint_decode(buf, pos):
+    """Decode one of git's big-endian varints, where each continuation
+    adds one, so that there's only one way to encode every number.
+    Return a pair (position after the varint, value)."""
+
+    c = buf[pos]
+    value = c & 0x7f
+    while c & 0x80:
+        pos += 1
+        c = buf[pos]
+        value = ((value + 1) << 7) | (c & 0x7f)
+    return pos + 1, value
+
+def varint_encode(value):
+    """The reverse of varint_decode"""
+
+    ret = [ value & 0x7f ]
+    value >>= 7
+    while value:
+        value -= 1
+        ret.append(0x80 | (value & 0x7f))
+        value >>= 7
+    return bytes(reversed(ret))
+
+def pack_read_object(repo, pack, offset):
+    """Read the object at offset in pack, resolving deltas.  Return a
+    pair (fmt, data)."""
+
+    cache = repo_delta_base_cache(repo)
+
+    # Walk down the delta chain until we reach a full object, or one
+    # we've already resolved as the base of another delta,
+    # remembering the deltas on the way.  This is a loop rather than
+    # recursion, because chains can be very long.
+    deltas = list()
+    cached = False
+
+    while True:
+        if deltas:
+            base = cache.get((pack.path, offset))
+            if base:
+                fmt, data = base
+                cached = True
+                break
+
+        type, size, pos = pack_entry_header(pack, offset)
+
+        if type in pack_type_fmt:
+            fmt = pack_type_fmt[type]
+            data = pack_inflate(pack, pos, size)
+            break
+
+        if type not in (PACK_OBJ_OFS_DELTA, PACK_OBJ_REF_DELTA):
+            raise Exception(f"Unknown pack entry type {type} in {pack.path}")
+
+        base_offset, base_sha, pos = pack_delta_base(pack, type, offset, pos)
+        deltas.append((base_offset, pos, size))
+
+        if base_offset is None:
+            base = object_read_raw(repo, base_sha)
+            if not base:
+                raise Exception(f"Missing delta base {base_sha} in {pack.path}")
+            fmt, data = base
+            cached = True
+            break
+
+        offset = base_offset
+
+    # Then apply the deltas in reverse order, from the base up.  Every
+    # intermediate result is the base of the next delta, so it goes
+    # to the cache: sibling objects are very likely to share it.
+    for base_offset, pos, size in reversed(deltas):
+        if not cached:
+            cache.put((pack.path, base_offset), (fmt, data), len(data))
+        cached = False
+        data = delta_apply(data, pack_inflate(pack, pos, size))
+
+    return fmt, data
+
+def pack_inflate_head(pack, pos, size):
+    """Inflate at least size bytes of the zlib data at pos in the pack
+    (fewer if there isn't that much), and not much more."""
+
+    buf = pack.pack
+    d = zlib.decompressobj()
+    ret = b''
+
+    while len(ret) < size and not d.eof:
+        data = d.unconsumed_tail
+        if not data:
+            data = buf[pos:pos + 64]
+            if not data:
+                raise Exception(f"Truncated packfile {pack.path}")
+            pos += len(data)
+        ret += d.decompress(data, size - len(ret))
+
+    return ret
+
+def pack_object_info(repo, pack, offset):
+    """Return the type and size of the object at offset in pack as a
+    pair (fmt, size), without inflating it."""
+
+    type, size, pos = pack_entry_header(pack, offset)
+
+    if type in pack_type_fmt:
+        return pack_type_fmt[type], size
+
+    # A delta: its header gives the size of the result.  Both sizes
+    # it holds are varints of 10 bytes at most.
+    base_offset, base_sha, pos = pack_delta_base(pack, type, offset, pos)
+    head = pack_inflate_head(pack, pos, 20)
+    pos, _ = delta_varint(head, 0)
+    _, size = delta_varint(head, pos)
+
+    # Its type is the type of the base at the end of the chain.
+    while base_offset is not None:
+        type, _, pos = pack_entry_header(pack, base_offset)
+        if type in pack_type_fmt:
+            return pack_type_fmt[type], size
+        base_offset, base_sha, pos = pack_delta_base(pack, type, base_offset, pos)
+
+    return object_info(repo, base_sha)[0], size
+
+def delta_varint(delta, pos):
+    """Read a little-endian varint, as used in delta headers."""
+    ret = 0
+    shift = 0
+    while True:
+        c = delta[pos]
+        pos += 1
+        ret |= (c & 0x7f) << shift
+        shift += 7
+        if not c & 0x80:
+            return pos, ret
+
+def delta_apply(base, delta):
+    """Rebuild an object from its base and a delta"""
+
+    pos, base_size = delta_varint(delta, 0)
+    pos, result_size = delta_varint(delta, pos)
+
+    if base_size != len(base):
+        raise Exception("Delta base size mismatch")
+
+    ret = bytearray()
+    end = len(delta)
+
+    while pos < end:
+        op = delta[pos]
+        pos += 1
+
+        if op & 0x80:
+            # Copy from base.  The four low bits tell which bytes of
+            # the offset follow, the next three which bytes of the
+            # size do.  Missing bytes are zero.
+            copy_offset = 0
+            for i in range(4):
+                if op & (1 << i):
+                    copy_offset |= delta[pos] << (8 * i)
+                    pos += 1
+            copy_size = 0
+            for i in range(3):
+                if op & (1 << (4 + i)):
+                    copy_size |= delta[pos] << (8 * i)
+                    pos += 1
+            if copy_size == 0:
+                copy_size = 0x10000
+            ret += base[copy_offset:copy_offset + copy_size]
+        elif op:
+            # Insert the next op bytes of the delta
+            ret += delta[pos:pos + op]
+            pos += op
+        else:
+            raise Exception("Invalid delta opcode 0")
+
+    if len(ret) != result_size:
+        raise Exception("Delta result size mismatch")
+
+    return bytes(ret)
+
 class GitBlob(GitObject):
     fmt = b'blob'
 
@@ -237,20 +1015,43 @@ class GitBlob(GitObject):
     def deserialise(self, data):
         self.blobdata = data
 
+    def init(self):
+        self.blobdata = b''
+
 argsp = argsubparsers.add_parser("cat-file", help="Provide content of repository objects")
 
+argsp.add_argument("-t",
+                   metavar="object",
+                   dest="type_of",
+                   help="Show the type of object instead of its content")
+
+argsp.add_argument("-s",
+                   metavar="object",
+                   dest="size_of",
+                   help="Show the size of object instead of its content")
+
 argsp.add_argument("type",
                    metavar="type",
+                   nargs="?",
                    choices=["blob", "commit", "tag", "tree"],
                    help="Specify the type")
 
 argsp.add_argument("object",
                    metavar="object",
+                   nargs="?",
                    help="The object to display")
 
 def cmd_cat_file(args):
     repo = repo_find()
-    cat_file(repo, args.object, fmt=args.type.encode())
+
+    if args.type_of:
+        print(object_info(repo, object_find(repo, args.type_of))[0].decode("ascii"))
+    elif args.size_of:
+        print(object_info(repo, object_find(repo, args.size_of))[1])
+    elif args.type and args.object:
+        cat_file(repo, args.object, fmt=args.type.encode())
+    else:
+        raise Exception("cat-file needs a type and an object, or one of -t and -s")
 
 def cat_file(repo, obj, fmt=None):
     obj = object_read(repo, object_find(repo, obj, fmt=fmt))
@@ -271,23 +1072,29 @@ def object_find(repo, name, fmt=None, follow=True):
         return sha
     
     while True:
-        obj = object_read(repo, sha)
-        #     ^^^^^^^^^^^ < this is a bit agressive: we're reading
-        # the full object just to get its type.  And we're doing
-        # that in a loop, albeit normally short.  Don't expect
-        # high performance here.
+        # We only need the type here, which object_info may know
+        # without reading the object.
+        info = object_info(repo, sha)
+
+        if not info:
+            raise Exception(f"Missing object {sha}")
 
-        if obj.fmt == fmt:
+        if info[0] == fmt:
             return sha
         
         if not follow:
             return None
-        
+
+        if info[0] not in (b'tag', b'commit'):
+            return None
+
+        obj = object_read(repo, sha)
+
         # follow tags
         if obj.fmt == b'tag':
-            sha = obj.kvlm[b'object'].decode('ascii')
+            sha = kvlm_sha_headers(obj, b'object')[0]
         elif obj.fmt == b'commit' and fmt == b'tree':
-            sha = obj.kvlm[b'tree'].decode('ascii')
+            sha = kvlm_sha_headers(obj, b'tree')[0]
         else:
             return None
         
@@ -297,6 +1104,7 @@ argsp.add_argument("-t",
                    metavar="type",
                    dest="type",
                    choices=["blob", "commit", "tag", "tree"],
+                   default="blob",
                    help="Specify the type")
 
 argsp.add_argument("-w",
@@ -320,6 +1128,14 @@ def cmd_hash_object(args):
 def object_hash(fd, fmt, repo=None):
     """Hash object, writing it to repo if provided"""
 
+    # Blobs need no parsing, so we stream them from regular files:
+    # they may be much larger than memory.
+    if fmt == b'blob':
+        st = os.fstat(fd.fileno())
+        if stat.S_ISREG(st.st_mode):
+            chunks = iter(lambda: fd.read(OBJECT_CHUNK_SIZE), b'')
+            return object_write_stream(fmt, st.st_size, chunks, repo)
+
     data = fd.read()
 
     match fmt:
@@ -337,50 +1153,132 @@ def kvlm_parse(raw, start=0, dct=None):
     if not dct:
         dct = collections.OrderedDict()
 
-    space = raw.find(b' ', start)
-    newline = raw.find(b'\n', start)
-
-    # If space appears before newline, we have a keyword.  Otherwise,
-    # it's the final message, which we just read to the end of the file.
-
-    # Base case
-    # =========
-    # If newline appears first (or there's no space at all, in which
-    # case find returns -1), we assume a blank line.  A blank line
-    # means the remainder of the data is the message.  We store it in
-    # the dictionary, with None as the key, and return.
-    if space < 0 or newline < space:
-        assert newline == start
-        dct[None] = raw[start + 1:]
-        return dct
-    
-    # Recursive case
-    # ==============
-    # we read a key-value pair and recurse for the next.
-    key = raw[start:space]
-
-    # Find the end of the value.  Continuation lines begin with a
-    # space, so we loop until we find a "\n" not followed by a space.
-    end = start
     while True:
-        end = raw.find(b'\n', end + 1)
-        if raw[end + 1] != ord(' '): 
-            break
-    
-    # Grab the value
-    # Also, drop the leading space on continuation lines
-    value = raw[space + 1: end].replace(b'\n ', b'\n')
-
-    if key in dct:
-        if type(dct[key]) == list:
-            dct[key].append(value)
+        space = raw.find(b' ', start)
+        newline = raw.find(b'\n', start)
+
+        # If space appears before newline, we have a keyword.
+        # Otherwise, it's the final message, which we just read to the
+        # end of the file.
+
+        # If newline appears first (or there's no space at all, in
+        # which case find returns -1), we assume a blank line.  A
+        # blank line means the remainder of the data is the message.
+        # We store it in the dictionary, with None as the key, and
+        # return.
+        if space < 0 or newline < space:
+            assert newline == start
+            dct[None] = raw[start + 1:]
+            return dct
+
+        # Otherwise, we read a key-value pair, and loop for the next.
+        key = raw[start:space]
+
+        # Find the end of the value.  Continuation lines begin with a
+        # space, so we loop until we find a "\n" not followed by a
+        # space.
+        end = newline
+        while raw[end + 1] == ord(' '):
+            end = raw.find(b'\n', end + 1)
+
+        # Grab the value
+        # Also, drop the leading space on continuation lines
+        value = raw[space + 1: end]
+        if end != newline:
+            value = value.replace(b'\n ', b'\n')
+
+        if key in dct:
+            if type(dct[key]) == list:
+                dct[key].append(value)
+            else:
+                dct[key] = [dct[key], value]
         else:
-            dct[key] = [dct[key], value]
+            dct[key] = value
+
+        start = end + 1
+
+def kvlm_sha_headers(obj, key):
+    """Return the list of SHAs in the key headers of obj, a commit or
+    a tag: tree, parent or object.
+
+    git writes these first, tree then parents in commits and object in
+    tags, on lines of a fixed length, and stops looking for them at
+    the first other line.  So do we: this reads them straight from the
+    raw object, without parsing the rest.  Objects parsed already, or
+    laid out any other way, go through kvlm instead."""
+
+    raw = obj.raw
+    if raw is None:
+        return kvlm_sha_headers_parsed(obj, key)
+
+    if key == b'parent' and raw.startswith(b'tree ') and raw[45:46] == b'\n':
+        # Parents follow the tree
+        pos = 46
+        ret = list()
+        while raw.startswith(b'parent ', pos):
+            if raw[pos + 47:pos + 48] != b'\n':
+                return kvlm_sha_headers_parsed(obj, key)
+            ret.append(raw[pos + 7:pos + 47].decode("ascii"))
+            pos += 48
+        return ret
+
+    end = len(key) + 41
+    if key != b'parent' and raw.startswith(key + b' ') and raw[end:end + 1] == b'\n':
+        return [ raw[len(key) + 1:end].decode("ascii") ]
+
+    # Commits always have a tree, and tags an object.  If it's not on
+    # the first line, this object is unusual: parse it whole.
+    return kvlm_sha_headers_parsed(obj, key)
+
+def kvlm_sha_headers_parsed(obj, key):
+    values = obj.kvlm.get(key, [])
+    if type(values) != list:
+        values = [ values ]
+    return [ value.decode("ascii") for value in values ]
+
+def kvlm_header(obj, key):
+    """Return the value of the first key header of obj, a commit or a
+    tag, or None.  Only that header is parsed, unless obj is parsed
+    already."""
+
+    raw = obj.raw
+    if raw is None:
+        value = obj.kvlm.get(key)
+        return value[0] if type(value) == list else value
+
+    prefix = key + b' '
+    if raw.startswith(prefix):
+        pos = 0
     else:
-        dct[key] = value
+        pos = raw.find(b'\n' + prefix) + 1
+        # Headers can't hold an empty line, since continuation lines
+        # begin with a space: the first one ends them, and what
+        # follows is the message.
+        if not pos or raw.startswith(b'\n') or raw.find(b'\n\n', 0, pos) >= 0:
+            return None
+
+    start = pos + len(prefix)
+    stop = raw.find(b'\n', start)
+    while raw[stop + 1:stop + 2] == b' ':
+        stop = raw.find(b'\n', stop + 1)
+
+    return raw[start:stop].replace(b'\n ', b'\n')
+
+def kvlm_message(obj):
+    """Return the message of obj, a commit or a tag, without parsing
+    its headers."""
+
+    raw = obj.raw
+    if raw is None:
+        return obj.kvlm[None]
+
+    if raw.startswith(b'\n'):
+        return raw[1:]
+
+    # The first empty line ends the headers, as above.
+    end = raw.find(b'\n\n')
+    return raw[end + 2:] if end >= 0 else obj.kvlm[None]
 
-    return kvlm_parse(raw, start=end + 1, dct=dct)
-    
 def kvlm_serialise(kvlm):
     ret = b''
 
@@ -401,8 +1299,14 @@ def kvlm_serialise(kvlm):
 class GitCommit(GitObject):
     fmt = b'commit'
 
+    # The object as read.  Most readers of commits only want the tree
+    # and parents, which kvlm_sha_headers finds there, so the whole
+    # object is only parsed to kvlm on demand.
+    raw = None
+    _kvlm = None
+
     def deserialise(self, data):
-        self.kvlm = kvlm_parse(data)
+        self.raw = data
 
     def serialise(self, repo=None):
         return kvlm_serialise(self.kvlm)
@@ -410,8 +1314,35 @@ class GitCommit(GitObject):
     def init(self):
         self.kvlm = dict()
 
+    @property
+    def kvlm(self):
+        if self._kvlm is None:
+            self._kvlm = kvlm_parse(self.raw)
+            # From now on, kvlm is the truth.
+            self.raw = None
+        return self._kvlm
+
+    @kvlm.setter
+    def kvlm(self, kvlm):
+        self._kvlm = kvlm
+        self.raw = None
+
 argsp = argsubparsers.add_parser("log", help="Display history of a given commit")
 
+argsp.add_argument("-n", "--max-count",
+                   metavar="n",
+                   type=int,
+                   default=None,
+                   help="Show at most n commits")
+
+argsp.add_argument("--topo-order",
+                   action="store_true",
+                   help="Show no parent before all of its children, instead of ordering by commit date")
+
+argsp.add_argument("--oneline",
+                   action="store_true",
+                   help="Print one line per commit, instead of a Graphviz graph")
+
 argsp.add_argument("commit",
                    default="HEAD",
                    nargs="?",
@@ -420,42 +1351,450 @@ argsp.add_argument("commit",
 def cmd_log(args):
     repo = repo_find()
 
+    commits = log_walk(repo, [ object_find(repo, args.commit, b'commit') ], topo=args.topo_order)
+    commits = itertools.islice(commits, args.max_count)
+
+    try:
+        if args.oneline:
+            for sha in commits:
+                print(log_oneline(repo, sha))
+        else:
+            log_graphviz(repo, commits)
+    except BrokenPipeError:
+        # Our reader, say head, has seen enough.  Point stdout to
+        # /dev/null, so that Python doesn't fail again flushing it.
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+
+def log_walk(repo, roots, topo=False):
+    """Yield the SHAs of the commits reachable from roots, newest
+    first: by commit date, or in topological order if topo is true.
+    By date, commits come as they're found, so that callers can stop
+    early without walking the whole history.  In topological order,
+    no commit comes before all of its children, so the walk must see
+    every commit first (this is quick with a commit graph)."""
+
+    if topo:
+        yield from log_walk_topo(repo, roots)
+        return
+
+    # A heap of (-date, n, sha, parent nodes), n keeping commits with
+    # the same date in the order they were found, as git does.
+    heap = list()
+    seen = set()
+    counter = itertools.count()
+
+    def push(node):
+        if node not in seen:
+            seen.add(node)
+            sha, parents, date = commit_node_info(repo, node)
+            heapq.heappush(heap, (-date, next(counter), sha, parents))
+
+    for sha in roots:
+        push(commit_node(repo, sha))
+
+    while heap:
+        _, _, sha, parents = heapq.heappop(heap)
+        yield sha
+        for parent in parents:
+            push(parent)
+
+def log_walk_topo(repo, roots):
+    """Yield the commits reachable from roots in topological order:
+    count the children of every commit, then walk from the commits
+    without children, and get to a parent when its last child has
+    been shown.  The ready commits are a stack, so that a line of
+    history is shown whole before the next.  As in git, the last
+    parent's line comes first."""
+
+    roots = list(dict.fromkeys(commit_node(repo, sha) for sha in roots))
+    children = collections.Counter()
+    parents_of = dict()
+
+    stack = list(roots)
+    while stack:
+        node = stack.pop()
+        if node in parents_of:
+            continue
+        _, parents, _ = commit_node_info(repo, node)
+        parents_of[node] = parents
+        for parent in parents:
+            children[parent] += 1
+            stack.append(parent)
+
+    graph = repo_commit_graph(repo)
+    ready = [ node for node in reversed(roots) if not children[node] ]
+    while ready:
+        node = ready.pop()
+        yield commit_graph_name(graph, node).hex() if type(node) == int else node
+
+        for parent in parents_of.pop(node):
+            children[parent] -= 1
+            if not children[parent]:
+                ready.append(parent)
+
+def log_message_summary(commit):
+    """Return the first line of the message of commit"""
+    return kvlm_message(commit).decode("utf8").strip().split("\n", 1)[0]
+
+def log_oneline(repo, sha):
+    return f"{object_abbrev(repo, sha)} {log_message_summary(object_read(repo, sha))}"
+
+def log_graphviz(repo, commits):
+    """Print the history of commits, an iterable of SHAs, as a Graphviz
+    graph.  Each node is printed as soon as its commit comes."""
+
     print("digraph wyaglog{")
     print("  node[shape=rect]")
-    log_graphviz(repo, object_find(repo, args.commit), set())
+
+    for sha in commits:
+        commit = object_read(repo, sha)
+        assert commit.fmt == b'commit'
+
+        short_hash = sha[0:8]
+        message = log_message_summary(commit)
+        message = message.replace("\\", "\\\\")
+        message = message.replace("\"", "\\\"")
+
+        print(f"  c_{sha} [label=\"{short_hash}: {message}\"]")
+
+        for parent in commit_parents(repo, sha):
+            print(f"  c_{sha} -> c_{parent};")
+
     print("}")
 
-def log_graphviz(repo, sha, seen):
-    if sha in seen:
-        return
-    
-    seen.add(sha)
+# Commit graph
+# ============
+#
+# Walking history means reading every commit, only to learn its
+# parents.  git's commit-graph file, .git/objects/info/commit-graph,
+# holds that for every commit, in fixed-size records, along with the
+# root tree, the commit date and a generation number.
+#
+# The file is a header and a table of contents, followed by chunks:
+#
+#  - OIDF, the fanout table of OIDL, as in pack indexes;
+#  - OIDL, the sorted binary names of the commits;
+#  - CDAT, for each commit, the root tree's name, the positions of its
+#    first two parents in OIDL, and the generation number and commit
+#    date packed in 8 bytes;
+#  - EDGE, the remaining parents of octopus merges, if any.
+#
+# Parents are positions in the file itself, so a walk doesn't even
+# need to look names up: it goes from record to record.
+
+COMMIT_GRAPH_PARENT_NONE = 0x70000000
+COMMIT_GRAPH_EXTRA_EDGES = 0x80000000
+COMMIT_GRAPH_LAST_EDGE = 0x80000000
+COMMIT_GRAPH_GENERATION_MAX = 0x3fffffff
+COMMIT_GRAPH_CDAT = struct.Struct(">20sLLLL")
+COMMIT_GRAPH_PARENTS = struct.Struct(">LL")
+
+class GitCommitGraph(object):
+    """A memory-mapped commit-graph file."""
+
+    path = None
+    data = None
+    count = None
+    fanout = None
+    # Offsets of the chunks we use, by id
+    chunks = None
+
+    def __init__(self, path):
+        self.path = path
+
+        with open(path, "rb") as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        # The header: signature, version, hash version (1 for SHA-1),
+        # number of chunks, and number of base graphs.
+        signature, version, hash_version, chunk_count, _ = struct.unpack_from(">4sBBBB", self.data, 0)
+        if signature != b'CGPH':
+            raise Exception(f"Not a commit-graph file {path}")
+        if version != 1 or hash_version != 1:
+            raise Exception(f"Unsupported commit-graph version {version}, hash version {hash_version} {path}")
+
+        # The table of contents: (id, offset) pairs, and a last one
+        # with a zero id that marks where the last chunk ends.
+        self.chunks = dict()
+        for i in range(chunk_count):
+            id, offset = struct.unpack_from(">4sQ", self.data, 8 + 12 * i)
+            self.chunks[id] = offset
+
+        for id in (b'OIDF', b'OIDL', b'CDAT'):
+            if id not in self.chunks:
+                raise Exception(f"Missing chunk {id.decode()} in commit-graph {path}")
+
+        self.fanout = struct.unpack_from(">256L", self.data, self.chunks[b'OIDF'])
+        self.count = self.fanout[255]
+
+def repo_commit_graph(repo):
+    """Return the repository's commit graph, or None.  It's opened
+    once, and cached on the repository object."""
+
+    if repo.commit_graph is None:
+        path = repo_path(repo, "objects", "info", "commit-graph")
+        if repo_config_bool(repo, "core", "commitGraph", True) and os.path.isfile(path):
+            repo.commit_graph = GitCommitGraph(path)
+        else:
+            repo.commit_graph = False
+
+    return repo.commit_graph or None
+
+def commit_graph_name(graph, pos):
+    """Return the binary name of the commit at pos"""
+    start = graph.chunks[b'OIDL'] + 20 * pos
+    return graph.data[start:start + 20]
+
+def commit_graph_find(graph, sha):
+    """Return the position of commit sha in the graph, or None"""
+
+    binsha = bytes.fromhex(sha)
+    first = binsha[0]
+    lo = graph.fanout[first - 1] if first else 0
+    hi = graph.fanout[first]
+
+    pos = object_names_bisect(functools.partial(commit_graph_name, graph), lo, hi, binsha)
+    if pos < hi and commit_graph_name(graph, pos) == binsha:
+        return pos
+
+    return None
+
+def commit_graph_record(graph, pos):
+    """Return the commit at pos as a tuple (binary tree name, parent
+    positions, generation number, commit date)."""
+
+    tree, parent1, parent2, high, low = COMMIT_GRAPH_CDAT.unpack_from(graph.data, graph.chunks[b'CDAT'] + 36 * pos)
+
+    if parent1 == COMMIT_GRAPH_PARENT_NONE:
+        parents = []
+    elif parent2 == COMMIT_GRAPH_PARENT_NONE:
+        parents = [ parent1 ]
+    elif not parent2 & COMMIT_GRAPH_EXTRA_EDGES:
+        parents = [ parent1, parent2 ]
+    else:
+        # Octopus merge: the other parents are in EDGE, from the
+        # position in parent2 to the one with the high bit set.
+        parents = [ parent1 ]
+        edge = graph.chunks[b'EDGE'] + 4 * (parent2 & ~COMMIT_GRAPH_EXTRA_EDGES)
+        while True:
+            parent = struct.unpack_from(">L", graph.data, edge)[0]
+            parents.append(parent & ~COMMIT_GRAPH_LAST_EDGE)
+            if parent & COMMIT_GRAPH_LAST_EDGE:
+                break
+            edge += 4
+
+    return tree, parents, high >> 2, ((high & 0x3) << 32) | low
+
+def commit_parents(repo, sha):
+    """Return the SHAs of the parents of commit sha, from the commit
+    graph if it has it, or else from the commit object."""
+
+    graph = repo_commit_graph(repo)
+    pos = commit_graph_find(graph, sha) if graph else None
+
+    if pos is not None:
+        return [ commit_graph_name(graph, parent).hex() for parent in commit_graph_record(graph, pos)[1] ]
 
     commit = object_read(repo, sha)
-    short_hash = sha[0:8]
-    message = commit.kvlm[None].decode("utf8").strip()
-    message = message.replace("\\", "\\\\")
-    message = message.replace("\"", "\\\"")
+    if not commit or commit.fmt != b'commit':
+        raise Exception(f"Not a commit {sha}")
 
-    # Keep only the first line
-    if "\n" in message:
-        message = message[:message.index("\n")]
+    return kvlm_sha_headers(commit, b'parent')
 
-    print(f"  c_{sha} [label=\"{short_hash}: {message}\"]")
-    assert commit.fmt == b'commit'
+def commit_date(commit):
+    """Return the commit date of commit, in seconds since the epoch.
+    The committer line ends with the timestamp and the timezone."""
+    return int(kvlm_header(commit, b'committer').split(b' ')[-2])
 
-    if not b'parent' in commit.kvlm.keys():
-        return
-    
-    parents = commit.kvlm[b'parent']
+def commit_node(repo, sha):
+    """Return how history walks refer to commit sha: its position in
+    the commit graph if it's there, or else its SHA."""
+
+    graph = repo_commit_graph(repo)
+    pos = commit_graph_find(graph, sha) if graph else None
+
+    return sha if pos is None else pos
+
+def commit_node_info(repo, node):
+    """Return a triple (SHA, parent nodes, commit date) for the commit
+    that node refers to."""
+
+    if type(node) == int:
+        graph = repo_commit_graph(repo)
+        _, parents, _, date = commit_graph_record(graph, node)
+        return commit_graph_name(graph, node).hex(), parents, date
+
+    commit = object_read(repo, node)
+    if not commit or commit.fmt != b'commit':
+        raise Exception(f"Not a commit {node}")
+
+    return node, [ commit_node(repo, parent) for parent in commit_parents(repo, node) ], commit_date(commit)
 
-    if type(parents) != list:
-        parents = [parents]
+def commits_reachable(repo, roots):
+    """Yield the SHA of every commit reachable from roots, once,
+    depth-first.  Commits in the commit graph are walked by position,
+    without looking their names up or reading them."""
 
-    for parent in parents:
-        parent = parent.decode("ascii")
-        print(f"  c_{sha} -> c_{parent};")
-        log_graphviz(repo, parent, seen)
+    graph = repo_commit_graph(repo)
+
+    seen = set()
+    stack = [ commit_node(repo, sha) for sha in reversed(roots) if sha ]
+    # Where the parents are, in the first commit's record
+    cdat = graph.chunks[b'CDAT'] + 20 if graph else None
+
+    while stack:
+        commit = stack.pop()
+
+        if commit in seen:
+            continue
+        seen.add(commit)
+
+        if type(commit) == int:
+            yield commit_graph_name(graph, commit).hex()
+            parent1, parent2 = COMMIT_GRAPH_PARENTS.unpack_from(graph.data, cdat + 36 * commit)
+            if parent2 == COMMIT_GRAPH_PARENT_NONE:
+                # Most commits have a single parent, or none
+                if parent1 != COMMIT_GRAPH_PARENT_NONE and parent1 not in seen:
+                    stack.append(parent1)
+                continue
+            parents = commit_graph_record(graph, commit)[1]
+        else:
+            yield commit
+            parents = [ commit_node(repo, parent) for parent in commit_parents(repo, commit) ]
+
+        # The first parent goes on top of the stack, to be walked first
+        stack.extend(reversed(parents))
+
+argsp = argsubparsers.add_parser("commit-graph", help="Write a commit-graph file, to speed up history walks")
+argsp.add_argument("action",
+                   choices=["write"],
+                   help="Write the graph of the commits reachable from any ref")
+
+def cmd_commit_graph(args):
+    repo = repo_find()
+
+    match args.action:
+        case "write":
+            commit_graph_write(repo)
+
+def commit_graph_write(repo, roots=None):
+    """Write the commit graph of every commit reachable from roots, by
+    default every ref and HEAD.  Return its path, or None if there are
+    no commits."""
+
+    if roots is None:
+        roots = list(ref_list(repo).values()) + [ ref_resolve(repo, "HEAD") ]
+
+    # Peel tags, and skip refs to trees or blobs
+    heads = list()
+    for sha in roots:
+        sha = object_peel(repo, sha)
+        info = object_info(repo, sha) if sha else None
+        if info and info[0] == b'commit':
+            heads.append(sha)
+
+    commits = dict()
+    for sha in commits_reachable(repo, heads):
+        commit = object_read(repo, sha)
+        commits[sha] = (kvlm_sha_headers(commit, b'tree')[0], kvlm_sha_headers(commit, b'parent'), commit_date(commit))
+
+    if not commits:
+        return None
+
+    names = sorted(commits)
+    positions = { sha: pos for pos, sha in enumerate(names) }
+
+    # Generation numbers: 1 for root commits, and one more than the
+    # largest of their parents' for the others.  The walk is
+    # iterative, for the sake of long histories.
+    generations = dict()
+    for sha in names:
+        stack = [ sha ]
+        while stack:
+            top = stack[-1]
+            if top in generations:
+                stack.pop()
+                continue
+            pending = [ p for p in commits[top][1] if p not in generations ]
+            if pending:
+                stack.extend(pending)
+            else:
+                generations[top] = 1 + max((generations[p] for p in commits[top][1]), default=0)
+                stack.pop()
+
+    fanout = [0] * 256
+    for sha in names:
+        fanout[int(sha[:2], 16)] += 1
+    total = 0
+    for i in range(256):
+        total += fanout[i]
+        fanout[i] = total
+
+    oidl = bytearray()
+    cdat = bytearray()
+    edge = bytearray()
+    for sha in names:
+        tree, parents, date = commits[sha]
+        parents = [ positions[p] for p in parents ]
+
+        parent1 = parents[0] if parents else COMMIT_GRAPH_PARENT_NONE
+        if len(parents) < 2:
+            parent2 = COMMIT_GRAPH_PARENT_NONE
+        elif len(parents) == 2:
+            parent2 = parents[1]
+        else:
+            parent2 = COMMIT_GRAPH_EXTRA_EDGES | (len(edge) // 4)
+            for parent in parents[1:-1]:
+                edge += struct.pack(">L", parent)
+            edge += struct.pack(">L", COMMIT_GRAPH_LAST_EDGE | parents[-1])
+
+        generation = min(generations[sha], COMMIT_GRAPH_GENERATION_MAX)
+        oidl += bytes.fromhex(sha)
+        cdat += COMMIT_GRAPH_CDAT.pack(bytes.fromhex(tree), parent1, parent2,
+                                       (generation << 2) | ((date >> 32) & 0x3), date & 0xffffffff)
+
+    chunks = [ (b'OIDF', struct.pack(">256L", *fanout)), (b'OIDL', oidl), (b'CDAT', cdat) ]
+    if edge:
+        chunks.append((b'EDGE', edge))
+
+    data = bytearray(struct.pack(">4sBBBB", b'CGPH', 1, 1, len(chunks), 0))
+    offset = len(data) + 12 * (len(chunks) + 1)
+    for id, chunk in chunks:
+        data += struct.pack(">4sQ", id, offset)
+        offset += len(chunk)
+    data += struct.pack(">4sQ", b'\0\0\0\0', offset)
+    for _, chunk in chunks:
+        data += chunk
+    data += hashlib.sha1(data).digest()
+
+    path = repo_file(repo, "objects", "info", "commit-graph", mkdir=True)
+    with open(path + ".lock", "wb") as f:
+        f.write(data)
+    os.replace(path + ".lock", path)
+
+    # Don't keep using the graph we just replaced
+    repo.commit_graph = None
+
+    return path
+
+argsp = argsubparsers.add_parser("rev-list", help="List the commits reachable from a commit")
+argsp.add_argument("--count",
+                   action="store_true",
+                   help="Print the number of commits instead")
+argsp.add_argument("commit",
+                   default="HEAD",
+                   nargs="?",
+                   help="Commit to start at")
+
+def cmd_rev_list(args):
+    repo = repo_find()
+    commits = commits_reachable(repo, [ object_find(repo, args.commit, b'commit') ])
+
+    if args.count:
+        print(sum(1 for _ in commits))
+    else:
+        for sha in commits:
+            print(sha)
 
 class GitTreeLeaf(object):
     def __init__(self, mode, path, sha):
@@ -472,7 +1811,7 @@ def tree_parse_one(raw, start=0):
     mode = raw[start:x]
     if len(mode) == 5:
         # normalise to 6 bytes
-        mode = b' ' + mode
+        mode = b'0' + mode
 
     # find null terminator of the path
     y = raw.find(b'\x00', x)
@@ -480,7 +1819,7 @@ def tree_parse_one(raw, start=0):
     path = raw[x + 1:y]
 
     # read the SHA and convert to a hex string
-    sha = format(int.from_bytes(raw[y + 1:y + 21], "big"), "040x")
+    sha = raw[y + 1:y + 21].hex()
     
     return y + 21, GitTreeLeaf(mode, path.decode("utf8"), sha)
  
@@ -510,7 +1849,9 @@ def tree_serialise(obj):
     obj.items.sort(key=tree_leaf_sort_key)
     ret = b''
     for item in obj.items:
-        ret += item.mode
+        # Modes are normalised to six bytes when parsed, but git
+        # stores them without leading zeros ("40000" for trees)
+        ret += item.mode.lstrip(b'0')
         ret += b' '
         ret += item.path.encode("utf8")
         ret += b'\x00'
@@ -524,8 +1865,16 @@ def tree_serialise(obj):
 class GitTree(GitObject):
     fmt = b'tree'
 
+    # The object as read, and the offsets of its entries in it, found
+    # on the first lookup.  tree_entries and tree_lookup work on it
+    # directly: entries are only decoded to GitTreeLeaf objects, in
+    # items, for callers that ask for them.
+    raw = None
+    offsets = None
+    _items = None
+
     def deserialise(self, data):
-        self.items = tree_parse(data)
+        self.raw = data
 
     def serialise(self, repo=None):
         return tree_serialise(self)
@@ -533,9 +1882,126 @@ class GitTree(GitObject):
     def init(self):
         self.items = list()
 
-argsp = argsubparsers.add_parser("ls-tree", help="Pretty-print a tree object")
+    @property
+    def items(self):
+        if self._items is None:
+            self._items = tree_parse(self.raw)
+            # From now on, items are the truth.
+            self.raw = None
+            self.offsets = None
+        return self._items
+
+    @items.setter
+    def items(self, items):
+        self._items = items
+        self.raw = None
+        self.offsets = None
+
+def tree_entries(tree):
+    """Yield the entries of tree as triples (mode, name, binary SHA),
+    without decoding anything.  Modes are normalised to six bytes, as
+    in GitTreeLeaf, and SHAs are slices of a memoryview of the object,
+    which compare equal to bytes and have a hex() method."""
+
+    if tree.raw is None:
+        for leaf in tree.items:
+            yield leaf.mode, leaf.path.encode("utf8"), bytes.fromhex(leaf.sha)
+        return
 
-argsp.add_argument("-r",
+    raw = tree.raw
+    view = memoryview(raw)
+    pos = 0
+    end = len(raw)
+
+    while pos < end:
+        space = raw.find(b' ', pos)
+        nul = raw.find(b'\x00', space)
+        mode = raw[pos:space]
+        if len(mode) == 5:
+            mode = b'0' + mode
+        yield mode, raw[space + 1:nul], view[nul + 1:nul + 21]
+        pos = nul + 21
+
+def tree_offsets(tree):
+    """Return the offsets of the entries of tree in its raw object.
+    They're found once, and kept on the tree."""
+
+    if tree.offsets is None:
+        raw = tree.raw
+        offsets = array.array("L")
+        pos = 0
+        end = len(raw)
+        while pos < end:
+            offsets.append(pos)
+            pos = raw.find(b'\x00', pos) + 21
+        tree.offsets = offsets
+
+    return tree.offsets
+
+def tree_entry_key(raw, pos):
+    """Return the sort key of the entry at pos in raw: its name, with
+    a / after the names of subtrees, as tree_leaf_sort_key does."""
+
+    space = raw.find(b' ', pos)
+    name = raw[space + 1:raw.find(b'\x00', space)]
+    return name + b'/' if raw[pos:space].lstrip(b'0') == b'40000' else name
+
+def tree_lookup(tree, name):
+    """Find the entry called name, in bytes, in tree.  Return a pair
+    (mode, binary SHA) as tree_entries would, or None.  Entries are
+    sorted in git's order, names of subtrees sorting as if they ended
+    with a /, so we bisect for both a file and a directory."""
+
+    if tree.raw is None:
+        for mode, entry_name, sha in tree_entries(tree):
+            if entry_name == name:
+                return mode, sha
+        return None
+
+    raw = tree.raw
+    offsets = tree_offsets(tree)
+
+    for key in (name, name + b'/'):
+        lo, hi = 0, len(offsets)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if tree_entry_key(raw, offsets[mid]) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        if lo < len(offsets) and tree_entry_key(raw, offsets[lo]) == key:
+            pos = offsets[lo]
+            space = raw.find(b' ', pos)
+            nul = raw.find(b'\x00', space)
+            mode = raw[pos:space]
+            if len(mode) == 5:
+                mode = b'0' + mode
+            return mode, memoryview(raw)[nul + 1:nul + 21]
+
+    return None
+
+def tree_lookup_path(repo, sha, path):
+    """Follow path, a /-separated str, from tree sha.  Return a pair
+    (mode, SHA) for what it names, or None.  Only the trees on the way
+    are read, and each is bisected rather than scanned."""
+
+    mode = b'040000'
+    for name in path.split("/"):
+        if not name:
+            continue
+        if mode != b'040000':
+            return None
+        found = tree_lookup(object_read(repo, sha), name.encode("utf8"))
+        if not found:
+            return None
+        mode, sha = found[0], found[1].hex()
+
+    return mode, sha
+
+argsp = argsubparsers.add_parser("ls-tree", help="Pretty-print a tree object")
+
+argsp.add_argument("-r",
                    dest="recursive",
                    action="store_true",
                    help="Recurse into sub-trees")
@@ -550,28 +2016,20 @@ def ls_tree(repo, ref, recursive=None, prefix=""):
     sha = object_find(repo, ref, fmt=b'tree')
     obj = object_read(repo, sha)
     
-    for item in obj.items:
-        if len(item.mode) == 5:
-            type = item.mode[0:1]
-        else:
-            type = item.mode[0:2]
-
-        match type:
+    for mode, name, sha in tree_entries(obj):
+        match mode[0:2]:
             case b'04': type = "tree"
             case b'10': type = "blob" # regular file
             case b'12': type = "blob" # symlink
             case b'16': type = "commit" # submodule
-            case _: raise Exception(f"Unknown tree leaf mode {item.mode}")
+            case _: raise Exception(f"Unknown tree leaf mode {mode}")
+
+        path = os.path.join(prefix, name.decode("utf8"))
 
         if not (recursive and type == "tree"):
-            print("{0} {1} {2}\t{3}".format(
-                "0" * (6 - len(item.mode)) + item.mode.decode("ascii"),
-                type,
-                item.sha,
-                os.path.join(prefix, item.path)
-            ))
+            print("{0} {1} {2}\t{3}".format(mode.decode("ascii"), type, sha.hex(), path))
         else:
-            ls_tree(repo, item.sha, recursive, os.path.join(prefix, item.path))
+            ls_tree(repo, sha.hex(), recursive, path)
 
 argsp = argsubparsers.add_parser("checkout", help="Checkout a commit inside of a directory")
 
@@ -581,13 +2039,20 @@ argsp.add_argument("commit",
 argsp.add_argument("path",
                    help="The EMPTY directory to checkout on.")
 
+argsp.add_argument("-j",
+                   metavar="jobs",
+                   dest="jobs",
+                   type=int,
+                   default=None,
+                   help="Number of threads writing files (default: checkout.workers, or 1)")
+
 def cmd_checkout(args):
     repo = repo_find()
 
     obj = object_read(repo, object_find(repo, args.commit))
 
     if obj.fmt == b'commit':
-        obj = object_read(repo, obj.kvlm[b'tree'].decode("ascii"))
+        obj = object_read(repo, kvlm_sha_headers(obj, b'tree')[0])
 
     if os.path.exists(args.path):
         if not os.path.isdir(args.path):
@@ -598,74 +2063,318 @@ def cmd_checkout(args):
     else:
         os.makedirs(args.path)
 
-    tree_checkout(repo, obj, os.path.realpath(args.path))
+    jobs = repo_jobs(repo, args.jobs, "checkout", "workers")
+
+    if jobs > 1:
+        tree_checkout_parallel(repo, obj, os.path.realpath(args.path), jobs)
+    else:
+        tree_checkout(repo, obj, os.path.realpath(args.path))
 
 def tree_checkout(repo, tree, path):
-    for item in tree.items:
-        obj = object_read(repo, item.sha)
-        dest = os.path.join(path, item.path)
+    # The mode tells the type of each entry, no need to look it up.
+    for mode, name, sha in tree_entries(tree):
+        dest = os.path.join(path, name.decode("utf8"))
 
-        if obj.fmt == b'tree':
+        if mode == b'040000':
             os.mkdir(dest)
-            tree_checkout(repo, obj, dest)
-        elif obj.fmt == b'blob':
-            with open(dest, 'wb') as f:
-                f.write(obj.blobdata)
+            tree_checkout(repo, object_read(repo, sha.hex()), dest)
+        elif not mode.startswith(b'16'):
+            # Submodules (gitlinks) point to commits in another
+            # repository: skip them.
+            blob_checkout(repo, sha.hex(), dest)
+
+def blob_checkout(repo, sha, dest):
+    # Inflate blobs straight to their destination, rather than read
+    # them whole.
+    _, _, chunks = object_stream(repo, sha)
+    with open(dest, 'wb') as f:
+        for chunk in chunks:
+            f.write(chunk)
+
+def tree_checkout_parallel(repo, tree, path, jobs):
+    """Same as tree_checkout, but write blobs from a pool of jobs
+    threads.  Inflating and writing files release the GIL, so
+    threads are enough to keep several cores (and disks) busy."""
+
+    # First create every directory, so that workers never have to
+    # care about their order, and collect the blobs to write.
+    blobs = list()
+    stack = [ (tree, path) ]
+
+    while stack:
+        tree, path = stack.pop()
+        for mode, name, sha in tree_entries(tree):
+            dest = os.path.join(path, name.decode("utf8"))
+
+            if mode == b'040000':
+                os.mkdir(dest)
+                stack.append((object_read(repo, sha.hex()), dest))
+            elif not mode.startswith(b'16'):
+                blobs.append((sha.hex(), dest))
+
+    # Then write blobs.  We bound the number of blobs in flight, so
+    # that memory doesn't grow with the size of the tree.
+    slots = threading.BoundedSemaphore(jobs * 4)
+    futures = list()
+
+    with concurrent.futures.ThreadPoolExecutor(jobs) as executor:
+        for sha, dest in blobs:
+            slots.acquire()
+            future = executor.submit(blob_checkout, repo, sha, dest)
+            future.add_done_callback(lambda _: slots.release())
+            futures.append(future)
+
+    # Raise the first error, if any
+    for future in futures:
+        future.result()
+
+class GitRefs(object):
+    """The references of a repository, cached for the lifetime of the
+    process.  Loose refs, files under .git/refs, override the ones
+    packed in .git/packed-refs."""
+
+    # Name to SHA, and name to the object an annotated tag points to,
+    # from packed-refs.  None until it's read.
+    packed = None
+    peeled = None
+    # Whether packed-refs has a ^ line for every annotated tag.
+    fully_peeled = False
+    # Name to the contents of the loose ref, or None if there's no
+    # such file.
+    loose = None
+    # Name to SHA for every ref, sorted.  None until ref_list.
+    listed = None
+
+    def __init__(self):
+        self.loose = dict()
+
+def repo_refs(repo):
+    if repo.refs is None:
+        repo.refs = GitRefs()
+
+    return repo.refs
+
+def packed_refs_read(repo):
+    """Read .git/packed-refs, once, and return the ref cache."""
+
+    refs = repo_refs(repo)
+
+    if refs.packed is not None:
+        return refs
+
+    refs.packed = dict()
+    refs.peeled = dict()
+
+    path = repo_path(repo, "packed-refs")
+    if not os.path.isfile(path):
+        return refs
+
+    with open(path, "r") as fp:
+        name = None
+        for line in fp:
+            line = line.rstrip("\n")
+
+            if line.startswith("# pack-refs with:"):
+                refs.fully_peeled = "fully-peeled" in line.split()
+            elif not line or line[0] == "#":
+                continue
+            elif line[0] == "^":
+                # The object the tag on the previous line points to
+                if name:
+                    refs.peeled[name] = line[1:]
+            else:
+                sha, _, name = line.partition(" ")
+                refs.packed[name] = sha
+
+    return refs
+
+def ref_read(repo, ref):
+    """Return the contents of ref, loose or packed: a SHA, or "ref: "
+    followed by the name of another ref, or None if there's no such
+    ref."""
+
+    refs = repo_refs(repo)
+
+    if ref not in refs.loose:
+        data = None
+        path = repo_path(repo, ref)
+        if os.path.isfile(path):
+            with open(path, 'r') as fp:
+                data = fp.read().rstrip("\n")
+        refs.loose[ref] = data
+
+    data = refs.loose[ref]
+    if data is None:
+        data = packed_refs_read(repo).packed.get(ref)
+
+    return data
 
 def ref_resolve(repo, ref):
-    path = repo_file(repo, ref)
+    data = ref_read(repo, ref)
 
     # Sometimes, an indirect reference may be broken.  This is normal
     # in one specific case: we're looking for HEAD on a new repository
     # with no commits.  In that case, .git/HEAD points to "ref:
     # refs/heads/main", but .git/refs/heads/main doesn't exist yet
     # (since there's no commit for it to refer to).
-    if not os.path.isfile(path):
+    if not data:
         return None
-    
-    with open(path, 'r') as fp:
-        data = fp.read()[:-1] # drop final \n
 
     if data.startswith("ref: "):
         return ref_resolve(repo, data[5:])
     else:
         return data
 
-def ref_list(repo, path=None):
-    if not path:
-        path = repo_dir(repo, "refs")
+def ref_update(repo, ref, data):
+    """Write data, a SHA or "ref: " followed by a ref name, to the
+    loose ref, and keep the cache in sync."""
 
-    ret = collections.OrderedDict()
+    with open(repo_file(repo, *ref.split("/"), mkdir=True), 'w') as fp:
+        fp.write(data + "\n")
 
-    # Git shows refs sorted.  To do the same, we use
-    # an OrderedDict and sort the output of listdir
-    for f in sorted(os.listdir(path)):
-        can = os.path.join(path, f)
+    refs = repo_refs(repo)
+    refs.loose[ref] = data
+    refs.listed = None
 
-        if os.path.isdir(can):
-            ret[f] = ref_list(repo, can)
-        else:
-            ret[f] = ref_resolve(repo, can)
+def ref_peel(repo, ref):
+    """Resolve ref, following annotated tags to the object they point
+    to.  For packed refs, packed-refs usually knows it already."""
 
-    return ret
+    sha = ref_resolve(repo, ref)
+    refs = packed_refs_read(repo)
+
+    if sha and refs.packed.get(ref) == sha:
+        if ref in refs.peeled:
+            return refs.peeled[ref]
+        if refs.fully_peeled:
+            return sha
+
+    return object_peel(repo, sha)
+
+def object_peel(repo, sha):
+    """Follow the tag sha points to, if any, and the tags it points to,
+    to an object that isn't a tag."""
+
+    while sha:
+        info = object_info(repo, sha)
+        if not info or info[0] != b'tag':
+            break
+        sha = kvlm_sha_headers(object_read(repo, sha), b'object')[0]
+
+    return sha
+
+def ref_list(repo, prefix="refs/"):
+    """Return the refs whose names start with prefix, as a dictionary
+    of full names to SHAs, sorted by name as git shows them.  The
+    refs are listed once, and cached."""
+
+    refs = packed_refs_read(repo)
+
+    if refs.listed is None:
+        loose = set()
+        for dirpath, _, filenames in os.walk(repo_path(repo, "refs")):
+            rel = os.path.relpath(dirpath, repo.gitdir).replace(os.sep, "/")
+            loose.update(rel + "/" + f for f in filenames if not f.endswith(".lock"))
+
+        # Packed refs that have no loose file don't need a stat each
+        for name in refs.packed:
+            if name not in loose:
+                refs.loose.setdefault(name, None)
+
+        names = loose | set(refs.packed)
+        refs.listed = collections.OrderedDict()
+        for name in sorted(names):
+            sha = ref_resolve(repo, name)
+            if sha:
+                refs.listed[name] = sha
+
+    return collections.OrderedDict((name, sha) for name, sha in refs.listed.items()
+                                   if name.startswith(prefix))
 
 argsp = argsubparsers.add_parser("show-ref", help="List references")
+argsp.add_argument("-d", "--dereference",
+                   action="store_true",
+                   help="Also show the objects annotated tags point to, as name^{}")
 
 def cmd_show_ref(args):
     repo = repo_find()
     refs = ref_list(repo)
-    show_ref(repo, refs, prefix="refs")
-
-def show_ref(repo, refs, with_hash=True, prefix=""):
-    for k, v in refs.items():
-        if type(v) == str:
-            print("{0}{1}{2}".format(
-                v + " " if with_hash else "",
-                prefix + "/" if prefix else "",
-                k
-            ))
-        else:
-            show_ref(repo, v, with_hash=with_hash, prefix="{0}{1}{2}".format(prefix, "/" if prefix else "", k))
+    show_ref(repo, refs, dereference=args.dereference)
+
+def show_ref(repo, refs, with_hash=True, dereference=False, strip=""):
+    for name, sha in refs.items():
+        print("{0}{1}".format(sha + " " if with_hash else "", name[len(strip):]))
+
+        if dereference:
+            peeled = ref_peel(repo, name)
+            if peeled != sha:
+                print(f"{peeled} {name}^{{}}")
+
+argsp = argsubparsers.add_parser("pack-refs", help="Pack references in .git/packed-refs")
+argsp.add_argument("--all",
+                   action="store_true",
+                   help="Pack every ref, not only tags and refs that are already packed")
+argsp.add_argument("--no-prune",
+                   dest="prune",
+                   action="store_false",
+                   help="Keep the loose refs that were packed")
+
+def cmd_pack_refs(args):
+    repo = repo_find()
+    pack_refs(repo, all=args.all, prune=args.prune)
+
+def pack_refs(repo, all=False, prune=True):
+    """Write tags, refs already packed, and every other ref if all is
+    true, to .git/packed-refs, with the objects annotated tags point
+    to.  Then remove their loose files, unless prune is false.
+    Symbolic refs stay loose."""
+
+    refs = packed_refs_read(repo)
+
+    packed = collections.OrderedDict()
+    peeled = dict()
+    for name, sha in ref_list(repo).items():
+        if ref_read(repo, name).startswith("ref: "):
+            continue
+
+        if all or name.startswith("refs/tags/") or name in refs.packed:
+            packed[name] = sha
+            peel = ref_peel(repo, name)
+            if peel != sha:
+                peeled[name] = peel
+
+    path = repo_path(repo, "packed-refs")
+    with open(path + ".lock", "w") as fp:
+        fp.write("# pack-refs with: peeled fully-peeled sorted \n")
+        for name, sha in packed.items():
+            fp.write(f"{sha} {name}\n")
+            if name in peeled:
+                fp.write(f"^{peeled[name]}\n")
+    os.replace(path + ".lock", path)
+
+    refs.packed = dict(packed)
+    refs.peeled = peeled
+    refs.fully_peeled = True
+
+    if not prune:
+        return
+
+    for name in packed:
+        if refs.loose.get(name) is None:
+            continue
+
+        os.remove(repo_path(repo, name))
+        refs.loose[name] = None
+
+        # Remove the directories this emptied, but not refs/heads
+        # and the likes.
+        parent = name.rpartition("/")[0]
+        while parent.count("/") > 1:
+            try:
+                os.rmdir(repo_path(repo, parent))
+            except OSError:
+                break
+            parent = parent.rpartition("/")[0]
 
 class GitTag(GitCommit):
     fmt = b'tag'
@@ -692,8 +2401,8 @@ def cmd_tag(args):
     if args.name:
         tag_create(repo, args.name, args.object, create_tag_object=True if args.create_tag_object else False)
     else:
-        refs = ref_list(repo)
-        show_ref(repo, refs["tags"], with_hash=False)
+        refs = ref_list(repo, "refs/tags/")
+        show_ref(repo, refs, with_hash=False, strip="refs/tags/")
 
 def tag_create(repo, name, ref, create_tag_object=False):
     sha = object_find(repo, ref)
@@ -715,8 +2424,129 @@ def tag_create(repo, name, ref, create_tag_object=False):
         ref_create(repo, "tags/" + name, sha)
 
 def ref_create(repo, ref_name, sha):
-    with open(repo_file(repo, "refs/" + ref_name), 'w') as fp:
-        fp.write(sha + "\n")
+    ref_update(repo, "refs/" + ref_name, sha)
+
+# Short hashes are 4 to 40 hexadecimal digits.  The minimum is
+# documented in man git-rev-parse.
+OBJECT_HASH_REGEX = re.compile(r"[0-9A-Fa-f]{4,40}")
+
+def loose_names(repo, first):
+    """Return the sorted binary names of the loose objects whose name
+    begins with byte first.  Each fanout directory is listed once, and
+    cached on the repository."""
+
+    if repo.loose_names is None:
+        repo.loose_names = dict()
+
+    names = repo.loose_names.get(first)
+    if names is None:
+        path = repo_path(repo, "objects", f"{first:02x}")
+        names = list()
+        if os.path.isdir(path):
+            for f in os.listdir(path):
+                if len(f) == 38:
+                    try:
+                        names.append(bytes.fromhex(f"{first:02x}{f}"))
+                    except ValueError:
+                        continue
+        names.sort()
+        repo.loose_names[first] = names
+
+    return names
+
+def loose_names_add(repo, sha):
+    """Record the new loose object sha, if its directory was listed."""
+
+    if repo.loose_names is None:
+        return
+
+    binsha = bytes.fromhex(sha)
+    names = repo.loose_names.get(binsha[0])
+    if names is not None:
+        i = bisect.bisect_left(names, binsha)
+        if i == len(names) or names[i] != binsha:
+            names.insert(i, binsha)
+
+def object_names_bisect(name_at, lo, hi, binsha):
+    """Return the position of the first name not less than binsha
+    among the sorted names name_at(lo) to name_at(hi - 1)."""
+
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if name_at(mid) < binsha:
+            lo = mid + 1
+        else:
+            hi = mid
+
+    return lo
+
+def object_names_sources(repo, first):
+    """Yield triples (name_at, lo, hi) for every sorted list of object
+    names which may hold names beginning with byte first: the loose
+    objects, and the index of each pack."""
+
+    names = loose_names(repo, first)
+    yield names.__getitem__, 0, len(names)
+
+    for pack in repo_packs(repo):
+        lo = pack.fanout[first - 1] if first else 0
+        yield functools.partial(pack_name, pack), lo, pack.fanout[first]
+
+def object_prefix_lookup(repo, prefix):
+    """Return the sorted SHAs of the objects, loose or packed, whose
+    name begins with the hexadecimal prefix."""
+
+    prefix = prefix.lower()
+    # The smallest name with that prefix
+    low = bytes.fromhex(prefix + "0" * (len(prefix) % 2))
+    found = set()
+
+    for refresh in (False, True):
+        # The object may be in a pack that was created after we
+        # listed them, so look again once before giving up.
+        if refresh:
+            if found:
+                break
+            repo_packs(repo, refresh=True)
+
+        for name_at, lo, hi in object_names_sources(repo, low[0]):
+            i = object_names_bisect(name_at, lo, hi, low)
+            while i < hi:
+                sha = name_at(i).hex()
+                if not sha.startswith(prefix):
+                    break
+                found.add(sha)
+                i += 1
+
+    return sorted(found)
+
+def object_abbrev(repo, sha, length=7):
+    """Return the shortest prefix of sha, at least length digits long,
+    that names no other object in the repository.  Only the names
+    right before and after sha in each sorted list need checking."""
+
+    binsha = bytes.fromhex(sha)
+    common = 0
+
+    for name_at, lo, hi in object_names_sources(repo, binsha[0]):
+        i = object_names_bisect(name_at, lo, hi, binsha)
+        for j in (i - 1, i, i + 1):
+            if lo <= j < hi:
+                other = name_at(j)
+                if other != binsha:
+                    common = max(common, object_names_common(binsha, other))
+
+    return sha[:max(length, common + 1)]
+
+def object_names_common(a, b):
+    """Return the number of leading hexadecimal digits a and b, two
+    binary names, have in common."""
+
+    for i in range(len(a)):
+        if a[i] != b[i]:
+            return 2 * i + (1 if a[i] >> 4 == b[i] >> 4 else 0)
+
+    return 2 * len(a)
 
 def object_resolve(repo, name):
     """Resolve name to an object hash in the repo
@@ -728,34 +2558,26 @@ def object_resolve(repo, name):
     - tags
     - branches
     - remote branches
+    - rev:path, for what path is in the tree of rev
     """
 
     candidates = list()
-    hash_regex = re.compile(r"^[0-9A-fa-f]{4,40}$")
 
     if not name.strip():
         return None
+
+    rev, colon, path = name.partition(":")
+    if colon and rev:
+        found = tree_lookup_path(repo, object_find(repo, rev, fmt=b'tree'), path)
+        return [ found[1] ] if found else []
     
     if name == "HEAD":
         return [ ref_resolve(repo, "HEAD") ]
 
-    if hash_regex.match(name):
-        # This may be a hash, either small or full.  4 seems to be the
-        # minimal length for git to consider something a short hash.
-        # This limit is documented in man git-rev-parse
-        name = name.lower()
-        prefix = name[0:2]
-        path = repo_dir(repo, "objects", prefix, mkdir=False)
+    if OBJECT_HASH_REGEX.fullmatch(name):
+        # This may be a hash, either small or full.
+        candidates.extend(object_prefix_lookup(repo, name))
 
-        if path:
-            rem = name[2:]
-
-            for f in os.listdir(path):
-                if f.startswith(rem):
-                    # Notice a string startswith() itself, so this
-                    # works for full hashes.
-                    candidates.append(prefix + f)
-        
     as_tag = ref_resolve(repo, "refs/tags/" + name)
 
     if as_tag:
@@ -766,6 +2588,11 @@ def object_resolve(repo, name):
     if as_branch:
         candidates.append(as_branch)
 
+    as_remote_branch = ref_resolve(repo, "refs/remotes/" + name)
+
+    if as_remote_branch:
+        candidates.append(as_remote_branch)
+
     return candidates
 
 argsp = argsubparsers.add_parser("rev-parse", help="Parse revision (or other objects) identifiers")
@@ -777,6 +2604,12 @@ argsp.add_argument("--wyag-type",
                    default=None,
                    help="Specify the expected type")
 
+argsp.add_argument("--abbrev",
+                   metavar="n",
+                   type=int,
+                   default=None,
+                   help="Print the shortest unique prefix of the name, at least n digits long")
+
 argsp.add_argument("name", help="The name to parse")
 
 def cmd_rev_parse(args):
@@ -786,14 +2619,26 @@ def cmd_rev_parse(args):
         fmt = None
     
     repo = repo_find()
+    sha = object_find(repo, args.name, fmt, follow=True)
+
+    if args.abbrev is not None and sha:
+        sha = object_abbrev(repo, sha, max(args.abbrev, 4))
 
-    print(object_find(repo, args.name, fmt, follow=True))
+    print(sha)
 
 class GitIndexEntry(object):
+    # Large repositories have hundreds of thousands of entries: slots
+    # make each of them much smaller than a regular object.
+    __slots__ = ("ctime", "mtime", "dev", "ino", "mode_type", "mode_perms",
+                 "uid", "gid", "fsize", "sha", "flag_assume_valid",
+                 "flag_stage", "name", "flag_skip_worktree",
+                 "flag_intent_to_add")
+
     def __init__(self, ctime=None, mtime=None, dev=None, ino=None,
                  mode_type=None, mode_perms=None, uid=None, gid=None,
                  fsize=None, sha=None, flag_assume_valid=None,
-                 flag_stage=None, name=None) -> None:
+                 flag_stage=None, name=None, flag_skip_worktree=False,
+                 flag_intent_to_add=False) -> None:
         # The last time a file's metadata changed.  This is a pair
         # (timestamp in seconds, nanoseconds)
         self.ctime = ctime
@@ -821,17 +2666,327 @@ class GitIndexEntry(object):
         self.flag_stage = flag_stage
         # Name of the object (full path this time!)
         self.name = name
+        # Extended flags, only in version 3 and later indexes
+        self.flag_skip_worktree = flag_skip_worktree
+        self.flag_intent_to_add = flag_intent_to_add
 
 class GitIndex(object):
     version = None
     entries = []
-
-    def __init__(self, version=2, entries=None) -> None:
+    # The root of the cache tree (TREE extension), if any
+    cache_tree = None
+    # In split index mode, the SHA of the shared index this index is
+    # based on, and the entries of that shared index.
+    shared_index = None
+    shared_entries = None
+    # The modification time of the index file we read, as a pair
+    # (seconds, nanoseconds), to detect racily clean entries.
+    timestamp = None
+    # Names of the entries that we've checked against the worktree
+    uptodate = None
+    # The untracked cache (UNTR extension), if any
+    untracked_cache = None
+    # The fsmonitor token (FSMN extension), if any, and the names of
+    # the entries we must check even if the fsmonitor daemon doesn't
+    # report them.
+    fsmonitor_token = None
+    fsmonitor_dirty = None
+
+    def __init__(self, version=2, entries=None, cache_tree=None) -> None:
         if not entries:
             entries = list()
 
         self.version = version
         self.entries = entries
+        self.cache_tree = cache_tree
+        self.uptodate = set()
+
+class GitCacheTree(object):
+    """A node of the cache tree, which remembers the tree objects built
+    from the index by the last commit, so that the next one only has
+    to rebuild the directories that changed.  An entry_count of -1
+    means the node is invalid: something changed below it."""
+
+    entry_count = -1
+    sha = None
+    children = None
+
+    def __init__(self, entry_count=-1, sha=None):
+        self.entry_count = entry_count
+        self.sha = sha
+        # Subdirectories, by name
+        self.children = dict()
+
+def cache_tree_parse(data):
+    """Parse the TREE extension.  Nodes are stored depth-first: path
+    component, NUL, entry count, space, number of subtrees, newline,
+    and then the tree's SHA, unless the node is invalid."""
+
+    root = None
+    # Stack of (node, children left to read)
+    stack = list()
+    pos = 0
+
+    while pos < len(data):
+        nul = data.find(b'\x00', pos)
+        name = data[pos:nul].decode("utf8")
+        newline = data.find(b'\n', nul)
+        entry_count, subtrees = data[nul + 1:newline].split(b' ')
+        pos = newline + 1
+
+        node = GitCacheTree(int(entry_count))
+        if node.entry_count >= 0:
+            node.sha = data[pos:pos + 20].hex()
+            pos += 20
+
+        if stack:
+            parent, left = stack[-1]
+            parent.children[name] = node
+            if left == 1:
+                stack.pop()
+            else:
+                stack[-1] = (parent, left - 1)
+        else:
+            root = node
+
+        if int(subtrees):
+            stack.append((node, int(subtrees)))
+
+    return root
+
+def cache_tree_serialise(root):
+    ret = list()
+    # Stack of (name, node), in reverse order of output
+    stack = [ ("", root) ]
+
+    while stack:
+        name, node = stack.pop()
+        ret.append(f"{name}\x00{node.entry_count} {len(node.children)}\n".encode("utf8"))
+        if node.entry_count >= 0:
+            ret.append(bytes.fromhex(node.sha))
+        # Git sorts subtrees by length of their name, then by name.
+        children = sorted(node.children.items(), key=lambda c: (len(c[0].encode("utf8")), c[0].encode("utf8")))
+        stack.extend(reversed(children))
+
+    return b''.join(ret)
+
+def cache_tree_invalidate(index, path):
+    """Invalidate the cache tree nodes of every directory containing
+    path, which is about to be added, changed or removed."""
+
+    node = index.cache_tree
+    if not node:
+        return
+
+    node.entry_count = -1
+    for name in path.split("/")[:-1]:
+        node = node.children.get(name)
+        if not node:
+            break
+        node.entry_count = -1
+
+class GitUntrackedCache(object):
+    """The untracked cache (UNTR extension), which remembers the
+    untracked files of each directory of the worktree, so that status
+    only has to list the directories that changed since.
+
+    It's only valid for the worktree it was built in, and as long as
+    the ignore files that apply everywhere don't change, so we keep
+    their stat data and SHA."""
+
+    # NUL-terminated strings naming the worktree and system the cache
+    # was built on
+    ident = b''
+    # Stat data and SHA (or None if missing) of .git/info/exclude and
+    # of the global excludes file
+    exclude_stat = None
+    exclude_sha = None
+    global_stat = None
+    global_sha = None
+    # git's dir_struct flags.  We list every untracked file, as git
+    # status -uall does, which is no flag at all.
+    dir_flags = 0
+    exclude_per_dir = ".gitignore"
+    # The root GitUntrackedDir, or None if we haven't walked yet
+    root = None
+
+    def __init__(self, ident=b''):
+        self.ident = ident
+        self.exclude_stat = self.global_stat = UNTRACKED_NO_STAT
+
+class GitUntrackedDir(object):
+    """A directory of the untracked cache.  Its untracked list is only
+    meaningful if it's valid, and the directory's stat data and the
+    SHA of its .gitignore are still the same."""
+
+    name = None
+    valid = False
+    check_only = False
+    stat = None
+    exclude_sha = None
+    untracked = None
+    dirs = None
+
+    def __init__(self, name):
+        self.name = name
+        # Names of the untracked files, sorted
+        self.untracked = list()
+        # Subdirectories, by name
+        self.dirs = dict()
+
+# Stat data, as stored in the untracked cache: ctime and mtime
+# (seconds, nanoseconds), dev, ino, uid, gid and size.
+UNTRACKED_STAT = struct.Struct(">9L")
+UNTRACKED_NO_STAT = (0,) * 9
+
+def untracked_stat_data(st):
+    """Stat data, truncated to 32 bits as the index stores them"""
+
+    return (int(st.st_ctime) & 0xFFFFFFFF, st.st_ctime_ns % 10**9,
+            int(st.st_mtime) & 0xFFFFFFFF, st.st_mtime_ns % 10**9,
+            st.st_dev & 0xFFFFFFFF, st.st_ino & 0xFFFFFFFF,
+            st.st_uid & 0xFFFFFFFF, st.st_gid & 0xFFFFFFFF,
+            st.st_size & 0xFFFFFFFF)
+
+def untracked_cache_parse(data):
+    """Parse the UNTR extension.  It begins with the ident, the stat
+    data and SHAs of the global ignore files, the flags and the name
+    of per-directory ignore files.  Then come the directories,
+    depth-first: number of untracked files, number of subdirectories,
+    name and untracked files.  Last come three EWAH bitmaps of
+    directory positions (valid, check only, and with a .gitignore),
+    the stat data of valid directories and the SHAs of their
+    .gitignore."""
+
+    pos, length = varint_decode(data, 0)
+    uc = GitUntrackedCache(data[pos:pos + length])
+    pos += length
+
+    uc.exclude_stat = UNTRACKED_STAT.unpack_from(data, pos)
+    pos += UNTRACKED_STAT.size
+    uc.global_stat = UNTRACKED_STAT.unpack_from(data, pos)
+    pos += UNTRACKED_STAT.size
+    uc.dir_flags = struct.unpack_from(">L", data, pos)[0]
+    uc.exclude_sha = untracked_sha(data[pos + 4:pos + 24])
+    uc.global_sha = untracked_sha(data[pos + 24:pos + 44])
+    pos += 44
+
+    nul = data.find(b'\x00', pos)
+    uc.exclude_per_dir = data[pos:nul].decode("utf8")
+    pos, count = varint_decode(data, nul + 1)
+
+    if not count:
+        return uc
+
+    nodes = list()
+    # Stack of (node, subdirectories left to read)
+    stack = list()
+
+    while len(nodes) < count:
+        pos, untracked_count = varint_decode(data, pos)
+        pos, subdirs = varint_decode(data, pos)
+        nul = data.find(b'\x00', pos)
+        node = GitUntrackedDir(data[pos:nul].decode("utf8"))
+        pos = nul + 1
+
+        for _ in range(untracked_count):
+            nul = data.find(b'\x00', pos)
+            node.untracked.append(data[pos:nul].decode("utf8"))
+            pos = nul + 1
+
+        if stack:
+            parent, left = stack[-1]
+            parent.dirs[node.name] = node
+            if left == 1:
+                stack.pop()
+            else:
+                stack[-1] = (parent, left - 1)
+
+        if subdirs:
+            stack.append((node, subdirs))
+
+        nodes.append(node)
+
+    pos, valid = ewah_decode(data, pos)
+    pos, check_only = ewah_decode(data, pos)
+    pos, sha_valid = ewah_decode(data, pos)
+
+    for i in valid:
+        nodes[i].valid = True
+        nodes[i].stat = UNTRACKED_STAT.unpack_from(data, pos)
+        pos += UNTRACKED_STAT.size
+    for i in check_only:
+        nodes[i].check_only = True
+    for i in sha_valid:
+        nodes[i].exclude_sha = data[pos:pos + 20].hex()
+        pos += 20
+
+    uc.root = nodes[0]
+    return uc
+
+def untracked_sha(binsha):
+    """SHAs of missing files are stored as zeroes"""
+    return None if binsha == bytes(20) else binsha.hex()
+
+def untracked_cache_serialise(uc):
+    ret = [ varint_encode(len(uc.ident)), uc.ident,
+            UNTRACKED_STAT.pack(*uc.exclude_stat),
+            UNTRACKED_STAT.pack(*uc.global_stat),
+            struct.pack(">L", uc.dir_flags),
+            bytes.fromhex(uc.exclude_sha) if uc.exclude_sha else bytes(20),
+            bytes.fromhex(uc.global_sha) if uc.global_sha else bytes(20),
+            uc.exclude_per_dir.encode("utf8") + b'\x00' ]
+
+    nodes = list()
+    blocks = list()
+    stack = [ uc.root ] if uc.root else []
+
+    while stack:
+        node = stack.pop()
+        nodes.append(node)
+        untracked = node.untracked if node.valid else []
+        blocks.append(varint_encode(len(untracked)) + varint_encode(len(node.dirs))
+                      + node.name.encode("utf8") + b'\x00'
+                      + b''.join(name.encode("utf8") + b'\x00' for name in untracked))
+        # Git keeps subdirectories sorted by name.
+        stack.extend(node.dirs[name] for name in sorted(node.dirs, reverse=True))
+
+    ret.append(varint_encode(len(nodes)))
+
+    if not nodes:
+        return b''.join(ret)
+
+    ret.extend(blocks)
+    ret.append(ewah_encode([ i for i, node in enumerate(nodes) if node.valid ]))
+    ret.append(ewah_encode([ i for i, node in enumerate(nodes) if node.valid and node.check_only ]))
+    ret.append(ewah_encode([ i for i, node in enumerate(nodes) if node.exclude_sha ]))
+    ret.extend(UNTRACKED_STAT.pack(*node.stat) for node in nodes if node.valid)
+    ret.extend(bytes.fromhex(node.exclude_sha) for node in nodes if node.exclude_sha)
+    # A safeguard for readers of NUL-terminated strings
+    ret.append(b'\x00')
+
+    return b''.join(ret)
+
+def untracked_cache_invalidate(index, path):
+    """Invalidate the untracked cache node of the directory containing
+    path, which is about to be added to or removed from the index."""
+
+    uc = index.untracked_cache
+    if not uc or not uc.root:
+        return
+
+    node = uc.root
+    for name in path.split("/")[:-1]:
+        node = node.dirs.get(name)
+        if not node:
+            return
+    node.valid = False
+
+# The fixed-size part of an index entry: ctime and mtime (seconds,
+# nanoseconds), dev, ino, mode (on 32 bits, 16 of them unused), uid,
+# gid, size, SHA and flags.
+INDEX_HEADER = struct.Struct(">4sLL")
+INDEX_ENTRY = struct.Struct(">LLLLLLLLLL20sH")
 
 def index_read(repo):
     index_file = repo_file(repo, "index")
@@ -839,107 +2994,132 @@ def index_read(repo):
     # New repositories have no index
     if not os.path.exists(index_file):
         return GitIndex()
-    
+
+    st = os.stat(index_file)
+    version, entries, extensions, _ = index_parse(index_file)
+    index = GitIndex(version=version, entries=entries)
+    index.timestamp = (int(st.st_mtime) & 0xFFFFFFFF, st.st_mtime_ns % 10**9)
+
+    fsmonitor = None
+
+    for signature, data in extensions:
+        if signature == b'TREE':
+            index.cache_tree = cache_tree_parse(data)
+        elif signature == b'link':
+            index_split_merge(repo, index, data)
+        elif signature == b'UNTR':
+            index.untracked_cache = untracked_cache_parse(data)
+        elif signature == b'FSMN':
+            fsmonitor = fsmonitor_parse(data)
+        # Extensions whose signature begins with an uppercase letter
+        # are optional, and we can ignore the ones we don't know.
+        elif not b'A' <= signature[:1] <= b'Z':
+            raise Exception(f"Unsupported index extension {signature.decode('ascii', 'replace')}")
+
+    # The FSMN bitmap holds positions in the merged index, so it must
+    # wait for the link extension.
+    if fsmonitor:
+        index.fsmonitor_token, dirty = fsmonitor
+        index.fsmonitor_dirty = { index.entries[i].name for i in dirty if i < len(index.entries) }
+
+    return index
+
+def index_parse(index_file):
+    """Parse an index file.  Return its version, its entries, its
+    extensions as a list of (signature, data) and its checksum."""
+
     with open(index_file, 'rb') as f:
         raw = f.read()
 
-    header = raw[:12]
-    signature = header[:4]
+    # The last 20 bytes are the SHA-1 of everything before them.
+    view = memoryview(raw)
+    if hashlib.sha1(view[:-20]).digest() != raw[-20:]:
+        raise Exception(f"Bad index file checksum {index_file}")
+
+    signature, version, count = INDEX_HEADER.unpack_from(raw, 0)
     assert signature == b'DIRC' # stands for DirCache
-    version = int.from_bytes(header[4:8], "big")
-    assert version == 2, "wyag only supports index file version 2"
-    count = int.from_bytes(header[8:12], "big")
+    assert version in (2, 3, 4), "wyag only supports index file versions 2 to 4"
 
     entries = list()
+    unpack = INDEX_ENTRY.unpack_from
+    entry_size = INDEX_ENTRY.size
+    # Version 4 only stores what differs from the previous name
+    prev_name = b''
 
-    content = raw[12:]
-    idx = 0
+    idx = 12
     for i in range(0, count):
-        # Read creation time, as a unix timestamp (seconds since
-        # 1970-01-01 00:00:00, the "epoch")
-        ctime_s = int.from_bytes(content[idx : idx + 4], "big")
-        # Read creation time, as nanoseconds after that timestamps,
-        # for extra precision.
-        ctime_ns = int.from_bytes(content[idx + 4 : idx + 8], "big")
-        # Same for modification time: first seconds from epoch.
-        mtime_s = int.from_bytes(content[idx + 8 : idx + 12], "big")
-        # Then extra nanoseconds
-        mtime_ns = int.from_bytes(content[idx + 12 : idx + 16], "big")
-        # Device ID
-        dev = int.from_bytes(content[idx + 16 : idx + 20], "big")
-        # inode 
-        ino = int.from_bytes(content[idx + 20 : idx + 24], "big")
-        # ignored
-        unused = int.from_bytes(content[idx + 24 : idx + 26], "big")
-        assert 0 == unused
-        mode = int.from_bytes(content[idx + 26 : idx + 28], "big")
+        (ctime_s, ctime_ns, mtime_s, mtime_ns, dev, ino, mode,
+         uid, gid, fsize, sha, flags) = unpack(view, idx)
+
+        # The upper 16 bits of the mode are unused
+        assert mode >> 16 == 0
         mode_type = mode >> 12
         assert mode_type in [0b1000, 0b1010, 0b1110]
         mode_perms = mode & 0b0000000111111111
-        # User ID
-        uid = int.from_bytes(content[idx + 28 : idx + 32], "big")
-        # Group ID
-        gid = int.from_bytes(content[idx + 32 : idx + 36], "big")
-        # Size
-        fsize = int.from_bytes(content[idx + 36 : idx + 40], "big")
-        # SHA (Object ID). Store as lowercase hex string for consistency
-        sha = format(int.from_bytes(content[idx + 40 : idx + 60], "big"), "040x")
-        # Flags we're going to ignore
-        flags = int.from_bytes(content[idx + 60 : idx + 62], "big")
+
         # Parse flags
         flag_assume_valid = (flags & 0b1000000000000000) != 0
         flag_extended = (flags & 0b0100000000000000) != 0
-        assert not flag_extended
         flag_stage = flags & 0b0011000000000000
         # Length of the name.  This is stored on 12 bits, some max
         # value is 0xFFF, 4095.  Since names can occasionally go
         # beyond that length, git treats 0xFFF as meaning at least
         # 0xFFF, and looks for the final 0x00 to find the end of the
-        # name --- at a small, and probably very rare, performance
-        # cost.
+        # name.
         name_length = flags & 0b0000111111111111
 
-        # We've read 62 bytes so far
-        idx += 62
-
-        if name_length < 0xFFF:
-            assert content[idx + name_length] == 0x00
-            raw_name = content[idx : idx + name_length]
-            idx += name_length + 1
+        name_start = idx + entry_size
+
+        # Version 3 adds 16 bits of extended flags, only present if
+        # the extended flag is set.
+        flag_skip_worktree = False
+        flag_intent_to_add = False
+        if flag_extended:
+            assert version >= 3, "Extended flags in a version 2 index"
+            extended = int.from_bytes(raw[name_start:name_start + 2], "big")
+            assert extended & 0b1001111111111111 == 0, "Unknown extended index flags"
+            flag_skip_worktree = (extended & 0b0100000000000000) != 0
+            flag_intent_to_add = (extended & 0b0010000000000000) != 0
+            name_start += 2
+
+        if version == 4:
+            # The name is a varint, the number of bytes to remove
+            # from the end of the previous name, then a NUL-terminated
+            # string to append to it.  There's no padding.
+            suffix_start, strip = varint_decode(raw, name_start)
+            name_end = raw.find(b'\x00', suffix_start)
+            name = prev_name[:len(prev_name) - strip] + raw[suffix_start:name_end]
+            prev_name = name
+            idx = name_end + 1
         else:
-            print("Notice: Name is 0x{:X} bytes long".format(name_length))
-            # This probably wasn't tested enough.  It works with a
-            # path of exactly 0xFFF bytes.  Any extra bytes broke
-            # something between git, my shell and my filesystem.
-            null_idx = content.find(b'\x00', idx + 0xFFF)
-            raw_name = content[idx : null_idx]
-            idx = null_idx + 1
-
-        # Parse name as utf8
-        name = raw_name.decode("utf8")
-
-        # Data is padded on multiples of eight bytes for pointer
-        # alignment, so we skip as many bytes as we need for the next
-        # read to start at the right position.
-
-        idx = 8 * ceil(idx / 8)
-
-        # Add this entry to list
-        entries.append(GitIndexEntry(ctime=(ctime_s, ctime_ns),
-                                     mtime=(mtime_s, mtime_ns),
-                                     dev=dev,
-                                     ino=ino,
-                                     mode_type=mode_type,
-                                     mode_perms=mode_perms,
-                                     uid=uid,
-                                     gid=gid,
-                                     fsize=fsize,
-                                     sha=sha,
-                                     flag_assume_valid=flag_assume_valid,
-                                     flag_stage=flag_stage,
-                                     name=name))
-        
-    return GitIndex(version=version, entries=entries)
+            if name_length < 0xFFF:
+                name_end = name_start + name_length
+                assert raw[name_end] == 0x00
+            else:
+                name_end = raw.find(b'\x00', name_start + 0xFFF)
+            name = raw[name_start:name_end]
+
+            # Entries are padded with 1 to 8 NUL bytes, to a multiple
+            # of eight bytes.
+            idx = (name_end - idx + 8) // 8 * 8 + idx
+
+        # Positional arguments are noticeably faster than keywords,
+        # in a loop this hot.
+        entries.append(GitIndexEntry((ctime_s, ctime_ns), (mtime_s, mtime_ns),
+                                     dev, ino, mode_type, mode_perms, uid, gid,
+                                     fsize, sha.hex(), flag_assume_valid, flag_stage,
+                                     name.decode("utf8"), flag_skip_worktree,
+                                     flag_intent_to_add))
+
+    # Extensions follow the entries, each a 4-byte signature and a
+    # 4-byte size.
+    extensions = list()
+    while idx < len(raw) - 20:
+        signature, size = struct.unpack_from(">4sL", raw, idx)
+        extensions.append((signature, raw[idx + 8:idx + 8 + size]))
+        idx += 8 + size
+
+    return version, entries, extensions, raw[-20:].hex()
 
 argsp = argsubparsers.add_parser("ls-files", help="List all the stage files")
 
@@ -967,30 +3147,51 @@ def cmd_ls_files(args):
             print(f"  created {datetime.fromtimestamp(e.ctime[0])}.{e.ctime[1]}, modified {datetime.fromtimestamp(e.mtime[0])}.{e.mtime[1]}")
             print(f"  device: {e.dev}, inode: {e.ino}")
             print(f"  user: {pwd.getpwuid(e.uid).pw_name} ({e.uid}), group: {grp.getgrgid(e.gid)} ({e.gid})")
-            print(f"  flags: stage={e.flag_stage} assume_valid={e.flag_assume_valid}")
+            print(f"  flags: stage={e.flag_stage} assume_valid={e.flag_assume_valid} "
+                  f"skip_worktree={e.flag_skip_worktree} intent_to_add={e.flag_intent_to_add}")
 
 argsp = argsubparsers.add_parser("check-ignore", help="Check path(s) against ignore rules")
 
-argsp.add_argument("path", nargs="+", help="Paths to check")
+argsp.add_argument("--stdin",
+                   action="store_true",
+                   help="Read paths from standard input, one per line")
+
+argsp.add_argument("path", nargs="*", help="Paths to check")
 
 def cmd_check_ignore(args):
     repo = repo_find()
     rules = gitignore_read(repo)
 
-    for path in args.path:
-        if check_ignore(rules, path):
+    if args.stdin:
+        paths = (line.rstrip("\n") for line in sys.stdin)
+    elif args.path:
+        paths = args.path
+    else:
+        raise Exception("check-ignore needs paths, or --stdin")
+
+    for path in paths:
+        relpath = os.path.relpath(os.path.abspath(path), repo.worktree)
+        is_dir = path.endswith("/") or os.path.isdir(os.path.join(repo.worktree, relpath))
+        if check_ignore_with_parents(rules, relpath, is_dir):
             print(path)
 
 def gitignore_parse1(raw):
-    raw = raw.strip() # Remove leading / trailing spaces
+    raw = raw.rstrip("\r\n")
+
+    # Trailing spaces are ignored, unless escaped with a backslash.
+    # Leading spaces are part of the pattern.
+    stripped = raw.rstrip(" ")
+    if stripped.endswith("\\") and len(stripped) < len(raw):
+        stripped += " "
+    raw = stripped
 
     if not raw or raw[0] == '#':
         return None
     elif raw[0] == '!':
         return (raw[1:], False)
-    elif raw[0] == '\\':
-        return (raw[1:], True)
     else:
+        # Escapes (as in "\#" or "\!") are kept: the pattern compiler
+        # understands them.
         return (raw, True)
     
 def gitignore_parse(lines):
@@ -1011,86 +3212,307 @@ class GitIgnore(object):
         self.absolute = absolute
         self.scoped = scoped
 
-def gitignore_read(repo):
+def gitignore_read(repo, index=None):
     ret = GitIgnore(absolute=list(), scoped=dict())
 
     # Read local configuration in .git/info/exclude
     repo_file = os.path.join(repo.gitdir, "info/exclude")
     if os.path.exists(repo_file):
         with open(repo_file, 'r') as f:
-            ret.absolute.append(gitignore_parse(f.readlines()))
+            ret.absolute.append(GitIgnoreMatcher(gitignore_parse(f.readlines())))
 
     # Global configuration
-    if 'XDG_CONFIG_HOME' in os.environ:
-        config_home = os.environ['XDG_CONFIG_HOME']
-    else:
-        config_home = os.path.expanduser("~/.config")
-    global_file = os.path.join(config_home, "git/ignore")
+    global_file = gitignore_global_path()
 
     if os.path.exists(global_file):
         with open(global_file, 'r') as f:
-            ret.absolute.append(gitignore_parse(f.readlines()))
+            ret.absolute.append(GitIgnoreMatcher(gitignore_parse(f.readlines())))
 
-    # .gitignore files in the index
-    index = index_read(repo)
+    # .gitignore files in the index.  They're compiled once per blob,
+    # and rarely change, so we keep them for the life of the process.
+    if index is None:
+        index = index_read(repo)
+
+    if repo.gitignore_cache is None:
+        repo.gitignore_cache = dict()
 
     for entry in index.entries:
         if entry.name == ".gitignore" or entry.name.endswith("/.gitignore"):
             dir_name = os.path.dirname(entry.name)
-            contents = object_read(repo, entry.sha)
-            lines = contents.blobdata.decode('utf8').splitlines()
-            ret.scoped[dir_name] = gitignore_parse(lines)
+            matcher = repo.gitignore_cache.get(entry.sha)
+            if matcher is None:
+                contents = object_read(repo, entry.sha)
+                lines = contents.blobdata.decode('utf8').splitlines()
+                matcher = GitIgnoreMatcher(gitignore_parse(lines))
+                repo.gitignore_cache[entry.sha] = matcher
+            ret.scoped[dir_name] = matcher
     
     return ret
 
-def check_ignore1(rules, path):
-    result = None
-    for (pattern, value) in rules:
-        if fnmatch(path, pattern):
-            result = value
-    return result
+def gitignore_global_path():
+    if 'XDG_CONFIG_HOME' in os.environ:
+        config_home = os.environ['XDG_CONFIG_HOME']
+    else:
+        config_home = os.path.expanduser("~/.config")
+    return os.path.join(config_home, "git/ignore")
+
+# Compiled ignore rules
+# =====================
+#
+# Matching every path against every pattern of every ignore file with
+# fnmatch is slow on large worktrees.  Instead, the rules of each file
+# are compiled once.  Most patterns are plain names ("build") or
+# extensions ("*.o"), which go to hash tables.  The others are
+# translated to regular expressions, joined in a single one, in
+# reverse order: the alternative that matches is then the last
+# pattern that does, and the last pattern wins in gitignore.
+
+# Characters that make a pattern more than a plain name
+GITIGNORE_SPECIAL = re.compile(r"[*?\[\\/]")
+# "*.ext" patterns
+GITIGNORE_EXTENSION = re.compile(r"\*\.([^*?\[\\/.]+)")
+
+class GitIgnoreMatcher(object):
+    """The rules of one ignore file, compiled.  Patterns with a
+    trailing / only match directories, so directories and files have
+    separate tables."""
+
+    values = None
+    files = None
+    dirs = None
+
+    def __init__(self, rules):
+        self.values = [ value for _, value in rules ]
+        self.files = gitignore_compile([ (i, pattern) for i, (pattern, _) in enumerate(rules)
+                                         if not pattern.endswith("/") ])
+        self.dirs = gitignore_compile([ (i, pattern) for i, (pattern, _) in enumerate(rules) ])
+
+    def match(self, path, is_dir=False):
+        """Match path, relative to the directory of the ignore file.
+        Return True if it's ignored, False if it's explicitly not
+        (by a ! pattern), and None if no pattern matches."""
+
+        names, paths, extensions, globs, suffixed, prefixed, anchored = self.dirs if is_dir else self.files
+
+        base = path[path.rfind("/") + 1:]
+        best = max(names.get(base, -1), paths.get(path, -1))
+
+        dot = base.rfind(".")
+        if dot >= 0:
+            best = max(best, extensions.get(base[dot + 1:], -1))
+
+        best = gitignore_alternation_match(globs, base, best)
+        best = gitignore_alternation_match(suffixed.get(base), path, best)
+        best = gitignore_alternation_match(prefixed.get(path.partition("/")[0]), path, best)
+        best = gitignore_alternation_match(anchored, path, best)
+
+        return self.values[best] if best >= 0 else None
+
+def gitignore_compile(patterns):
+    """Compile (index, pattern) pairs into tables of plain names, plain
+    paths and extensions, and regex alternations for everything else:
+    one for globs without a /, matched against the base name only, one
+    per literal last component for globs with a / (so "**/logs" is only
+    tried on paths named logs), else one per literal first component
+    (so "src/**/*.o" is only tried on paths in src), and one for the
+    rest.  Each maps to the index of the last pattern that matches."""
+
+    names = dict()
+    paths = dict()
+    extensions = dict()
+    globs = list()
+    suffixed = collections.defaultdict(list)
+    prefixed = collections.defaultdict(list)
+    anchored = list()
+
+    for i, pattern in patterns:
+        pattern = pattern.rstrip("/")
+        if not pattern:
+            continue
+
+        extension = GITIGNORE_EXTENSION.fullmatch(pattern)
+
+        if not GITIGNORE_SPECIAL.search(pattern):
+            # A name matches at any depth
+            names[pattern] = i
+        elif not GITIGNORE_SPECIAL.search(pattern.strip("/").replace("/", "")):
+            # A path, anchored to the directory of the ignore file
+            paths[pattern.lstrip("/")] = i
+        elif extension:
+            extensions[extension.group(1)] = i
+        elif "/" not in pattern:
+            globs.append((i, gitignore_regex(pattern)))
+        else:
+            components = pattern.lstrip("/").split("/")
+            if not GITIGNORE_SPECIAL.search(components[-1]):
+                suffixed[components[-1]].append((i, gitignore_regex(pattern)))
+            elif len(components) > 1 and not GITIGNORE_SPECIAL.search(components[0]):
+                prefixed[components[0]].append((i, gitignore_regex(pattern)))
+            else:
+                anchored.append((i, gitignore_regex(pattern)))
+
+    return (names, paths, extensions, gitignore_alternation(globs),
+            { last: gitignore_alternation(regexes) for last, regexes in suffixed.items() },
+            { first: gitignore_alternation(regexes) for first, regexes in prefixed.items() },
+            gitignore_alternation(anchored))
 
-def check_ignore_scoped(rules, path):
-    parent = os.path.dirname(path)
-    while True:
+def gitignore_alternation(regexes):
+    """Join (index, regex) pairs in a single regex, in reverse order.
+    Return it with the indices, last first, or None if there are no
+    regexes."""
+
+    if not regexes:
+        return None
+
+    regexes = list(reversed(regexes))
+    regex = re.compile("|".join(f"({r})" for _, r in regexes), re.DOTALL)
+    return regex, [ i for i, _ in regexes ]
+
+def gitignore_alternation_match(alternation, path, best):
+    """Return the index of the last pattern of alternation that matches
+    path, if greater than best, or else best."""
+
+    if not alternation:
+        return best
+
+    regex, indices = alternation
+    # The alternation can't do better than its last pattern.
+    if indices[0] < best:
+        return best
+
+    m = regex.fullmatch(path)
+    return max(best, indices[m.lastindex - 1]) if m else best
+
+def gitignore_regex(pattern):
+    """Translate a gitignore pattern, without its trailing /, to a
+    regular expression.  Patterns with a / match paths relative to the
+    directory of the ignore file, others match base names.  As with
+    git's wildmatch, * and ? never match a /, but ** matches any
+    number of directories when it's a whole path component."""
+
+    ret = ""
+    if pattern.startswith("/"):
+        pattern = pattern[1:]
+
+    i = 0
+    n = len(pattern)
+
+    while i < n:
+        c = pattern[i]
+
+        if c == "*":
+            j = i
+            while j < n and pattern[j] == "*":
+                j += 1
+            if j - i >= 2 and (i == 0 or pattern[i - 1] == "/") and (j == n or pattern[j] == "/"):
+                if j == n:
+                    # A trailing /** matches everything inside
+                    ret += ".*"
+                else:
+                    # **/ matches zero or more directories
+                    ret += "(?:.*/)?"
+                    j += 1
+            else:
+                ret += "[^/]*"
+            i = j
+        elif c == "?":
+            ret += "[^/]"
+            i += 1
+        elif c == "[":
+            j = i + 1
+            if j < n and pattern[j] in "!^":
+                j += 1
+            if j < n and pattern[j] == "]":
+                j += 1
+            while j < n and pattern[j] != "]":
+                j += 1
+
+            if j >= n:
+                # No closing bracket: a literal [
+                ret += re.escape(c)
+                i += 1
+                continue
+
+            body = pattern[i + 1:j]
+            negate = body[:1] in ("!", "^")
+            if negate:
+                body = body[1:]
+            # Escape what's special in Python's sets but not in git's
+            body = "".join("\\" + b if b in "[]&~|" else b for b in body)
+            ret += f"[^/{body}]" if negate else f"[{body}]"
+            i = j + 1
+        elif c == "\\" and i + 1 < n:
+            ret += re.escape(pattern[i + 1])
+            i += 2
+        else:
+            ret += re.escape(c)
+            i += 1
+
+    return ret
+
+def check_ignore_scoped(rules, path, is_dir=False):
+    # The deepest .gitignore wins, and its patterns are relative to
+    # its directory.
+    parent = path
+    while parent:
+        parent = parent[:max(parent.rfind("/"), 0)]
         if parent in rules:
-            result = check_ignore1(rules[parent], path)
+            result = rules[parent].match(path[len(parent) + 1:] if parent else path, is_dir)
             if result != None:
                 return result
-        if parent == '':
-            break
-        parent = os.path.dirname(parent)
     
     return None
 
-def check_ignore_absolute(rules, path):
-    parent = os.path.dirname(path)
+def check_ignore_absolute(rules, path, is_dir=False):
     for ruleset in rules:
-        result = check_ignore1(ruleset, path)
+        result = ruleset.match(path, is_dir)
         if result != None:
             return result
     return False
 
-def check_ignore(rules, path):
+def check_ignore(rules, path, is_dir=False):
+    """Whether path, a file or a directory if is_dir, is ignored.  This
+    assumes that the directories containing path aren't: walks prune
+    ignored directories, and never get there.  Use
+    check_ignore_with_parents otherwise."""
+
     if os.path.isabs(path):
         raise Exception("This function requires path to be relative to the repository's root")
     
-    result = check_ignore_scoped(rules.scoped, path)
+    result = check_ignore_scoped(rules.scoped, path, is_dir)
     if result != None:
         return result
     
-    return check_ignore_absolute(rules.absolute, path)
+    return check_ignore_absolute(rules.absolute, path, is_dir)
+
+def check_ignore_with_parents(rules, path, is_dir=False):
+    """Same as check_ignore, but also true if a directory containing
+    path is ignored: as in git, nothing can be re-included there."""
+
+    parts = path.split("/")
+    for i in range(1, len(parts)):
+        if check_ignore(rules, "/".join(parts[:i]), True):
+            return True
+
+    return check_ignore(rules, path, is_dir)
 
 argsp = argsubparsers.add_parser("status", help = "Show the working tree status.")
+argsp.add_argument("-j",
+                   metavar="jobs",
+                   dest="jobs",
+                   type=int,
+                   default=None,
+                   help="Number of threads checking files, and of processes hashing them (default: status.workers, or 1)")
 
-def cmd_status(_):
+def cmd_status(args):
     repo = repo_find()
     index = index_read(repo)
+    jobs = repo_jobs(repo, args.jobs, "status", "workers")
 
     cmd_status_branch(repo)
     cmd_status_head_index(repo, index)
     print()
-    cmd_status_index_worktree(repo, index)
+    cmd_status_index_worktree(repo, index, jobs)
 
 def branch_get_active(repo):
     with open(repo_file(repo, "HEAD"), "r") as f:
@@ -1113,21 +3535,19 @@ def tree_to_dict(repo, ref, prefix=""):
     tree_sha = object_find(repo, ref, fmt = b"tree")
     tree = object_read(repo, tree_sha)
 
-    for leaf in tree.items:
-        full_path = os.path.join(prefix, leaf.path)
+    for mode, name, sha in tree_entries(tree):
+        full_path = os.path.join(prefix, name.decode("utf8"))
 
-        # We read the object to extract its type (this is uselessly
-        # expensive: we could just open it as a file and read the
-        # first few bytes)
-        is_subtree = leaf.mode.startswith(b"04")
+        # The mode tells us whether this is a subtree.
+        is_subtree = mode.startswith(b"04")
 
         # Depending on the type, we either store the path (if it's a
         # blob, so a regular file), or recurse (if it's another tree,
         # so a subdir)
         if is_subtree:
-            ret.update(tree_to_dict(repo, leaf.sha, full_path))
+            ret.update(tree_to_dict(repo, sha.hex(), full_path))
         else:
-            ret[full_path] = leaf.sha
+            ret[full_path] = sha.hex()
     
     return ret
 
@@ -1149,123 +3569,1188 @@ def cmd_status_head_index(repo, index):
     for entry in head.keys():
         print(f"  deleted:  {entry}")
 
-def cmd_status_index_worktree(repo, index):
+def cmd_status_index_worktree(repo, index, jobs=1):
     print("Changes not staged for commit:")
 
-    ignore = gitignore_read(repo)
+    ignore = gitignore_read(repo, index)
+
+    # If the fsmonitor daemon runs, it tells us which files may have
+    # changed, and we only look at those.
+    fsmonitor = (index.fsmonitor_token, index.fsmonitor_dirty)
+    monitored = fsmonitor_refresh(repo, index)
+
+    # We now compare real files with the index, refreshing the stat
+    # data of the files that haven't really changed.
+    modified, deleted, dirty = index_refresh(repo, index, jobs)
+
+    for entry in index.entries:
+        if entry.name in deleted:
+            print(f"  deleted: {entry.name}")
+        elif entry.name in modified:
+            print(f"  modified: {entry.name}")
+
+    print()
+    print("Untracked files:")
+
+    untracked, untracked_dirty = untracked_files(repo, index, ignore, monitored)
+
+    for f in untracked:
+        print(" ", f)
+
+    # Save the refreshed stat data and untracked cache, so the next
+    # status doesn't have to hash the same files or list the same
+    # directories again.  This is only an optimisation: if someone
+    # else holds the lock, never mind.
+    if dirty or untracked_dirty or fsmonitor != (index.fsmonitor_token, index.fsmonitor_dirty):
+        index_write(repo, index, quiet=True)
+
+def untracked_files(repo, index, ignore, monitored=None):
+    """Return the untracked files of the worktree that aren't
+    ignored, and whether the untracked cache changed.
+
+    Without an untracked cache, we walk the whole worktree.  With one
+    (see core.untrackedCache), we only list the directories whose
+    stat data or .gitignore changed, and reuse what the cache
+    remembers for the others.  If monitored is the set of paths the
+    fsmonitor daemon saw change, we don't even stat the directories
+    it didn't report."""
+
+    dirty = untracked_cache_prepare(repo, index)
+    tracked = { entry.name for entry in index.entries }
+
+    if not index.untracked_cache:
+        # Untracked files are those of the worktree that aren't in the
+        # index.  Ignored directories can't hold any we'd show, so we
+        # don't even walk them.
+        return [ f for f in worktree_files(repo, repo.worktree, ignore)
+                 if f not in tracked and not check_ignore(ignore, f) ], dirty
+
+    uc = index.untracked_cache
+    if not uc.root:
+        uc.root = GitUntrackedDir("")
+
+    # The rules of a .gitignore apply to the whole directory below it,
+    # so when one changes, we list every directory below.
+    gitignores = { entry.name: entry.sha for entry in index.entries
+                   if entry.name == ".gitignore" or entry.name.endswith("/.gitignore") }
+    ret = list()
+    # Directories holding paths the daemon reported
+    if monitored is not None:
+        monitored_parents = { path.rpartition("/")[0] for path in monitored }
+    # Stack of (node, path prefix, whether its .gitignore rules changed,
+    # whether the daemon reported it or a directory above it), popped
+    # in the order worktree_files walks directories.
+    stack = [ (uc.root, "", False, False) ]
+
+    while stack:
+        node, prefix, changed, moved = stack.pop()
+
+        exclude_sha = gitignores.get(prefix + ".gitignore")
+        changed = changed or exclude_sha != node.exclude_sha
+
+        # A directory the daemon didn't report is as we listed it.  One
+        # moved or created as a whole is reported by its name only: we
+        # can't trust anything below it.
+        trusted = False
+        if monitored is not None:
+            moved = moved or prefix[:-1] in monitored
+            trusted = node.valid and not (changed or moved or prefix[:-1] in monitored_parents)
+
+        if not trusted:
+            # We stat a directory before listing it: if it changes
+            # while we do, its stat data won't match next time.
+            try:
+                st = os.stat(os.path.join(repo.worktree, prefix))
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+            stat_data = untracked_stat_data(st)
+
+            # As with index entries, a directory changed in the same
+            # tick as the index was written may have the same stat data
+            # as when we listed it.
+            racy = index.timestamp is not None and stat_data[2:4] >= index.timestamp
+
+            if changed or racy or not node.valid or node.stat != stat_data:
+                listed = untracked_dir_list(repo, prefix, ignore, tracked)
+                if listed is None:
+                    continue
+                node.untracked, dirs = listed
+                node.dirs = { name: node.dirs.get(name) or GitUntrackedDir(name) for name in dirs }
+                node.valid = True
+                node.check_only = False
+                node.stat = stat_data
+                node.exclude_sha = exclude_sha
+                dirty = True
+
+        ret.extend(prefix + name for name in node.untracked)
+        stack.extend((node.dirs[name], prefix + name + "/", changed, moved)
+                     for name in sorted(node.dirs, reverse=True))
+
+    return ret, dirty
+
+def untracked_dir_list(repo, prefix, ignore, tracked):
+    """List directory prefix of the worktree as worktree_files would.
+    Return the sorted names of its untracked files that aren't ignored,
+    and of its subdirectories that aren't ignored, or None if it can't
+    be read."""
+
+    files, dirs = list(), list()
+
+    try:
+        with os.scandir(os.path.join(repo.worktree, prefix)) as it:
+            for entry in it:
+                path = prefix + entry.name
+                if entry.is_dir():
+                    # os.walk doesn't follow symlinks to directories
+                    if not (path == ".git" or entry.is_symlink() or check_ignore(ignore, path, True)):
+                        dirs.append(entry.name)
+                elif path not in tracked and not check_ignore(ignore, path):
+                    files.append(entry.name)
+    except OSError:
+        return None
+
+    return sorted(files), sorted(dirs)
+
+def untracked_cache_prepare(repo, index):
+    """Add or remove the untracked cache as core.untrackedCache says
+    (true, false, or keep, the default, to keep whatever the index
+    has), and drop what it remembers if it was built for another
+    worktree, with other flags, or with other global ignore files.
+    Return whether the cache changed."""
+
+    setting = repo.conf.get("core", "untrackedCache", fallback="keep").strip().lower()
+    uc = index.untracked_cache
+
+    if setting != "keep" and not configparser.ConfigParser.BOOLEAN_STATES.get(setting, False):
+        index.untracked_cache = None
+        return uc is not None
+
+    ident = f"Location {repo.worktree}, system {os.uname().sysname}".encode("utf8")
+
+    if uc and (ident not in uc.ident.split(b'\x00') or uc.dir_flags != 0
+               or uc.exclude_per_dir != ".gitignore"):
+        uc = None
+
+    if not uc:
+        if setting == "keep":
+            index.untracked_cache = None
+            return False
+        uc = GitUntrackedCache(ident + b'\x00')
+
+    dirty = uc is not index.untracked_cache
+    index.untracked_cache = uc
+
+    # Those files apply everywhere: if one of them changes, we start
+    # from scratch.
+    exclude_stat, exclude_sha = untracked_cache_exclude_file(
+        os.path.join(repo.gitdir, "info/exclude"), uc.exclude_stat, uc.exclude_sha)
+    global_stat, global_sha = untracked_cache_exclude_file(
+        gitignore_global_path(), uc.global_stat, uc.global_sha)
+
+    if exclude_sha != uc.exclude_sha or global_sha != uc.global_sha:
+        uc.root = None
+    if (exclude_stat, global_stat) != (uc.exclude_stat, uc.global_stat) or not uc.root:
+        dirty = True
+
+    uc.exclude_stat, uc.exclude_sha = exclude_stat, exclude_sha
+    uc.global_stat, uc.global_sha = global_stat, global_sha
+
+    return dirty
+
+def untracked_cache_exclude_file(path, stat_data, sha):
+    """Return the stat data and SHA of ignore file path, given those
+    we knew.  We only hash the file if its stat data changed."""
+
+    try:
+        st = os.stat(path)
+    except (FileNotFoundError, NotADirectoryError):
+        return UNTRACKED_NO_STAT, None
+
+    new_stat = untracked_stat_data(st)
+    if new_stat == stat_data:
+        return stat_data, sha
+
+    with open(path, "rb") as fd:
+        return new_stat, object_hash(fd, b'blob')
+
+def index_refresh(repo, index, jobs=1):
+    """Compare the index with the worktree.  Return the set of names
+    of modified entries, the set of names of deleted entries, and
+    whether the index should be written back.
 
-    gitdir_prefix = repo.gitdir + os.path.sep
+    Entries whose stat data differ but whose content is unchanged get
+    their stat data refreshed, so that we don't hash them again next
+    time.  Files whose size differ are modified: no need to hash them
+    either.
 
-    all_files = list()
+    With jobs > 1, files are stat'ed by that many threads, and hashed
+    by that many processes.
 
-    # We begin by walking the filesystem
-    # os.walk returns current dir, dirs in current, files in current
-    for root, _, files in os.walk(repo.worktree, True):
-        if root == repo.gitdir or root.startswith(gitdir_prefix):
+    If the fsmonitor daemon told us what changed (see
+    fsmonitor_refresh), only the entries it marked dirty are checked."""
+
+    filemode = repo_config_bool(repo, "core", "filemode", True)
+    modified = set()
+    deleted = set()
+    dirty = False
+
+    if index.fsmonitor_dirty is None:
+        positions = range(len(index.entries))
+    else:
+        positions = [ i for i, e in enumerate(index.entries) if e.name in index.fsmonitor_dirty ]
+
+    stats = dict(zip(positions, index_entries_stat(repo, [ index.entries[i] for i in positions ], jobs)))
+
+    # Entries we need to hash, by position in the index
+    check = list()
+    for i, st in stats.items():
+        e = index.entries[i]
+        if st is None:
+            deleted.add(e.name)
             continue
-        for f in files:
-            full_path = os.path.join(root, f)
-            rel_path = os.path.relpath(full_path, repo.worktree)
-            all_files.append(rel_path)
 
-    # We now traverse the index, and compare real files with the cached
-    # versions.
+        match index_entry_compare(index, e, st, filemode):
+            case "same":
+                index.uptodate.add(e.name)
+            case "modified":
+                modified.add(e.name)
+            case "racy":
+                # Racily clean entries are written back even if their
+                # stat data doesn't change: the new index will be more
+                # recent than them.
+                dirty = True
+                check.append(i)
+            case _:
+                check.append(i)
 
-    for entry in index.entries:
-        full_path = os.path.join(repo.worktree, entry.name)
+    shas = object_hash_files(repo, [ os.path.join(repo.worktree, index.entries[i].name) for i in check ],
+                             jobs, write=False)
 
-        # That file *name* is in the index
+    for i, sha in zip(check, shas):
+        e = index.entries[i]
+        if sha != e.sha:
+            modified.add(e.name)
+            continue
 
-        if not os.path.exists(full_path):
-            print(f"  deleted: {entry.name}")
+        index.uptodate.add(e.name)
+        refreshed = index_entry_from_stat(e.name, stats[i], e.sha)
+        refreshed.flag_assume_valid = e.flag_assume_valid
+        refreshed.flag_stage = e.flag_stage
+        refreshed.flag_skip_worktree = e.flag_skip_worktree
+        refreshed.flag_intent_to_add = e.flag_intent_to_add
+        if not filemode:
+            refreshed.mode_perms = e.mode_perms
+
+        if not index_entry_same(refreshed, e):
+            index.entries[i] = refreshed
+            dirty = True
+
+    # Changed entries stay dirty until they're staged: the daemon
+    # won't report them again.
+    if index.fsmonitor_dirty is not None:
+        index.fsmonitor_dirty = modified | deleted
+
+    return modified, deleted, dirty
+
+def index_entry_stat(repo, entry):
+    """Stat the file of an index entry, or return None if it's gone."""
+
+    try:
+        return os.stat(os.path.join(repo.worktree, entry.name))
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+
+def index_entries_stat(repo, entries, jobs=1):
+    """Stat the files of entries, with up to jobs threads: on network
+    filesystems each stat is a round trip, and threads let them
+    overlap.  Return the results, in the same order."""
+
+    if jobs <= 1:
+        return [ index_entry_stat(repo, e) for e in entries ]
+
+    shard = 512
+    shards = [ entries[i:i + shard] for i in range(0, len(entries), shard) ]
+    ret = list()
+
+    with concurrent.futures.ThreadPoolExecutor(jobs) as executor:
+        for stats in executor.map(lambda es: [ index_entry_stat(repo, e) for e in es ], shards):
+            ret.extend(stats)
+
+    return ret
+
+def index_entry_compare(index, entry, st, filemode=True):
+    """Compare an index entry with the stat data of its file, without
+    reading it.  Return "same" if the file is unchanged, "modified" if
+    it has changed, "racy" if it seems unchanged but we can't be sure,
+    and "check" if we need to hash it to know."""
+
+    if not stat.S_ISREG(st.st_mode):
+        return "modified"
+    if filemode and bool(st.st_mode & stat.S_IXUSR) != (entry.mode_perms == 0o755):
+        return "modified"
+
+    # A different size means different content.  Size zero is also
+    # how we mark entries we know nothing about, see index_smudge.
+    if entry.fsize != st.st_size & 0xFFFFFFFF and entry.fsize != 0:
+        return "modified"
+
+    if (entry.mtime != (int(st.st_mtime) & 0xFFFFFFFF, st.st_mtime_ns % 10**9)
+        or entry.ctime != (int(st.st_ctime) & 0xFFFFFFFF, st.st_ctime_ns % 10**9)
+        or entry.ino != st.st_ino & 0xFFFFFFFF
+        or entry.uid != st.st_uid & 0xFFFFFFFF
+        or entry.gid != st.st_gid & 0xFFFFFFFF
+        or entry.fsize != st.st_size & 0xFFFFFFFF):
+        return "check"
+
+    if index_entry_racy(index, entry):
+        return "racy"
+
+    return "same"
+
+def index_entry_racy(index, entry):
+    """Whether entry is racily clean.  If a file is modified in the
+    same timestamp tick as the index is written, its stat data may
+    not change while its content has: we can only trust the stat data
+    of files last modified before the index was written."""
+
+    return index.timestamp is not None and entry.mtime >= index.timestamp
+
+def index_smudge(repo, index):
+    """Before writing the index, look for racily clean entries we
+    haven't checked: once the index is rewritten, they would look
+    clean.  Those whose content changed get size zero, so that
+    index_entry_compare never thinks they're unchanged."""
+
+    filemode = repo_config_bool(repo, "core", "filemode", True)
+
+    for i, e in enumerate(index.entries):
+        if e.name in index.uptodate or not index_entry_racy(index, e):
+            continue
+
+        st = index_entry_stat(repo, e)
+        if st is None or index_entry_compare(index, e, st, filemode) != "racy":
+            continue
+
+        with open(os.path.join(repo.worktree, e.name), "rb") as fd:
+            sha = object_hash(fd, b"blob", None)
+
+        if sha != e.sha:
+            # The entry may be shared with the shared index: copy it.
+            smudged = GitIndexEntry(*(getattr(e, slot) for slot in GitIndexEntry.__slots__))
+            smudged.fsize = 0
+            index.entries[i] = smudged
+
+def index_write(repo, index, quiet=False):
+    """Write index.  We write to index.lock, and rename it: readers
+    never see a partial index, and if the lock exists, some other
+    process is writing the index, so we fail rather than clobber its
+    changes.  If quiet, just return False in that case."""
+
+    index_file = repo_file(repo, "index")
+    lock = index_file + ".lock"
+
+    try:
+        fd = os.open(lock, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+    except FileExistsError:
+        if quiet:
+            return False
+        raise Exception(f"Unable to create {lock}: File exists.  Another wyag or git process seems to be running.")
+
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(index_serialise(repo, index))
+        os.replace(lock, index_file)
+    except BaseException:
+        os.unlink(lock)
+        raise
+
+    st = os.stat(index_file)
+    index.timestamp = (int(st.st_mtime) & 0xFFFFFFFF, st.st_mtime_ns % 10**9)
+
+    return True
+
+def index_serialise(repo, index):
+    index_smudge(repo, index)
+
+    # The version to write can be forced with index.version, as in
+    # git.  Extended flags need at least version 3.
+    version = repo_config_int(repo, "index", "version", index.version)
+    if version < 3 and any(e.flag_skip_worktree or e.flag_intent_to_add for e in index.entries):
+        version = 3
+    if version not in (2, 3, 4):
+        raise Exception(f"Unsupported index version {version}")
+    index.version = version
+
+    # link goes first, as git writes it: until git has read it, it
+    # checks the FSMN bitmap against the split index's entries alone.
+    extensions = list()
+    if repo_config_bool(repo, "core", "splitIndex", False):
+        entries, names, link = index_split(repo, index, version)
+        extensions.append((b'link', link))
+    else:
+        entries, names = index.entries, None
+        index.shared_index = index.shared_entries = None
+
+    if index.cache_tree:
+        extensions.append((b'TREE', cache_tree_serialise(index.cache_tree)))
+    if index.untracked_cache:
+        extensions.append((b'UNTR', untracked_cache_serialise(index.untracked_cache)))
+    if index.fsmonitor_token:
+        extensions.append((b'FSMN', fsmonitor_serialise(index)))
+
+    return index_encode(version, entries, extensions, names)
+
+def index_encode(version, entries, extensions, names=None):
+    """Encode an index file, and return it as a bytearray.  names, if
+    given, overrides the names of the entries, encoded as UTF-8."""
+
+    # We encode what follows the fixed-size part of each entry first,
+    # to know the size of the whole file and fill a single buffer,
+    # rather than issue many small writes.
+    entry_size = INDEX_ENTRY.size
+    tails = list()
+    prev_name = b''
+    size = 12
+
+    if names is None:
+        names = [ e.name.encode("utf8") for e in entries ]
+
+    for e, name in zip(entries, names):
+        extended = e.flag_skip_worktree or e.flag_intent_to_add
+        fixed_size = entry_size + 2 if extended else entry_size
+
+        if version == 4:
+            # Prefix-compress the name against the previous one
+            common = len(os.path.commonprefix([ prev_name, name ]))
+            tail = varint_encode(len(prev_name) - common) + name[common:]
+            prev_name = name
+            # The tail, then a final 0x00
+            size += fixed_size + len(tail) + 1
+        else:
+            # The name, then 1 to 8 NUL bytes of padding
+            tail = name
+            size += (fixed_size + len(name) + 8) // 8 * 8
+
+        tails.append((name, tail))
+
+    # EXTENSIONS
+    for _, data in extensions:
+        size += 8 + len(data)
+
+    buf = bytearray(size + 20)
+
+    # HEADER
+    INDEX_HEADER.pack_into(buf, 0, b"DIRC", version, len(entries))
+
+    # ENTRIES
+    pack = INDEX_ENTRY.pack_into
+    idx = 12
+    for e, (name, tail) in zip(entries, tails):
+        flag_assume_valid = 0x1 << 15 if e.flag_assume_valid else 0
+        extended = e.flag_skip_worktree or e.flag_intent_to_add
+        flag_extended = 0x1 << 14 if extended else 0
+        name_length = min(len(name), 0xFFF)
+        start = idx
+
+        pack(buf, idx,
+             e.ctime[0], e.ctime[1], e.mtime[0], e.mtime[1], e.dev, e.ino,
+             (e.mode_type << 12) | e.mode_perms,
+             e.uid, e.gid, e.fsize, bytes.fromhex(e.sha),
+             # We merge back four pieces of data (three flags and the
+             # length of the name) on the same two bytes
+             flag_assume_valid | flag_extended | e.flag_stage | name_length)
+        idx += entry_size
+
+        if extended:
+            flags = (0x1 << 14 if e.flag_skip_worktree else 0) | (0x1 << 13 if e.flag_intent_to_add else 0)
+            buf[idx:idx + 2] = flags.to_bytes(2, "big")
+            idx += 2
+
+        # The buffer is zeroed, so the final 0x00 and the padding are
+        # already there.
+        buf[idx:idx + len(tail)] = tail
+        if version == 4:
+            idx += len(tail) + 1
         else:
-            stat = os.stat(full_path)
+            idx = start + (idx - start + len(tail) + 8) // 8 * 8
 
-            # Compare metadata
-            ctime_ns = entry.ctime[0] * 10**9 + entry.ctime[1]
-            mtime_ns = entry.mtime[0] * 10**9 + entry.mtime[1]
+    for signature, data in extensions:
+        struct.pack_into(">4sL", buf, idx, signature, len(data))
+        buf[idx + 8:idx + 8 + len(data)] = data
+        idx += 8 + len(data)
 
-            if (stat.st_ctime_ns != ctime_ns) or (stat.st_mtime_ns != mtime_ns):
-                # If different, deep compare.
-                # This *will* crash on symlinks to dir.
-                with open(full_path, "rb") as fd:
-                    new_sha = object_hash(fd, b"blob", None)
-                    # If the hashes are the same, the files are actually the same.
-                    same = entry.sha == new_sha
+    # TRAILER: the SHA-1 of the whole content
+    buf[idx:] = hashlib.sha1(memoryview(buf)[:idx]).digest()
 
-                    if not same:
-                        print(f"  modified: {entry.name}")
+    return buf
 
-        if entry.name in all_files:
-            all_files.remove(entry.name)
+# How long to keep shared index files that no index refers to, as
+# git's default splitIndex.sharedIndexExpire, two weeks.
+SHARED_INDEX_EXPIRE = 14 * 24 * 3600
 
-    print()
-    print("Untracked files:")
+def index_split_merge(repo, index, link):
+    """Merge a split index with the shared index its link extension
+    refers to.  The link extension holds the SHA of the shared index,
+    then two EWAH bitmaps of positions in the shared index: entries to
+    delete, and entries replaced by the first entries of the split
+    index (which have empty names).  The remaining entries of the
+    split index are added."""
 
-    for f in all_files:
-        if not check_ignore(ignore, f):
-            print(" ", f)
+    sha = link[:20].hex()
+    if sha == "0" * 40:
+        return
 
-def index_write(repo, index):
-    with open(repo_file(repo, "index"), "wb") as f:
+    version, shared, _, checksum = index_parse(repo_file(repo, f"sharedindex.{sha}"))
+    if checksum != sha:
+        raise Exception(f"Bad shared index {sha}")
 
-        # HEADER
-        
-        # Write the magic bytes
-        f.write(b"DIRC")
-        # Write version number
-        f.write(index.version.to_bytes(4, "big"))
-        # Write the number of entries
-        f.write(len(index.entries).to_bytes(4, "big"))
-
-        # ENTRIES
-
-        idx = 0
-        for e in index.entries:
-            f.write(e.ctime[0].to_bytes(4, "big"))
-            f.write(e.ctime[1].to_bytes(4, "big"))
-            f.write(e.mtime[0].to_bytes(4, "big"))
-            f.write(e.mtime[1].to_bytes(4, "big"))
-            f.write(e.dev.to_bytes(4, "big"))
-            f.write(e.ino.to_bytes(4, "big"))
-
-            # Mode
-            mode = (e.mode_type << 12) | e.mode_perms
-            f.write(mode.to_bytes(4, "big"))
-
-            f.write(e.uid.to_bytes(4, "big"))
-            f.write(e.gid.to_bytes(4, "big"))
-
-            f.write(e.fsize.to_bytes(4, "big"))
-
-            # should convert back to int
-            f.write(int(e.sha, 16).to_bytes(20, "big"))
-
-            flag_assume_valid = 0x1 << 15 if e.flag_assume_valid else 0
-
-            name_bytes = e.name.encode("utf8")
-            bytes_len = len(name_bytes)
-            if bytes_len >= 0xFFF:
-                name_length = 0xFFF
+    delete, replace = list(), list()
+    if len(link) > 20:
+        pos, delete = ewah_decode(link, 20)
+        pos, replace = ewah_decode(link, pos)
+
+    entries = list(shared)
+    split = index.entries
+
+    if len(replace) > len(split):
+        raise Exception("Too many replaced entries in split index")
+    for e, pos in zip(split, replace):
+        if e.name:
+            raise Exception(f"Replacing entry {pos} of the shared index should have an empty name")
+        e.name = shared[pos].name
+        entries[pos] = e
+
+    if delete:
+        delete = set(delete)
+        entries = [ e for pos, e in enumerate(entries) if pos not in delete ]
+
+    added = split[len(replace):]
+    if added:
+        merged = { (e.name, e.flag_stage) : e for e in entries }
+        merged.update(((e.name, e.flag_stage), e) for e in added)
+        entries = sorted(merged.values(), key=lambda e: (e.name.encode("utf8"), e.flag_stage))
+
+    index.entries = entries
+    index.shared_index = sha
+    index.shared_entries = shared
+
+def index_split(repo, index, version):
+    """Prepare to write index in split mode.  Return the entries to
+    write in the index itself, their names, and the link extension.
+
+    The split index only holds what changed since the shared index.
+    When that grows past splitIndex.maxPercentChange percent of the
+    entries (0 meaning always, 100 never), we write a new shared
+    index holding everything instead."""
+
+    max_change = repo_config_int(repo, "splitIndex", "maxPercentChange", 20)
+
+    delta = None
+    if index.shared_entries is not None and max_change != 0:
+        delta = index_split_delta(index.shared_entries, index.entries)
+        changed = sum(len(d) for d in delta)
+        if max_change < 100 and changed * 100 > max_change * len(index.entries):
+            delta = None
+
+    if delta is None:
+        index_shared_write(repo, index, version)
+        delta = [], [], []
+    else:
+        # Keep the shared index we use fresh, so that it doesn't
+        # expire.
+        os.utime(repo_file(repo, f"sharedindex.{index.shared_index}"))
+
+    replaced, added, deleted = delta
+    entries = [ e for _, e in replaced ] + added
+    names = [ b'' ] * len(replaced) + [ e.name.encode("utf8") for e in added ]
+    link = (bytes.fromhex(index.shared_index)
+            + ewah_encode(deleted)
+            + ewah_encode([ pos for pos, _ in replaced ]))
+
+    return entries, names, link
+
+def index_split_delta(shared, entries):
+    """Compare entries to those of the shared index.  Return the list
+    of replaced entries as (position in the shared index, entry), the
+    list of added entries, and the positions of deleted entries."""
+
+    positions = { (e.name, e.flag_stage) : pos for pos, e in enumerate(shared) }
+    replaced = list()
+    added = list()
+
+    for e in entries:
+        pos = positions.pop((e.name, e.flag_stage), None)
+        if pos is None:
+            added.append(e)
+        elif e is not shared[pos] and not index_entry_same(e, shared[pos]):
+            replaced.append((pos, e))
+
+    replaced.sort(key=lambda r: r[0])
+    deleted = sorted(positions.values())
+
+    return replaced, added, deleted
+
+def index_entry_same(a, b):
+    return all(getattr(a, slot) == getattr(b, slot) for slot in GitIndexEntry.__slots__)
+
+def index_shared_write(repo, index, version):
+    """Write all the entries of index to a new shared index, named
+    after its checksum, and expire old shared indexes."""
+
+    buf = index_encode(version, index.entries, [])
+    sha = buf[-20:].hex()
+    path = repo_file(repo, f"sharedindex.{sha}")
+
+    if not os.path.exists(path):
+        # As with the index itself, the mode comes from the umask, so
+        # that shared repositories stay shared.
+        tmp = repo_file(repo, f"sharedindex_{os.getpid()}")
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(buf)
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    index.shared_index = sha
+    index.shared_entries = list(index.entries)
+
+    expire = time.time() - SHARED_INDEX_EXPIRE
+    for name in os.listdir(repo.gitdir):
+        if name.startswith("sharedindex.") and name != f"sharedindex.{sha}":
+            old = os.path.join(repo.gitdir, name)
+            if os.stat(old).st_mtime < expire:
+                os.unlink(old)
+
+def ewah_encode(bits):
+    """Encode a sorted list of bit positions as a git EWAH bitmap: the
+    number of bits, the number of 64-bit words, the words, and the
+    position of the last marker word.  Each marker word holds a run of
+    words all zeroes or all ones (bit 0 tells which, bits 1-32 how
+    many) and the number of literal words that follow (bits 33-63)."""
+
+    size = bits[-1] + 1 if bits else 0
+    words = [ 0 ] * ((size + 63) // 64)
+    for bit in bits:
+        words[bit >> 6] |= 1 << (bit & 63)
+
+    ones = 0xFFFFFFFFFFFFFFFF
+    out = list()
+    marker = 0
+    i = 0
+
+    while True:
+        running = 1 if i < len(words) and words[i] == ones else 0
+        clean = ones if running else 0
+        run = 0
+        while i < len(words) and words[i] == clean and run < 0xFFFFFFFF:
+            run += 1
+            i += 1
+
+        start = i
+        while i < len(words) and words[i] not in (0, ones) and i - start < 0x7FFFFFFF:
+            i += 1
+
+        marker = len(out)
+        out.append(running | run << 1 | (i - start) << 33)
+        out.extend(words[start:i])
+
+        if i >= len(words):
+            break
+
+    return struct.pack(f">LL{len(out)}QL", size, len(out), *out, marker)
+
+def ewah_decode(data, pos):
+    """Decode the EWAH bitmap at data[pos:].  Return the position
+    after it, and the sorted list of its set bits."""
+
+    size, count = struct.unpack_from(">LL", data, pos)
+    words = struct.unpack_from(f">{count}Q", data, pos + 8)
+    pos += 8 + 8 * count + 4
+
+    bits = list()
+    bit = 0
+    i = 0
+    while i < count:
+        marker = words[i]
+        run = (marker >> 1) & 0xFFFFFFFF
+        literals = marker >> 33
+
+        if marker & 1:
+            bits.extend(range(bit, min(bit + run * 64, size)))
+        bit += run * 64
+
+        for word in words[i + 1:i + 1 + literals]:
+            while word:
+                low = word & -word
+                bits.append(bit + low.bit_length() - 1)
+                word ^= low
+            bit += 64
+
+        i += 1 + literals
+
+    return pos, bits
+
+# Filesystem monitor
+# ==================
+#
+# Even with every cache above, status has to stat every file of the
+# worktree.  The fsmonitor daemon watches the worktree with Linux's
+# inotify, and answers the question "what changed since token X?"
+# over a Unix socket.  The index remembers the last token it got (in
+# the FSMN extension), so status only looks at the paths the daemon
+# reports.  When the daemon isn't running, or can't answer (it was
+# restarted, or the kernel dropped events), we fall back to looking
+# at everything.
+
+# inotify event masks, from <sys/inotify.h>
+IN_MODIFY      = 0x00000002
+IN_ATTRIB      = 0x00000004
+IN_MOVED_FROM  = 0x00000040
+IN_MOVED_TO    = 0x00000080
+IN_CREATE      = 0x00000100
+IN_DELETE      = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF   = 0x00000800
+IN_Q_OVERFLOW  = 0x00004000
+IN_IGNORED     = 0x00008000
+IN_ONLYDIR     = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_EXCL_UNLINK = 0x04000000
+IN_ISDIR       = 0x40000000
+
+INOTIFY_WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+                      | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR | IN_DONT_FOLLOW | IN_EXCL_UNLINK)
+
+# struct inotify_event: wd, mask, cookie and length of the name that
+# follows, NUL-padded.
+INOTIFY_EVENT = struct.Struct("iIII")
+
+# Past this many changed paths, the daemon forgets them all and asks
+# for a full scan, rather than grow without bounds.
+FSMONITOR_MAX_CHANGES = 1000000
+
+class Inotify(object):
+    """A non-blocking inotify instance, through libc"""
+
+    fd = None
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+
+        if not hasattr(libc, "inotify_init1"):
+            raise Exception("fsmonitor needs Linux's inotify")
+
+        self.libc = libc
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+    def add_watch(self, path, mask):
+        """Watch path.  Return the watch descriptor, which is the same
+        for every path of a given directory, or None if path is
+        gone."""
+
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err in (errno.ENOENT, errno.ENOTDIR):
+                return None
+            if err == errno.ENOSPC:
+                raise Exception("Too many directories to watch: raise fs.inotify.max_user_watches")
+            raise OSError(err, f"inotify_add_watch failed on {path}")
+        return wd
+
+    def rm_watch(self, wd):
+        self.libc.inotify_rm_watch(self.fd, wd)
+
+    def read(self):
+        """Return the list of pending events, as (wd, mask, name)
+        triples, name being None for events about the watched
+        directory itself."""
+
+        events = list()
+
+        while True:
+            try:
+                buf = os.read(self.fd, 65536)
+            except BlockingIOError:
+                return events
+
+            pos = 0
+            while pos < len(buf):
+                wd, mask, _, length = INOTIFY_EVENT.unpack_from(buf, pos)
+                pos += INOTIFY_EVENT.size
+                name = buf[pos:pos + length].rstrip(b'\x00')
+                pos += length
+                events.append((wd, mask, os.fsdecode(name) if name else None))
+
+    def close(self):
+        os.close(self.fd)
+
+class GitFSMonitor(object):
+    """The state of the fsmonitor daemon.
+
+    Every change is recorded with the current sequence number.  Tokens
+    name an instance of the daemon and a sequence number: the changes
+    since a token are those recorded with a greater number.  Events
+    lost by the kernel, or a token from another instance, mean that
+    anything may have changed."""
+
+    def __init__(self, repo):
+        self.repo = repo
+        self.inotify = Inotify()
+        self.instance = os.urandom(8).hex()
+        self.seq = 0
+        # The last sequence number we gave out in a token
+        self.issued = -1
+        # Tokens older than this predate lost events
+        self.overflow = 0
+        # Changed paths, relative to the worktree, and when
+        self.changes = dict()
+        # Watched directories, relative to the worktree, by watch
+        # descriptor and by path
+        self.watches = dict()
+        self.paths = dict()
+        self.root = None
+
+        self.watch("")
+
+    def watch(self, top):
+        """Watch directory top and every directory below it"""
+
+        for root, dirs, _ in os.walk(os.path.join(self.repo.worktree, top)):
+            if root == self.repo.worktree and ".git" in dirs:
+                dirs.remove(".git")
+
+            path = os.path.relpath(root, self.repo.worktree)
+            path = "" if path == "." else path
+            wd = self.inotify.add_watch(root, INOTIFY_WATCH_MASK)
+
+            if wd is None:
+                dirs.clear()
+                continue
+
+            old = self.watches.get(wd)
+            if old is not None and self.paths.get(old) == wd:
+                del self.paths[old]
+            self.watches[wd] = path
+            self.paths[path] = wd
+
+            if path == "":
+                self.root = wd
+
+    def unwatch(self, top):
+        """Stop watching directory top, and every directory below it"""
+
+        prefix = top + "/"
+        for path in [ p for p in self.paths if p == top or p.startswith(prefix) ]:
+            wd = self.paths.pop(path)
+            del self.watches[wd]
+            self.inotify.rm_watch(wd)
+
+    def changed(self, path):
+        # Only bump the sequence number if we've given out a token for
+        # the current one: a status with nothing new to report gets
+        # the same token, and doesn't have to write the index.
+        if self.issued == self.seq:
+            self.seq += 1
+        self.changes[path] = self.seq
+
+        if len(self.changes) > FSMONITOR_MAX_CHANGES:
+            self.lost()
+
+    def lost(self):
+        """We lost track of what changed: every token given so far is
+        worthless."""
+        self.seq += 1
+        self.overflow = self.seq
+        self.changes.clear()
+
+    def process(self):
+        """Record pending events.  Return False if the worktree itself
+        is gone."""
+
+        for wd, mask, name in self.inotify.read():
+            if mask & IN_Q_OVERFLOW:
+                # The kernel dropped events, possibly the creation of
+                # directories we don't watch yet.
+                self.lost()
+                self.watch("")
+                continue
+
+            if mask & IN_IGNORED:
+                path = self.watches.pop(wd, None)
+                if path is not None and self.paths.get(path) == wd:
+                    del self.paths[path]
+                if wd == self.root:
+                    return False
+                continue
+
+            parent = self.watches.get(wd)
+            if parent is None:
+                continue
+
+            if name is None:
+                # Events about a directory itself are reported as well
+                # by the watch on its parent, except for the root.
+                if wd == self.root and mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                    return False
+                continue
+
+            if parent == "" and name == ".git":
+                continue
+
+            path = parent + "/" + name if parent else name
+
+            if mask & IN_ISDIR:
+                if mask & IN_MOVED_FROM:
+                    self.unwatch(path)
+                elif mask & (IN_CREATE | IN_MOVED_TO):
+                    # Anything may have been created in there before
+                    # we watched it, but reporting the directory covers
+                    # everything below it.
+                    self.watch(path)
+
+            self.changed(path)
+
+        return True
+
+    def query(self, token):
+        """Answer a client: return the current token, and the paths
+        that changed since token, or None if we can't know."""
+
+        self.process()
+
+        changes = None
+        instance, _, seq = token.rpartition(":")
+        if instance == f"wyag:{self.instance}" and seq.isdigit() and int(seq) >= self.overflow:
+            seq = int(seq)
+            changes = [ path for path, when in self.changes.items() if when > seq ]
+
+        self.issued = self.seq
+        return f"wyag:{self.instance}:{self.seq}", changes
+
+    def serve(self, sock):
+        """Serve clients on the listening socket sock, until told to
+        quit or the worktree disappears."""
+
+        while True:
+            ready, _, _ = select.select([ self.inotify.fd, sock ], [], [])
+
+            if self.inotify.fd in ready and not self.process():
+                return
+
+            if sock in ready:
+                conn, _ = sock.accept()
+                with conn:
+                    conn.settimeout(5)
+                    try:
+                        request = fsmonitor_recv(conn).decode("utf8")
+                        if request == "quit":
+                            conn.sendall(b'\x00')
+                            return
+                        token, changes = self.query(request)
+                        reply = token.encode("utf8") + b'\x00'
+                        # As in git's protocol, "/" means everything.
+                        for path in ([ "/" ] if changes is None else changes):
+                            reply += path.encode("utf8") + b'\x00'
+                        conn.sendall(reply)
+                    except OSError:
+                        # A client gave up: never mind.
+                        pass
+
+def fsmonitor_socket_path(repo):
+    return repo_path(repo, "fsmonitor.sock")
+
+def fsmonitor_recv(conn):
+    """Read everything from conn, until the other side shuts down its
+    end."""
+    ret = list()
+    while True:
+        data = conn.recv(65536)
+        if not data:
+            return b''.join(ret)
+        ret.append(data)
+
+def fsmonitor_request(repo, request, timeout=5):
+    """Send a request to the daemon, and return its reply, or None if
+    it isn't running."""
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+
+    with sock:
+        try:
+            sock.connect(fsmonitor_socket_path(repo))
+            sock.sendall(request.encode("utf8"))
+            sock.shutdown(socket.SHUT_WR)
+            return fsmonitor_recv(sock)
+        except OSError:
+            # No socket, a stale socket from a dead daemon, or a
+            # daemon too slow to answer: all the same to us.
+            return None
+
+def fsmonitor_query(repo, token):
+    """Ask the daemon what changed since token.  Return a pair (new
+    token, set of changed paths, or None if anything may have
+    changed), or None if the daemon isn't running."""
+
+    reply = fsmonitor_request(repo, token)
+    if not reply:
+        return None
+
+    token, *paths = reply.decode("utf8").split("\x00")[:-1]
+    if "/" in paths:
+        return token, None
+    return token, set(paths)
+
+def fsmonitor_affected(changed, path):
+    """Whether path, or a directory containing it, has changed"""
+
+    while path:
+        if path in changed:
+            return True
+        path = path.rpartition("/")[0]
+    return False
+
+def fsmonitor_refresh(repo, index):
+    """If core.fsmonitor is set, ask the daemon what changed since the
+    index's token, and record its new token.  Entries that may have
+    changed are added to index.fsmonitor_dirty, and the others are up
+    to date.  Return the set of changed paths, or None if we don't
+    know what changed: then every entry is dirty (or, without a
+    daemon, index.fsmonitor_dirty is None)."""
+
+    reply = None
+    if repo_config_bool(repo, "core", "fsmonitor", False):
+        reply = fsmonitor_query(repo, index.fsmonitor_token or "")
+
+    if reply is None:
+        index.fsmonitor_token = index.fsmonitor_dirty = None
+        return None
+
+    token, changed = reply
+    known = index.fsmonitor_token is not None and changed is not None
+    index.fsmonitor_token = token
+
+    if not known:
+        index.fsmonitor_dirty = { e.name for e in index.entries }
+        return None
+
+    for e in index.entries:
+        if e.name in index.fsmonitor_dirty:
+            continue
+        if fsmonitor_affected(changed, e.name):
+            index.fsmonitor_dirty.add(e.name)
+        else:
+            index.uptodate.add(e.name)
+
+    return changed
+
+def fsmonitor_parse(data):
+    """Parse the FSMN extension: a version, the token as a
+    NUL-terminated string, and the size and data of an EWAH bitmap of
+    the positions of dirty entries.  Return a pair (token, positions),
+    or None for versions other than 2, whose tokens are timestamps."""
+
+    if struct.unpack_from(">L", data, 0)[0] != 2:
+        return None
+
+    nul = data.find(b'\x00', 4)
+    token = data[4:nul].decode("utf8")
+    _, dirty = ewah_decode(data, nul + 5)
+
+    return token, dirty
+
+def fsmonitor_serialise(index):
+    dirty = ewah_encode([ i for i, e in enumerate(index.entries) if e.name in index.fsmonitor_dirty ])
+    return struct.pack(">L", 2) + index.fsmonitor_token.encode("utf8") + b'\x00' + struct.pack(">L", len(dirty)) + dirty
+
+argsp = argsubparsers.add_parser("fsmonitor", help="Run a daemon watching the worktree, to speed up status")
+argsp.add_argument("action",
+                   nargs="?",
+                   choices=["run", "start", "stop", "status"],
+                   default="run",
+                   help="Run the daemon in the foreground, start it in the background, stop it, or tell whether it runs (default: run)")
+
+def cmd_fsmonitor(args):
+    repo = repo_find()
+
+    match args.action:
+        case "run":
+            fsmonitor_run(repo)
+        case "start":
+            fsmonitor_start(repo)
+        case "stop":
+            if fsmonitor_request(repo, "quit") is None:
+                raise Exception("The fsmonitor daemon isn't running")
+        case "status":
+            reply = fsmonitor_query(repo, "")
+            if reply:
+                print(f"The fsmonitor daemon is watching {repo.worktree}")
             else:
-                name_length = bytes_len
+                print("The fsmonitor daemon isn't running")
 
-            # We merge back three pieces of data (two flags and the 
-            # length of the name) on the same two bytes
-            f.write((flag_assume_valid | e.flag_stage | name_length).to_bytes(2, "big"))
+def fsmonitor_run(repo, ready=None):
+    """Run the daemon until it's stopped.  ready, if given, is called
+    once it's watching the worktree and listening."""
 
-            # Write back the name, and a final 0x00
-            f.write(name_bytes)
-            f.write((0).to_bytes(1, "big"))
+    path = fsmonitor_socket_path(repo)
 
-            idx += 62 + len(name_bytes) + 1
+    if fsmonitor_request(repo, "") is not None:
+        raise Exception(f"The fsmonitor daemon is already running for {repo.worktree}")
+
+    # A socket left behind by a daemon that died
+    if os.path.exists(path):
+        os.unlink(path)
+
+    monitor = GitFSMonitor(repo)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+    try:
+        sock.bind(path)
+        sock.listen(16)
+        if ready:
+            ready()
+        monitor.serve(sock)
+    finally:
+        sock.close()
+        monitor.inotify.close()
+        if os.path.exists(path):
+            os.unlink(path)
+
+def fsmonitor_start(repo):
+    """Start the daemon in the background, and return once it
+    answers."""
+
+    r, w = os.pipe()
+
+    if os.fork():
+        os.close(w)
+        with os.fdopen(r, "rb") as f:
+            if f.read(1) != b'\x00':
+                raise Exception("The fsmonitor daemon failed to start")
+        return
+
+    # The daemon: detach from the terminal and the session.
+    os.close(r)
+    os.setsid()
+    devnull = os.open(os.devnull, os.O_RDWR)
+    for fd in (0, 1, 2):
+        os.dup2(devnull, fd)
+
+    def ready():
+        os.write(w, b'\x00')
+        os.close(w)
+
+    try:
+        fsmonitor_run(repo, ready)
+    finally:
+        os._exit(0)
 
-            # Add padding if necessary
-            if idx % 8 != 0:
-                pad = 8 - (idx % 8)
-                f.write((0).to_bytes(pad, "big"))
-                idx += pad 
-            
 argsp = argsubparsers.add_parser("rm", help="Remove files from the working tree and the index.")
 argsp.add_argument("path", nargs="+", help="Files to remove")
 
@@ -1296,11 +4781,13 @@ def rm(repo, paths, delete=True, skip_missing=False):
         if full_path in abspaths:
             remove.append(full_path)
             abspaths.remove(full_path)
+            cache_tree_invalidate(index, e.name)
+            untracked_cache_invalidate(index, e.name)
         else:
             kept_entries.append(e)
     
-    if len(abspath) > 0 and not skip_missing:
-        raise Exception("Cannot remove paths not in the index {}".format(abspath))
+    if len(abspaths) > 0 and not skip_missing:
+        raise Exception("Cannot remove paths not in the index {}".format(abspaths))
     
     if delete:
         for path in remove:
@@ -1310,51 +4797,219 @@ def rm(repo, paths, delete=True, skip_missing=False):
     index_write(repo, index)
 
 argsp = argsubparsers.add_parser("add", help = "Add file contents to the index")
-argsp.add_argument("path", nargs = "+", help = "Files to add")
+argsp.add_argument("path", nargs = "+", help = "Files, directories or patterns to add")
+argsp.add_argument("-j",
+                   metavar="jobs",
+                   dest="jobs",
+                   type=int,
+                   default=None,
+                   help="Number of processes hashing files (default: add.workers, or all cores)")
 
 def cmd_add(args):
     repo = repo_find()
-    add(repo, args.path)
+    add(repo, args.path, jobs=repo_jobs(repo, args.jobs, "add", "workers", default=0))
+
+def add(repo, paths, jobs = 1):
+    # Read the index once, and key its entries by path, so that
+    # staging many files costs one read and one write, not one per
+    # file.
+    index = index_read(repo)
+    entries = { e.name: e for e in index.entries }
+
+    files, deleted = add_expand_paths(repo, paths, index)
+
+    for relpath in deleted:
+        del entries[relpath]
+        cache_tree_invalidate(index, relpath)
+        untracked_cache_invalidate(index, relpath)
+
+    # Files the fsmonitor daemon saw no change to since we last checked
+    # them are already staged as they are.
+    fsmonitor_refresh(repo, index)
+    if index.fsmonitor_dirty is not None:
+        files = [ f for f in files if f not in entries or f in index.fsmonitor_dirty ]
+        index.fsmonitor_dirty.difference_update(files)
+
+    # We stat files before hashing them: if a file changes in between,
+    # its stat data won't match the index, and status will notice.
+    abspaths = [ os.path.join(repo.worktree, relpath) for relpath in files ]
+    stats = [ os.stat(abspath) for abspath in abspaths ]
+    shas = object_hash_files(repo, abspaths, jobs)
+    index.uptodate.update(files)
+
+    for relpath, st, sha in zip(files, stats, shas):
+        entry = index_entry_from_stat(relpath, st, sha)
+        old = entries.get(relpath)
+        if not old or old.sha != entry.sha or old.mode_perms != entry.mode_perms:
+            cache_tree_invalidate(index, relpath)
+        if not old:
+            untracked_cache_invalidate(index, relpath)
+        entries[relpath] = entry
+
+    # Git keeps the index sorted by name.
+    index.entries = sorted(entries.values(), key=lambda e: e.name.encode("utf8"))
+    index_write(repo, index)
+
+def add_expand_paths(repo, paths, index):
+    """Expand the paths given to add into a pair of lists of paths
+    relative to the worktree: files to stage, and index entries whose
+    file is gone.
 
-def add(repo, paths, delete = True, skip_missing = True):
-    # First remove all paths from the index if they exist
-    rm(repo, paths, delete=False, skip_missing=True)
+    Each path can be a file, a directory (everything below it that
+    isn't ignored) or a pattern, matched against the whole worktree
+    and the index, as in git's pathspecs."""
 
     worktree = repo.worktree + os.sep
+    tracked = { e.name for e in index.entries }
+    files = dict() # Used as an ordered set
+    deleted = set()
+    ignore = None
+    walked = None
 
-    # Convert the paths to pairs: (absolute, relative_to_worktree)
-    # Also delete them from the index it they're present
-    clean_paths = list()
     for path in paths:
         abspath = os.path.abspath(path)
-        if not (abspath.startswith(worktree) and os.path.isfile(abspath)):
-            raise Exception(f"Not a file, or outside the worktree {paths}")
+
+        if not (abspath.startswith(worktree) or abspath == repo.worktree):
+            raise Exception(f"Outside the worktree {path}")
+
         relpath = os.path.relpath(abspath, repo.worktree)
-        clean_paths.append((abspath, relpath))
 
-        # Find and read the index. It was modified by rm
-        # This is not optimal but good enough for wyag
-        index = index_read(repo)
+        if os.path.isfile(abspath):
+            files[relpath] = None
+            continue
 
-        for (abspath, relpath) in clean_paths:
-            with open(abspath, "rb") as fd:
-                sha = object_hash(fd, b'blob', repo)
-            
-            stat = os.stat(abspath)
+        if ignore is None:
+            ignore = gitignore_read(repo, index)
+
+        if os.path.isdir(abspath):
+            prefix = "" if relpath == "." else relpath + "/"
+            # We don't walk ignored directories, but tracked files are
+            # staged even there.
+            if not (prefix and check_ignore_with_parents(ignore, relpath, True)):
+                for f in worktree_files(repo, abspath, ignore):
+                    if f in tracked or not check_ignore(ignore, f):
+                        files[f] = None
+            present, missing = worktree_tracked(repo, [ name for name in sorted(tracked) if name.startswith(prefix) ])
+            files.update(dict.fromkeys(present))
+            deleted.update(missing)
+            continue
 
-            ctime_s = int(stat.st_ctime)
-            ctime_ns = stat.st_ctime_ns % 10**9
-            mtime_s = int(stat.st_mtime)
-            mtime_ns = stat.st_mtime_ns % 10**9
+        # Anything else is a pattern.  We walk the worktree at most
+        # once, however many patterns we're given.
+        if walked is None:
+            walked = dict.fromkeys(f for f in worktree_files(repo, repo.worktree, ignore)
+                                   if f in tracked or not check_ignore(ignore, f))
+            walked.update(dict.fromkeys(worktree_tracked(repo, sorted(tracked))[0]))
+
+        matched = False
+        for f in walked:
+            if fnmatch(f, relpath):
+                files[f] = None
+                matched = True
+        for name in tracked:
+            if fnmatch(name, relpath) and not os.path.lexists(os.path.join(repo.worktree, name)):
+                deleted.add(name)
+                matched = True
+
+        if not matched:
+            raise Exception(f"Pathspec {path} did not match any files")
+
+    return list(files), deleted
+
+def worktree_tracked(repo, names):
+    """Split names of index entries into a pair of lists: those whose
+    file is in the worktree, and those whose file is gone.  A
+    directory in place of a file is neither."""
+
+    present, missing = list(), list()
+
+    for name in names:
+        try:
+            st = os.lstat(os.path.join(repo.worktree, name))
+        except (FileNotFoundError, NotADirectoryError):
+            missing.append(name)
+            continue
+        if not stat.S_ISDIR(st.st_mode):
+            present.append(name)
 
-            entry = GitIndexEntry(ctime=(ctime_s, ctime_ns), mtime=(mtime_s, mtime_ns), dev=stat.st_dev, ino=0, #stat.st_ino,
-                                  mode_type=0b1000, mode_perms=0o644, uid=stat.st_uid, gid=stat.st_gid,
-                                  fsize=stat.st_size, sha=sha, flag_assume_valid=False,
-                                  flag_stage=False, name=relpath)
-            
-            index.entries.append(entry)
+    return present, missing
+
+def worktree_files(repo, top, ignore=None):
+    """Yield the paths, relative to the worktree, of every file below
+    top, skipping the git directory, in a stable order.  If ignore
+    rules are given, ignored directories are pruned: we never read
+    them, and none of their files are yielded."""
+
+    for root, dirs, files in os.walk(top):
+        if root == repo.worktree and ".git" in dirs:
+            dirs.remove(".git")
+
+        prefix = os.path.relpath(root, repo.worktree)
+        prefix = "" if prefix == "." else prefix + "/"
+
+        # Pruning dirs in place tells os.walk not to descend there.
+        if ignore is not None:
+            dirs[:] = [ d for d in dirs if not check_ignore(ignore, prefix + d, True) ]
+        dirs.sort()
+
+        for f in sorted(files):
+            yield prefix + f
+
+def object_hash_files(repo, paths, jobs=1, write=True):
+    """Hash the files at paths as blobs, and write them unless write
+    is False, using up to jobs processes.  Return their SHAs, in the
+    same order."""
+
+    # Below a few dozen files, starting processes costs more than it
+    # saves.
+    batch = 64
+    jobs = min(jobs, ceil(len(paths) / batch))
+
+    if jobs <= 1:
+        return object_hash_files_run(repo.worktree, paths, write)
+
+    batches = [ paths[i:i + batch] for i in range(0, len(paths), batch) ]
+    ret = list()
+
+    with concurrent.futures.ProcessPoolExecutor(jobs) as executor:
+        for shas in executor.map(object_hash_files_run, [ repo.worktree ] * len(batches), batches,
+                                 [ write ] * len(batches)):
+            ret.extend(shas)
+
+    return ret
+
+def object_hash_files_run(worktree, paths, write=True):
+    # This runs in worker processes, so it takes the path of the
+    # repository rather than a GitRepository.
+    repo = GitRepository(worktree) if write else None
+    ret = list()
+    for path in paths:
+        with open(path, "rb") as fd:
+            ret.append(object_hash(fd, b'blob', repo))
+    return ret
+
+def index_entry_from_stat(name, st, sha):
+    """Build an index entry for file name, from its stat data and
+    SHA.  The index stores 32-bit values, so we truncate."""
 
-        index_write(repo, index)
+    if st.st_mode & stat.S_IXUSR:
+        mode_perms = 0o755
+    else:
+        mode_perms = 0o644
+
+    return GitIndexEntry(ctime=(int(st.st_ctime) & 0xFFFFFFFF, st.st_ctime_ns % 10**9),
+                         mtime=(int(st.st_mtime) & 0xFFFFFFFF, st.st_mtime_ns % 10**9),
+                         dev=st.st_dev & 0xFFFFFFFF,
+                         ino=st.st_ino & 0xFFFFFFFF,
+                         mode_type=0b1000,
+                         mode_perms=mode_perms,
+                         uid=st.st_uid & 0xFFFFFFFF,
+                         gid=st.st_gid & 0xFFFFFFFF,
+                         fsize=st.st_size & 0xFFFFFFFF,
+                         sha=sha,
+                         flag_assume_valid=False,
+                         flag_stage=0,
+                         name=name)
 
 argsp = argsubparsers.add_parser("commit", help = "Record changes to the repository")
 argsp.add_argument("-m",
@@ -1380,67 +5035,65 @@ def gitconfig_user_get(config):
     return None
 
 def tree_from_index(repo, index):
-    contents = dict()
-    contents[""] = list()
-
-    # Enumerate entries and turn them into a dictionary where keys
-    # are directories and values are lists of directory content
-    for entry in index.entries:
-        dirname = os.path.dirname(entry.name)
-
-        # We create all dictionary entries up to root (""). We need
-        # them *all*, because even if a directory holds no files it
-        # will contain at least a tree.
-        key = dirname
-        while key != "":
-            if not key in contents:
-                contents[key] = list()
-            key = os.path.dirname(key)
-
-        # For now store entry in the list
-        contents[dirname].append(entry)
-
-    # Get keys = (= directories) and sort themby length, descending.
-    # This means that we'll alwasy encounter a given path before its
-    # parent, which is all we need, since for each directory we'll
-    # need to modify its parent to add to the directory's tree.
-    sorted_paths = sorted(contents.keys(), key=len, reverse=True)
-
-    # This variable will store the current tree's SHA-1. After we're 
-    # done iterating over our dict, it will contain the hash for the
-    # root tree
-    sha = None
-
-    # We go through the sorted list of paths (dict keys)
-    for path in sorted_paths:
-        # Prepare a new empty tree object
-        tree = GitTree()
-
-        # Add each entry to or new tree in turn
-        for entry in contents[path]:
-            # An entry can be a normal GitIndexEntry read from the 
-            # index, or a tree we've created.
-            if isinstance(entry, GitIndexEntry): # regular entry (a file)
-
-                # We transcode the mode: the entrystores it as integers,
-                # we need an octal ASCII representation for the tree
-                leaf_mode = "{:02o}{:04o}".format(entry.mode_type, entry.mode_perms).encode("ascii")
-                leaf = GitTreeLeaf(mode = leaf_mode, path = os.path.basename(entry.name), sha = entry.sha)
-            else: # Tree, we've stored it as a pair: (basename, SHA)
-                leaf = GitTreeLeaf(mode = b"040000", path = entry[0], sha = entry[1])
-            
-            tree.items.append(leaf)
-        
-        # Write the new tree object to the store
-        sha = object_write(tree, repo)
-
-        # Add the new tree hash to the current dictionary's parent as
-        # a pair (basename, SHA)
-        parent = os.path.dirname(path)
-        base = os.path.basename(path) # The name without the path, e.g. main.go for src/main.go
-        contents[parent].append((base, sha))
-    
-    return sha
+    """Write the tree objects for the index, and return the SHA of the
+    root tree.  Directories whose cache tree node is still valid are
+    not rebuilt: we just reuse the SHA it remembers, so a commit only
+    writes trees for the directories that changed."""
+
+    # Entries of a directory are contiguous in the index, since it's
+    # sorted by name.  Older versions of wyag didn't keep it sorted.
+    entries = sorted((e for e in index.entries if e.flag_stage == 0),
+                     key=lambda e: e.name.encode("utf8"))
+
+    if not index.cache_tree:
+        index.cache_tree = GitCacheTree()
+
+    cache_tree_update(repo, entries, 0, "", index.cache_tree)
+
+    return index.cache_tree.sha
+
+def cache_tree_update(repo, entries, start, prefix, node):
+    """Make sure node holds the SHA of the tree for directory prefix,
+    whose entries begin at entries[start], writing it (and its
+    subtrees) if necessary.  Return the number of entries it covers."""
+
+    # A valid node claims to cover entries[start:end]: check that
+    # this is indeed the whole directory before we trust it.
+    end = start + node.entry_count
+    if (node.sha and 0 < node.entry_count and end <= len(entries)
+        and entries[start].name.startswith(prefix)
+        and entries[end - 1].name.startswith(prefix)
+        and (end == len(entries) or not entries[end].name.startswith(prefix))):
+        return node.entry_count
+
+    tree = GitTree()
+    children = dict()
+    i = start
+
+    while i < len(entries) and entries[i].name.startswith(prefix):
+        entry = entries[i]
+        name = entry.name[len(prefix):]
+        slash = name.find("/")
+
+        if slash < 0: # regular entry (a file)
+            # We transcode the mode: the entry stores it as integers,
+            # we need an octal ASCII representation for the tree
+            leaf_mode = "{:02o}{:04o}".format(entry.mode_type, entry.mode_perms).encode("ascii")
+            tree.items.append(GitTreeLeaf(mode = leaf_mode, path = name, sha = entry.sha))
+            i += 1
+        else: # a subdirectory: recurse
+            name = name[:slash]
+            child = node.children.get(name) or GitCacheTree()
+            children[name] = child
+            i += cache_tree_update(repo, entries, i, prefix + name + "/", child)
+            tree.items.append(GitTreeLeaf(mode = b"040000", path = name, sha = child.sha))
+
+    # Write the new tree object to the store
+    node.sha = object_write(tree, repo)
+    node.entry_count = i - start
+    node.children = children
+
+    return node.entry_count
 
 def commit_create(repo, tree, parent, author, timestamp, message):
     commit = GitCommit()
@@ -1470,6 +5123,9 @@ def cmd_commit(args):
     # Create trees, grab back SHA for root
     tree = tree_from_index(repo, index)
 
+    # Save the updated cache tree, for the next commit
+    index_write(repo, index)
+
     # Create the commit object
     commit = commit_create(repo, 
                            tree, 
@@ -1482,8 +5138,550 @@ def cmd_commit(args):
     active_branch = branch_get_active(repo)
 
     if active_branch: # If we're on a branch, we update refs/heads/BRANCH
-        with open(repo_file(repo, os.path.join("refs/heads", active_branch)), "w") as fd:
-            fd.write(commit + "\n")
+        ref_update(repo, "refs/heads/" + active_branch, commit)
     else: # Otherwise, update HEAD itself
-        with open(repo_file(repo, "HEAD"), "w") as fd:
-            fd.write("\n")
\ No newline at end of file
+        ref_update(repo, "HEAD", commit)
+
+argsp = argsubparsers.add_parser("repack", help="Pack loose objects")
+argsp.add_argument("-d",
+                   dest="prune",
+                   action="store_true",
+                   help="Remove the loose objects that were packed")
+argsp.add_argument("--window",
+                   type=int,
+                   default=None,
+                   help="Number of objects to try as delta bases (default: pack.window, or 10)")
+argsp.add_argument("--depth",
+                   type=int,
+                   default=None,
+                   help="Maximum length of delta chains (default: pack.depth, or 50)")
+argsp.add_argument("--threads",
+                   type=int,
+                   default=None,
+                   help="Number of worker processes looking for deltas (default: pack.threads, or all cores)")
+
+argsp = argsubparsers.add_parser("gc", help="Pack loose objects and remove them")
+
+def cmd_repack(args):
+    repo = repo_find()
+    repack(repo, prune=args.prune, window=args.window, depth=args.depth, threads=args.threads)
+
+def cmd_gc(args):
+    repo = repo_find()
+    repack(repo, prune=True)
+
+def objects_reachable(repo, roots, blobs=()):
+    """Walk the object graph from roots, and yield every object it
+    reaches as a triple (sha, fmt, path), path being the object's
+    path in the first tree it was found in (or "").  blobs are extra
+    (sha, path) pairs of blobs to yield, such as the index's.  Only
+    commits, trees and tags are read: blobs are yielded without ever
+    being opened."""
+
+    seen = set()
+    # A stack of (sha, fmt, path) triples, fmt being None when we
+    # don't know the type of an object yet.
+    stack = [ (sha, None, "") for sha in roots if sha ]
+    stack.extend((sha, b'blob', path) for sha, path in blobs)
+    graph = repo_commit_graph(repo)
+
+    while stack:
+        sha, fmt, path = stack.pop()
+
+        if sha in seen:
+            continue
+        seen.add(sha)
+
+        if fmt is None:
+            info = object_info(repo, sha)
+            if not info:
+                raise Exception(f"Missing object {sha}")
+            fmt = info[0]
+
+        if fmt == b'blob':
+            yield sha, fmt, path
+            continue
+
+        # The commit graph knows the tree and parents of commits
+        pos = commit_graph_find(graph, sha) if graph and fmt == b'commit' else None
+        if pos is not None:
+            yield sha, fmt, path
+            tree, parents, _, _ = commit_graph_record(graph, pos)
+            stack.append((tree.hex(), b'tree', ""))
+            for parent in parents:
+                stack.append((commit_graph_name(graph, parent).hex(), b'commit', ""))
+            continue
+
+        obj = object_read(repo, sha)
+        if not obj:
+            raise Exception(f"Missing object {sha}")
+        yield sha, obj.fmt, path
+
+        match obj.fmt:
+            case b'commit':
+                stack.append((kvlm_sha_headers(obj, b'tree')[0], b'tree', ""))
+                for parent in kvlm_sha_headers(obj, b'parent'):
+                    stack.append((parent, b'commit', ""))
+            case b'tag':
+                stack.append((kvlm_sha_headers(obj, b'object')[0], None, ""))
+            case b'tree':
+                for mode, name, item_sha in tree_entries(obj):
+                    if mode.startswith(b'04'):
+                        stack.append((item_sha.hex(), b'tree', os.path.join(path, name.decode("utf8"))))
+                    elif not mode.startswith(b'16'):
+                        # Submodules (gitlinks) point to commits in
+                        # another repository: skip them.
+                        stack.append((item_sha.hex(), b'blob', os.path.join(path, name.decode("utf8"))))
+
+pack_fmt_type = { fmt: type for type, fmt in pack_type_fmt.items() }
+
+class GitPackWriter(object):
+    """Write a packfile and its version 2 index, one object at a time.
+    The number of objects must be known in advance, since it's part of
+    the pack header."""
+
+    def __init__(self, repo, count):
+        self.repo = repo
+        self.count = count
+        self.offset = 0
+        self.entries = list()
+        self.sha = hashlib.sha1()
+
+        path = repo_dir(repo, "objects", "pack", mkdir=True)
+        self.tmp_path = os.path.join(path, f"tmp_pack_{os.getpid()}")
+        self.f = open(self.tmp_path, "wb")
+
+        self.write(b'PACK' + struct.pack(">LL", 2, count))
+
+    def write(self, data):
+        self.f.write(data)
+        self.sha.update(data)
+        self.offset += len(data)
+
+    def entry_header(self, type, size):
+        """Encode a pack entry header: type and size in a varint."""
+        c = (type << 4) | (size & 0x0f)
+        size >>= 4
+        ret = bytearray()
+        while size:
+            ret.append(c | 0x80)
+            c = size & 0x7f
+            size >>= 7
+        ret.append(c)
+        return bytes(ret)
+
+    def add(self, sha, fmt, size, chunks):
+        """Add a full object.  Its data is read from the chunks iterator
+        and compressed on the fly, so it never sits whole in memory.
+        Return the object's offset in the pack."""
+        return self.add_entry(sha, self.entry_header(pack_fmt_type[fmt], size), chunks)
+
+    def add_delta(self, sha, base_offset, delta):
+        """Add an object as a delta against the object at base_offset,
+        which must already be in this pack."""
+
+        header = self.entry_header(PACK_OBJ_OFS_DELTA, len(delta))
+
+        return self.add_entry(sha, header + varint_encode(self.offset - base_offset), [ delta ])
+
+    def add_entry(self, sha, header, chunks):
+        offset = self.offset
+        crc = zlib.crc32(header)
+        self.write(header)
+
+        c = zlib.compressobj()
+        for chunk in chunks:
+            data = c.compress(chunk)
+            if data:
+                crc = zlib.crc32(data, crc)
+                self.write(data)
+        data = c.flush()
+        crc = zlib.crc32(data, crc)
+        self.write(data)
+
+        self.entries.append((bytes.fromhex(sha), crc, offset))
+        return offset
+
+    def finish(self):
+        """Write the pack trailer and the index, and move both in
+        place.  Return the pack's name."""
+
+        if len(self.entries) != self.count:
+            raise Exception(f"Pack should hold {self.count} objects, not {len(self.entries)}")
+
+        pack_sha = self.sha.digest()
+        self.f.write(pack_sha)
+        self.f.close()
+
+        name = "pack-" + pack_sha.hex()
+        path = os.path.dirname(self.tmp_path)
+
+        self.entries.sort()
+        idx = bytearray(b'\xfftOc' + struct.pack(">L", 2))
+
+        # Fanout table
+        fanout = [0] * 256
+        for binsha, _, _ in self.entries:
+            fanout[binsha[0]] += 1
+        total = 0
+        for i in range(256):
+            total += fanout[i]
+            fanout[i] = total
+        idx += struct.pack(">256L", *fanout)
+
+        # Names, then CRCs, then offsets.  Offsets that don't fit in
+        # 31 bits go to a table of 64-bit offsets at the end.
+        large = list()
+        for binsha, _, _ in self.entries:
+            idx += binsha
+        for _, crc, _ in self.entries:
+            idx += struct.pack(">L", crc)
+        for _, _, offset in self.entries:
+            if offset < 0x80000000:
+                idx += struct.pack(">L", offset)
+            else:
+                idx += struct.pack(">L", 0x80000000 | len(large))
+                large.append(offset)
+        for offset in large:
+            idx += struct.pack(">Q", offset)
+
+        idx += pack_sha
+        idx += hashlib.sha1(idx).digest()
+
+        # The .pack goes first, so that the .idx never points to a
+        # missing pack.
+        os.replace(self.tmp_path, os.path.join(path, name + ".pack"))
+        with open(os.path.join(path, name + ".idx.tmp"), "wb") as f:
+            f.write(idx)
+        os.replace(os.path.join(path, name + ".idx.tmp"), os.path.join(path, name + ".idx"))
+
+        return name
+
+# Deltas
+# ======
+#
+# Most objects are small edits of another object, typically an older
+# version of the same file.  When writing a pack, we try to store
+# each object as a delta against one of the few objects preceding it
+# in a list sorted so that similar objects end up close to each
+# other: by type, then by a hash of their path, then by decreasing
+# size, as git's pack-objects does.
+
+# Smallest run of identical bytes worth a copy instruction
+DELTA_BLOCK = 16
+
+def pack_name_hash(path):
+    """Hash an object's path, so that objects sort by the end of their
+    path: this groups files with the same name, or the same extension,
+    together.  This is git's hash, bit for bit."""
+
+    hash = 0
+    for c in path.encode("utf8"):
+        if c in b' \t\n\v\f\r':
+            continue
+        hash = ((hash >> 2) + (c << 24)) & 0xffffffff
+    return hash
+
+def delta_encode_size(size):
+    """Encode a size as a little-endian varint, for delta headers."""
+    ret = bytearray()
+    while True:
+        c = size & 0x7f
+        size >>= 7
+        if not size:
+            ret.append(c)
+            return bytes(ret)
+        ret.append(c | 0x80)
+
+def delta_index(base):
+    """Index the blocks of base, mapping their contents to their
+    first offset."""
+    index = dict()
+    # We go backwards, so that first occurrences win.
+    for i in range(len(base) - DELTA_BLOCK - (len(base) % DELTA_BLOCK), -1, -DELTA_BLOCK):
+        index[base[i:i + DELTA_BLOCK]] = i
+    return index
+
+def delta_match_length(base, offset, target, pos):
+    """Length of the common run of base[offset:] and target[pos:]"""
+
+    length = 0
+    limit = min(len(base) - offset, len(target) - pos)
+    step = 4096
+
+    # Compare big slices first, and halve their size on mismatch,
+    # rather than compare byte by byte in Python.
+    while length < limit:
+        n = min(step, limit - length)
+        if base[offset + length:offset + length + n] == target[pos + length:pos + length + n]:
+            length += n
+        elif n == 1:
+            break
+        else:
+            step = n // 2
+
+    return length
+
+def delta_insert(out, target, start, end):
+    """Emit insert instructions for target[start:end]"""
+    while start < end:
+        n = min(127, end - start)
+        out.append(n)
+        out += target[start:start + n]
+        start += n
+
+def delta_copy(out, offset, length):
+    """Emit copy instructions for length bytes of base at offset"""
+    while length:
+        # Copies are limited to 64KiB, for compatibility with old
+        # versions of git.
+        n = min(length, 0x10000)
+        op = 0x80
+        args = bytearray()
+        for i in range(4):
+            b = (offset >> (8 * i)) & 0xff
+            if b:
+                op |= 1 << i
+                args.append(b)
+        for i in range(3):
+            b = (n >> (8 * i)) & 0xff
+            if b:
+                op |= 1 << (4 + i)
+                args.append(b)
+        out.append(op)
+        out += args
+        offset += n
+        length -= n
+
+def delta_create(base, target, index=None, max_size=None):
+    """Compute a delta turning base into target, the reverse of
+    delta_apply.  Return None if the delta would be larger than
+    max_size."""
+
+    if index is None:
+        index = delta_index(base)
+
+    out = bytearray(delta_encode_size(len(base)) + delta_encode_size(len(target)))
+
+    # Start of the target bytes we haven't encoded yet
+    pending = 0
+    pos = 0
+    end = len(target) - DELTA_BLOCK
+
+    while pos <= end:
+        offset = index.get(target[pos:pos + DELTA_BLOCK])
+
+        if offset is None:
+            pos += 1
+            continue
+
+        # Extend the match backwards, over the bytes we were about to
+        # insert, then forwards as far as it goes.
+        while pos > pending and offset > 0 and base[offset - 1] == target[pos - 1]:
+            pos -= 1
+            offset -= 1
+        length = delta_match_length(base, offset, target, pos)
+
+        delta_insert(out, target, pending, pos)
+        delta_copy(out, offset, length)
+        pos += length
+        pending = pos
+
+        if max_size is not None and len(out) > max_size:
+            return None
+
+    delta_insert(out, target, pending, len(target))
+
+    if max_size is not None and len(out) > max_size:
+        return None
+
+    return bytes(out)
+
+def pack_deltify_run(worktree, objects, window, depth, big_file):
+    """Find delta bases for a run of objects, sorted as explained
+    above.  objects is a list of (sha, fmt, size, name hash) tuples.
+    Return a list with, for each object, either None or a pair (index
+    of the base in objects, delta).  Objects larger than big_file are
+    never read: they're neither deltified nor used as bases.
+
+    This runs in worker processes, so it takes the path of the
+    repository rather than a GitRepository."""
+
+    repo = GitRepository(worktree)
+    ret = [ None ] * len(objects)
+    depths = [ 0 ] * len(objects)
+    # The window: [index, data, delta index] for the last few objects
+    recent = collections.deque(maxlen=window)
+
+    for i, (sha, fmt, size, _) in enumerate(objects):
+        if size > big_file:
+            continue
+
+        data = object_read_raw(repo, sha)[1]
+        best = None
+
+        # A delta must at least halve the object to be worth it.
+        # Objects too small for that are still fine bases.
+        max_size = size // 2 - 20
+
+        for candidate in reversed(recent):
+            j, base, _ = candidate
+
+            if max_size <= 0:
+                break
+            if objects[j][1] != fmt or depths[j] >= depth:
+                continue
+            # Don't even try if the base is much larger
+            if size < len(base) // 32:
+                continue
+
+            if candidate[2] is None:
+                candidate[2] = delta_index(base)
+
+            delta = delta_create(base, data, candidate[2], max_size)
+
+            if delta is not None:
+                best = (j, delta)
+                max_size = len(delta) - 1
+
+        if best:
+            ret[i] = best
+            depths[i] = depths[best[0]] + 1
+
+        recent.append([ i, data, None ])
+
+    return ret
+
+# Largest total size of the objects in a run, give or take a path.
+# Deltas are at most half their object, so this bounds the deltas
+# waiting to be written.
+DELTA_RUN_BYTES = 64 * 1024 * 1024
+
+def pack_deltify_runs(objects, threads, big_file):
+    """Split objects into contiguous runs, as (start, end) pairs: one
+    per thread, but none holding much more than DELTA_RUN_BYTES of
+    objects we'll deltify.  Runs only ever end where the path changes,
+    since objects at different paths rarely make good deltas of each
+    other anyway."""
+
+    run_size = ceil(len(objects) / threads)
+    start = 0
+    total = 0
+
+    for i, (_, fmt, size, name_hash) in enumerate(objects):
+        if i > start and (i - start >= run_size or total >= DELTA_RUN_BYTES) \
+           and (fmt, name_hash) != objects[i - 1][1::2]:
+            yield start, i
+            start = i
+            total = 0
+        if size <= big_file:
+            total += size
+
+    yield start, len(objects)
+
+def pack_deltify(repo, objects, window, depth, threads, big_file):
+    """Sort objects (a list of (sha, fmt, size, name hash) tuples) in
+    the order they must be written, and find delta bases for them.
+    Return an iterator over None or a (base index, delta) pair for
+    each object, in that order."""
+
+    objects.sort(key=lambda o: (pack_fmt_type[o[1]], o[3], o[2]), reverse=True)
+
+    if window <= 0:
+        return iter([ None ] * len(objects))
+
+    return pack_deltify_iter(repo, objects, window, depth, threads, big_file)
+
+def pack_deltify_iter(repo, objects, window, depth, threads, big_file):
+    """Deltify objects, already sorted, run by run.  Each run's results
+    are yielded as soon as it's done, so that deltas don't pile up in
+    memory."""
+
+    # Each worker gets a contiguous run of the list, as in git.  Runs
+    # are kept large enough for the workers to be worth starting.
+    threads = max(1, min(threads, len(objects) // 256))
+    runs = pack_deltify_runs(objects, threads, big_file)
+
+    def results(start, run):
+        for result in run:
+            yield (result[0] + start, result[1]) if result else None
+
+    if threads == 1:
+        for start, end in runs:
+            yield from results(start, pack_deltify_run(repo.worktree, objects[start:end],
+                                                       window, depth, big_file))
+        return
+
+    # Keep at most one run per worker going besides the one we wait for.
+    with concurrent.futures.ProcessPoolExecutor(threads) as executor:
+        pending = collections.deque()
+        for start, end in runs:
+            pending.append((start, executor.submit(pack_deltify_run, repo.worktree,
+                                                   objects[start:end], window, depth, big_file)))
+            if len(pending) > threads:
+                start, run = pending.popleft()
+                yield from results(start, run.result())
+        for start, run in pending:
+            yield from results(start, run.result())
+
+def repack(repo, prune=False, window=None, depth=None, threads=None):
+    """Move every reachable loose object to a new pack, storing
+    objects as deltas where possible.  If prune is true, delete the
+    loose copies afterwards."""
+
+    if window is None:
+        window = repo_config_int(repo, "pack", "window", 10)
+    if depth is None:
+        depth = repo_config_int(repo, "pack", "depth", 50)
+    if threads is None:
+        threads = repo_config_int(repo, "pack", "threads", 0)
+    if threads <= 0:
+        threads = os.cpu_count() or 1
+
+    # Objects larger than this are too costly to hold in memory,
+    # let alone index, so they are only ever streamed.
+    big_file = repo_config_int(repo, "core", "bigFileThreshold", 512 * 1024 * 1024)
+
+    # Everything reachable from a ref, HEAD, or the index.
+    roots = list(ref_list(repo).values())
+    roots.append(ref_resolve(repo, "HEAD"))
+    # Gitlinks point to commits in another repository.
+    blobs = [ (entry.sha, entry.name) for entry in index_read(repo).entries
+              if entry.mode_type != 0b1110 ]
+
+    # We only keep names and sizes here, never contents, so memory
+    # stays bounded by the number of objects, not by their size.
+    objects = list()
+    for sha, fmt, path in objects_reachable(repo, roots, blobs):
+        if os.path.isfile(repo_path(repo, "objects", sha[:2], sha[2:])):
+            objects.append((sha, fmt, object_info(repo, sha)[1], pack_name_hash(path)))
+
+    if not objects:
+        return None
+
+    deltas = pack_deltify(repo, objects, window, depth, threads, big_file)
+
+    # Bases always come before their deltas in objects, so they're
+    # always written first, as OFS_DELTA requires.
+    writer = GitPackWriter(repo, len(objects))
+    offsets = list()
+    for (sha, _, _, _), delta in zip(objects, deltas):
+        if delta:
+            offsets.append(writer.add_delta(sha, offsets[delta[0]], delta[1]))
+        else:
+            offsets.append(writer.add(sha, *object_loose_stream(repo, sha)))
+    name = writer.finish()
+
+    # Make sure we see the new pack before touching loose objects.
+    repo_packs(repo, refresh=True)
+
+    if prune:
+        for sha, _, _, _ in objects:
+            os.unlink(repo_path(repo, "objects", sha[:2], sha[2:]))
+        for prefix in { sha[:2] for sha, _, _, _ in objects }:
+            path = repo_path(repo, "objects", prefix)
+            if not os.listdir(path):
+                os.rmdir(path)
+        repo.loose_names = None
+
+    return name